@@ -80,4 +80,7 @@ except KeyboardInterrupt:
 finally:
     for server in done:
         server.cancel()
+
+    # Don't lose writes that haven't been committed yet
+    loop.run_until_complete(state.shutdown())
     loop.close()
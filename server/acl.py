@@ -4,10 +4,11 @@
 # under the terms of the Do What The Fuck You Want To Public License, Version
 # 2, as published by Sam Hocevar. See the LICENSE file for more details.
 
-import asyncio
 import enum
 from time import time
-from collections import defaultdict
+
+from server.names import canonical, key_of
+from server.errors import *
 
 
 class ACL:
@@ -63,179 +64,310 @@ class GroupACLValues(enum.Enum):
     ban_mute = 'ban:mute'
 
 
+def _bit_table(values, grants=False):
+    """ Give each ACL a bit position. If grants is set, grant:<acl> is
+    allowed for every ACL too, and gets its own bit. """
+    names = [v.value for v in values]
+    if grants:
+        names.extend('grant:' + n for n in list(names)
+                     if not n.startswith('grant:'))
+
+    return {n: 1 << i for i, n in enumerate(names)}
+
+
+USER_ACL_BITS = _bit_table(UserACLValues)
+GROUP_ACL_BITS = _bit_table(GroupACLValues, True)
+
+
+def _mask(table, acl):
+    """ Turn an ACL, ACL enum value, or iterable of them into a bitmask.
+    Unknown ACL's get no bits (so nobody ever has them). """
+    if isinstance(acl, int):
+        return acl
+
+    if isinstance(acl, (str, enum.Enum)):
+        return table.get(getattr(acl, 'value', acl), 0)
+
+    mask = 0
+    for a in acl:
+        mask |= table.get(getattr(a, 'value', a), 0)
+
+    return mask
+
+
+def user_mask(acl):
+    """ Precompute the mask for user ACL checks """
+    return _mask(USER_ACL_BITS, acl)
+
+
+def group_mask(acl):
+    """ Precompute the mask for group ACL checks """
+    return _mask(GROUP_ACL_BITS, acl)
+
+
+def _names(table, mask):
+    return [n for n, bit in table.items() if mask & bit]
+
+
+def _metadata(rows, held):
+    """ Build the acl -> ACL side table from storage rows, skipping ACL's
+    that have since been removed """
+    meta = dict()
+    for row in rows:
+        row = dict(row)
+        acl = row['acl']
+        if not held(acl):
+            continue
+
+        meta[acl] = ACL(row.get('setter'), row.get('reason'),
+                        row.get('timestamp'))
+
+    return meta
+
+
 class UserACLSet:
+    """ A user's ACL's.
+
+    What the user holds is a single int, one bit per ACL (see
+    USER_ACL_BITS), so checks are a single AND. Who set each ACL, when and
+    why is only needed for listing, so the storage rows are kept as they
+    are and turned into ACL objects the first time someone asks.
+    """
 
-    __slots__ = ['server', 'user', 'acl_map']
+    __slots__ = ['server', 'user', 'mask', 'rows', 'meta']
 
     def __init__(self, server, user, acl_data=[]):
         # NOTE - we use acl_data here separate instead of getting it ourselves
         # because __init__ being a coroutine is probably dodgy.
         self.server = server
-        self.user = user.lower()
-        self.acl_map = dict()
+        self.user = canonical(user)
+        self.mask = 0
 
-        if not acl_data:
-            return
+        self.rows = list(acl_data) if acl_data else []
+        self.meta = None
 
-        for acl in acl_data:
-            self._add_nocommit(acl['acl'], acl['setter'], acl['reason'],
-                               acl['timestamp'])
+        for acl in self.rows:
+            self.mask |= USER_ACL_BITS.get(acl['acl'], 0)
 
     def __iter__(self):
-        return self.acl_map.items()
+        return iter(_names(USER_ACL_BITS, self.mask))
+
+    def __contains__(self, acl):
+        return self.has_acl(acl)
+
+    def __len__(self):
+        return bin(self.mask).count('1')
 
     def has_acl(self, acl):
-        return acl in self.acl_map
+        bit = user_mask(acl)
+        return bit != 0 and self.mask & bit == bit
 
     def has_any(self, acl):
-        if isinstance(acl, str):
-            return self.has_acl(acl)
-
-        return any(self.has_acl(a) for a in acl)
+        return bool(self.mask & user_mask(acl))
 
     def has_all(self, acl):
-        if isinstance(acl, str):
-            return self.has_acl(acl)
+        mask = user_mask(acl)
+        return mask != 0 and self.mask & mask == mask
+
+    def _load_meta(self):
+        if self.meta is None:
+            self.meta = _metadata(self.rows, self.has_acl)
+            self.rows = []
 
-        return all(self.has_acl(a) for a in acl)
+        return self.meta
 
     def get(self, acl):
-        return self.acl_map.get(acl)
+        if not self.has_acl(acl):
+            return None
 
-    USERACL_MEMBERS = frozenset(a.value for a in
-                                UserACLValues.__members__.values())
+        return self._load_meta().get(getattr(acl, 'value', acl))
 
-    def _add_nocommit(self, acl, setter=None, reason=None, time_=None):
-        if acl in self.acl_map:
-            return (False, ACLExistsError(acl))
+    def items(self):
+        """ Get (acl, ACL) pairs, with who set them and when """
+        meta = self._load_meta()
+        return [(acl, meta.get(acl) or ACL()) for acl in self]
 
-        if acl not in self.USERACL_MEMBERS:
-            return (False, ACLValueError(acl))
+    def _add_nocommit(self, acl, setter=None, reason=None, time_=None):
+        self.mask |= USER_ACL_BITS[acl]
 
-        self.acl_map[acl] = ACL(setter, reason, time_)
-        return (True, None)
+        if self.meta is None:
+            self.rows.append({'acl': acl, 'setter': setter, 'reason': reason,
+                              'timestamp': time_})
+        else:
+            self.meta[acl] = ACL(setter, reason, time_)
 
     def add(self, acl, setter=None, reason=None):
-        if not isinstance(acl, str):
-            for a in acl:
-                self.add(a, setter, reason)
+        """ Add an ACL or a list of them. Either they all go in (in one
+        storage transaction) or, if any is bad, none do. """
+        acls = [acl] if isinstance(acl, str) else list(acl)
+
+        mask = 0
+        for a in acls:
+            bit = USER_ACL_BITS.get(a)
+            if bit is None:
+                raise ACLValueError(a)
+            elif (self.mask | mask) & bit:
+                raise ACLExistsError(a)
 
-            return
+            mask |= bit
 
-        ret, code = self._add_nocommit(acl, setter, reason)
-        if not ret:
-            raise code
+        setter = key_of(setter)
+        for a in acls:
+            self._add_nocommit(a, setter, reason)
 
-        asyncio.async(self.server.proto_store.create_user_acl(self.user, acl,
-                                                              reason))
+        self.server.permissions.invalidate(self.user)
+
+        rows = [(a, setter, reason) for a in acls]
+        self.server.proto_store.write('create_user_acls', self.user, rows)
 
     def delete(self, acl):
-        if not isinstance(acl, str):
-            for a in acl:
-                self.delete(a)
+        """ Remove an ACL or a list of them, all or nothing """
+        acls = [acl] if isinstance(acl, str) else list(acl)
 
-            return
+        mask = user_mask(acls)
+        for a in acls:
+            if not self.has_acl(a):
+                raise ACLDoesNotExistError('ACL does not exist')
 
-        if acl not in self.acl_map:
-            raise ACLDoesNotExistError('ACL does not exist')
+        self.mask &= ~mask
+        if self.meta is not None:
+            for a in acls:
+                self.meta.pop(a, None)
 
-        del self.acl_map[acl]
+        self.server.permissions.invalidate(self.user)
 
-        asyncio.async(self.server.proto_store.del_user_acl(acl, self.user))
+        self.server.proto_store.write('del_user_acls', self.user, acls)
 
 
 class GroupACLSet:
-    __slots__ = ['server', 'group', 'acl_map']
+    """ ACL's users hold in a group: one bitmask per user (see
+    GROUP_ACL_BITS), with metadata kept aside as for UserACLSet """
+
+    __slots__ = ['server', 'group', 'masks', 'rows', 'meta']
 
     def __init__(self, server, group, acl_data=None):
         self.server = server
-        self.group = group
+        self.group = canonical(group)
 
-        # XXX this is a hack and will change someday
-        # (dict of a dict is no way to live)
-        self.acl_map = defaultdict(dict)
+        # User key -> mask
+        self.masks = dict()
 
-        if not acl_data:
-            return
+        self.rows = list(acl_data) if acl_data else []
+        self.meta = None
 
-        for acl in acl_data:
-            self._add_nocommit(acl['target'], acl['acl'], acl['setter'],
-                               acl['reason'], acl['timestamp'])
+        for acl in self.rows:
+            bit = GROUP_ACL_BITS.get(acl['acl'], 0)
+            if bit:
+                user = canonical(acl['target'])
+                self.masks[user] = self.masks.get(user, 0) | bit
 
     def __iter__(self):
-        for user, acl_ in self.acl_map.items():
-            for acl in acl_:
+        for user, mask in self.masks.items():
+            for acl in _names(GROUP_ACL_BITS, mask):
                 yield (user, acl)
 
+    def mask(self, user):
+        return self.masks.get(key_of(user), 0)
+
     def has_acl(self, user, acl):
-        user = getattr(user, 'name', user)
-        return acl in self.acl_map[user]
+        bit = group_mask(acl)
+        return bit != 0 and self.mask(user) & bit == bit
 
     def has_any(self, user, acl):
-        if isinstance(acl, str):
-            return self.has_acl(user, acl)
-
-        return any(self.has_acl(user, a) for a in acl)
+        return bool(self.mask(user) & group_mask(acl))
 
     def has_all(self, user, acl):
-        if isinstance(acl, str):
-            return self.has_acl(user, acl)
+        mask = group_mask(acl)
+        return mask != 0 and self.mask(user) & mask == mask
+
+    def _load_meta(self):
+        if self.meta is None:
+            rows = []
+            for row in self.rows:
+                row = dict(row)
+                row['acl'] = (canonical(row['target']), row['acl'])
+                rows.append(row)
 
-        return all(self.has_acl(user, a) for a in acl)
+            self.meta = _metadata(rows,
+                                  lambda k: self.has_acl(k[0], k[1]))
+            self.rows = []
+
+        return self.meta
 
     def get(self, user, acl):
-        user = getattr(user, 'name', user)
-        return self.acl_map.get(user)
+        user = key_of(user)
+        if not self.has_acl(user, acl):
+            return None
 
-    GROUPACL_MEMBERS = frozenset(a.value for a in
-                                 GroupACLValues.__members__.values())
+        return self._load_meta().get((user, getattr(acl, 'value', acl)))
 
-    def _add_nocommit(self, user, acl, setter=None, reason=None, time_=None):
-        if acl in self.acl_map[user]:
-            pass
+    def items(self):
+        """ Get ((user, acl), ACL) pairs, with who set them and when """
+        meta = self._load_meta()
+        return [(k, meta.get(k) or ACL()) for k in self]
 
-        if acl not in self.GROUPACL_MEMBERS:
-            if acl.replace('grant:', '') not in self.GROUPACL_MEMBERS:
-                return
+    def _add_nocommit(self, user, acl, setter=None, reason=None, time_=None):
+        self.masks[user] = self.masks.get(user, 0) | GROUP_ACL_BITS[acl]
 
-        self.acl_map[user][acl] = ACL(setter, reason, time_)
+        if self.meta is None:
+            self.rows.append({'acl': acl, 'target': user, 'setter': setter,
+                              'reason': reason, 'timestamp': time_})
+        else:
+            self.meta[(user, acl)] = ACL(setter, reason, time_)
 
     def add(self, user, acl, setter=None, reason=None):
-        user = getattr(user, 'name', user)
-        if not isinstance(acl, str):
-            for a in acl:
-                self.add(user, a, setter, reason)
+        """ Give user an ACL or a list of them in this group, all or
+        nothing and in one storage transaction """
+        user = key_of(user)
+        acls = [acl] if isinstance(acl, str) else list(acl)
 
-            return
+        held = self.masks.get(user, 0)
+        for a in acls:
+            bit = GROUP_ACL_BITS.get(a)
+            if bit is None:
+                raise ACLValueError(a)
+            elif held & bit:
+                raise ACLExistsError(a)
 
-        if acl in self.acl_map[user]:
-            raise ACLExistsError(acl)
+            held |= bit
 
-        if acl not in self.GROUPACL_MEMBERS:
-            if acl.replace('grant:', '') not in self.GROUPACL_MEMBERS:
-                # Allow special grant: ACL's
-                raise ACLValueError(acl)
+        setter = key_of(setter)
+        for a in acls:
+            self._add_nocommit(user, a, setter, reason)
 
-        self._add_nocommit(user, acl, setter, reason)
+        self.server.permissions.invalidate(user, self.group)
 
-        asyncio.async(self.server.proto_store.create_group_acl(self.group,
-                      user, acl, setter, reason))
+        rows = [(user, a, setter, reason) for a in acls]
+        self.server.proto_store.write('create_group_acls', self.group, rows)
 
     def delete(self, user, acl):
-        user = getattr(user, 'name', user)
-        if not isinstance(acl, str):
-            for a in acl:
-                self.delete(user, a)
+        """ Take an ACL or a list of them from user, all or nothing """
+        user = key_of(user)
+        acls = [acl] if isinstance(acl, str) else list(acl)
+
+        for a in acls:
+            if not self.has_acl(user, a):
+                raise ACLDoesNotExistError('ACL does not exist')
 
-            return
+        mask = self.masks[user] & ~group_mask(acls)
+        if mask:
+            self.masks[user] = mask
+        else:
+            del self.masks[user]
 
-        if acl not in self.acl_map[user]:
-            raise ACLDoesNotExistError('ACL does not exist')
+        if self.meta is not None:
+            for a in acls:
+                self.meta.pop((user, a), None)
 
-        del self.acl_map[user][acl]
+        self.server.permissions.invalidate(user, self.group)
 
-        asyncio.async(self.server.proto_store.del_group_acl(self.group, user,
-                      acl))
+        rows = [(user, a) for a in acls]
+        self.server.proto_store.write('del_group_acls', self.group, rows)
 
     def delete_all(self, user):
-        self.acl_map.pop(user, None)
+        user = key_of(user)
+        self.masks.pop(user, None)
+        self.server.permissions.invalidate(user, self.group)
+        if self.meta is not None:
+            for key in [k for k in self.meta if k[0] == user]:
+                del self.meta[key]
@@ -15,6 +15,9 @@ logger = logging.getLogger(__name__)
 
 
 class Command:
+    # Expensive commands are refused when the server is overloaded
+    expensive = False
+
     def unregistered(self, server, proto, line):
         "Execute this action for unregistered users"
         if id(Command.registered) != id(self.registered):
@@ -7,83 +7,71 @@
 import asyncio
 
 from server.command import Command, register
+from server.acl import GROUP_ACL_BITS
+from server.errors import ACLError
 
 
 class ACLBase:
-    @asyncio.coroutine
     @staticmethod
     def has_grant_group(server, user, gtarget, acl):
         if user not in gtarget.users:
             return (False, 'Must be in group to alter ACL\'s in it')
 
-        check_grant = ['grant:*']
-        check_grant.extend('grant:' + a for a in acl)
-        if gtarget.acl.has_any(check_grant):
-            return (True, None)
-        else:
-            if not gtarget.acl.has_acl('group:grant'):
-                return (False, 'No permission to alter ACL')
+        if not all(server.permissions.check(user, gtarget, 'grant:' + a)
+                   for a in acl):
+            return (False, 'No permission to alter ACL')
 
         return (True, None)
 
-    @asyncio.coroutine
     @staticmethod
     def has_grant_user(server, user, utarget, acl):
-        check_grant = ['user:grant']
-        check_grant.extend(acl)
-        if not gtarget.acl.has_acl_all(check_grant):
+        if not all(server.permissions.check(user, None, 'grant-user:' + a)
+                   for a in acl):
             return (False, 'No permission to alter ACL')
 
         return (True, None)
 
-    @asyncio.coroutine
     @staticmethod
     def has_grant(server, user, gtarget, utarget, acl):
-        target = getattr(target, 'name', target)
-
         if isinstance(acl, str):
             acl = (acl,)
 
-        if target[0] == '#':
-            ret = (yield from ACLBase.has_grant_group(server, user, gtarget,
-                                                      acl))
+        if gtarget is not None:
+            return ACLBase.has_grant_group(server, user, gtarget, acl)
         else:
-            ret = (yield from ACLBase.has_grant_user(server, user, utarget,
-                                                     acl))
-
-        return ret
+            return ACLBase.has_grant_user(server, user, utarget, acl)
 
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         if 'acl' not in line.kval or not line.kval['acl']:
-            server.error(user, line.command, 'No ACL', False,
-                         {'target': [target]})
+            server.error(proto, line.command, 'No ACL', False,
+                         {'target': [line.target]})
             return (None, None)
 
         # Obtain target info
         line.kval['acl'] = acl = [a.lower() for a in line.kval['acl']]
         line.target = target = line.target.lower()
         if target == '*':
-            server.error(user, line.command, 'No valid target', False,
+            server.error(proto, line.command, 'No valid target', False,
                          {'acl': acl})
             return (None, None)
         elif target[0] == '#':
-            if acl not in GroupACLValues:
-                server.error(user, line.command, 'Invalid ACL', False,
+            if not all(a in GROUP_ACL_BITS for a in acl):
+                server.error(proto, line.command, 'Invalid ACL', False,
                              {'target': [target], 'acl': acl})
                 return (None, None)
 
             gtarget = (yield from server.get_any_target(target))
-            utarget = line.kval.get('user')
+            utarget = line.kval.get('user', [None])[0]
 
             if not utarget:
-                server.error(user, line.command, 'No valid user for target',
+                server.error(proto, line.command, 'No valid user for target',
                              False, {'target': [target], 'acl': acl})
                 return (None, None)
 
-            utarget = (yield from server.get_any_target(utarget.lower()))
+            utarget = (yield from server.get_any_target(utarget))
         elif target[0] == '=':
-            server.error(user, line.command, 'ACL\'s can\'t be set on '
+            server.error(proto, line.command, 'ACL\'s can\'t be set on '
                          'servers yet', False,
                          {'target': [target], 'acl': acl})
             return (None, None)
@@ -91,13 +79,19 @@ class ACLBase:
             gtarget = None
             utarget = (yield from server.get_any_target(target))
 
+        if utarget is None or (target[0] == '#' and gtarget is None):
+            server.error(proto, line.command, 'No such target', False,
+                         {'target': [target], 'acl': acl})
+            return (None, None)
+
         return (gtarget, utarget)
 
 
 class ACLSet(ACLBase, Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
-        gtarget, utarget = super().registered(server, user, line)
+        gtarget, utarget = (yield from super().registered(server, user, proto,
+                                                          line))
         if (gtarget, utarget) == (None, None):
             return
 
@@ -108,14 +102,13 @@ class ACLSet(ACLBase, Command):
         else:
             kwds = {'target': [utarget.name]}
 
-        reason = line.kval.get('reason')
+        reason = line.kval.get('reason', [None])[0]
         if reason:
             kwds['reason'] = [reason]
 
-        ret, msg = (yield from self.has_grant(server, user, gtarget, utarget,
-                                              acl))
+        ret, msg = self.has_grant(server, user, gtarget, utarget, acl)
         if not ret:
-            server.error(user, line.command, msg, False, kwds)
+            server.error(proto, line.command, msg, False, kwds)
             return
 
         # Bam
@@ -126,20 +119,21 @@ class ACLSet(ACLBase, Command):
                 utarget.acl.add(acl, user, reason)
         except ACLError as e:
             error = 'Error adding ACL: {}'.format(str(e))
-            server.error(user, line.command, error, False, kwds)
+            server.error(proto, line.command, error, False, kwds)
             return
 
         # Report to the target if they're online
         if gtarget:
             gtarget.send(server, user, line.command, kwds)
-        elif utarget.proto:
+        elif utarget.sessions:
             utarget.send(server, user, line.command, kwds)
 
         user.send(server, user, line.command, kwds)
 
     @asyncio.coroutine
     def ipc(self, server, proto, line):
-        gtarget, utarget = super().registered(server, proto, proto, line)
+        gtarget, utarget = (yield from super().registered(server, proto, proto,
+                                                          line))
         if (gtarget, utarget) == (None, None):
             return
 
@@ -150,31 +144,33 @@ class ACLSet(ACLBase, Command):
         else:
             kwds = {'target': [utarget.name]}
 
-        reason = line.kval.get('reason')
+        reason = line.kval.get('reason', [None])[0]
 
         # Bam
         try:
             if gtarget:
-                gtarget.acl.add(utarget, acl, proto, reason)
+                gtarget.acl.add(utarget, acl, None, reason)
             else:
-                utarget.acl.add(acl, proto, reason)
+                utarget.acl.add(acl, None, reason)
         except ACLError as e:
             error = 'Error adding ACL: {}'.format(str(e))
-            server.error(user, line.command, error, False, kwds)
+            server.error(proto, line.command, error, False, kwds)
             return
 
         # Report to the target if they're online
         if gtarget:
             gtarget.send(server, proto, line.command, kwds)
-        elif utarget.proto:
+        elif utarget.sessions:
             utarget.send(server, proto, line.command, kwds)
 
-        proto.send(server, None, line.commands, kwds)        
+        proto.send(server, None, line.command, kwds)
+
 
 class ACLDel(ACLBase, Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
-        gtarget, utarget = super().registered(server, user, line)
+        gtarget, utarget = (yield from super().registered(server, user, proto,
+                                                          line))
         if (gtarget, utarget) == (None, None):
             return
 
@@ -185,14 +181,13 @@ class ACLDel(ACLBase, Command):
         else:
             kwds = {'target': [utarget.name]}
 
-        reason = line.kval.get('reason')
+        reason = line.kval.get('reason', [None])[0]
         if reason:
             kwds['reason'] = [reason]
 
-        ret, msg = (yield from self.has_grant(server, user, gtarget, utarget,
-                                              acl))
+        ret, msg = self.has_grant(server, user, gtarget, utarget, acl)
         if not ret:
-            server.error(user, line.command, msg, False, kwds)
+            server.error(proto, line.command, msg, False, kwds)
             return
 
         # Bam
@@ -203,20 +198,21 @@ class ACLDel(ACLBase, Command):
                 utarget.acl.delete(acl)
         except ACLError as e:
             error = 'Error deleting ACL: {}'.format(str(e))
-            server.error(user, line.command, error, False, kwds)
+            server.error(proto, line.command, error, False, kwds)
             return
 
         # Report to the target if they're online
         if gtarget:
             gtarget.send(server, user, line.command, kwds)
-        elif utarget.proto:
+        elif utarget.sessions:
             utarget.send(server, user, line.command, kwds)
 
         user.send(server, user, line.command, kwds)
 
     @asyncio.coroutine
     def ipc(self, server, proto, line):
-        gtarget, utarget = super().registered(server, proto, line)
+        gtarget, utarget = (yield from super().registered(server, proto, proto,
+                                                          line))
         if (gtarget, utarget) == (None, None):
             return
 
@@ -227,7 +223,7 @@ class ACLDel(ACLBase, Command):
         else:
             kwds = {'target': [utarget.name]}
 
-        reason = line.kval.get('reason')
+        reason = line.kval.get('reason', [None])[0]
         if reason:
             kwds['reason'] = [reason]
 
@@ -239,22 +235,52 @@ class ACLDel(ACLBase, Command):
                 utarget.acl.delete(acl)
         except ACLError as e:
             error = 'Error deleting ACL: {}'.format(str(e))
-            server.error(user, line.command, error, False, kwds)
+            server.error(proto, line.command, error, False, kwds)
             return
 
         # Report to the target if they're online
         if gtarget:
             gtarget.send(server, proto, line.command, kwds)
-        elif utarget.proto:
+        elif utarget.sessions:
             utarget.send(server, proto, line.command, kwds)
 
         proto.send(server, None, line.command, kwds)
 
 
 class ACLList(ACLBase, Command):
+    @staticmethod
+    def send_list(server, proto, line, target, utarget, kwds):
+        """ Send the ACL's target holds, or just utarget's in a group """
+        entry = []
+        timestamp = []
+        setter = []
+        for acl, val in target.acl.items():
+            if isinstance(acl, tuple):
+                if acl[0] != utarget.key:
+                    continue
+
+                acl = acl[1]
+
+            entry.append(acl)
+            timestamp.append(str(val.time or ''))
+            setter.append(val.setter or '')
+
+        if not entry:
+            proto.send(server, None, line.command, kwds)
+            return
+
+        kwds.update({
+            'acl': entry,
+            'timestamp': timestamp,
+            'setter': setter,
+        })
+        proto.send_multipart(server, None, line.command,
+                             ('acl', 'timestamp', 'setter'), kwds)
+
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
-        gtarget, utarget = super().registered(server, user, line)
+        gtarget, utarget = (yield from super().registered(server, user, proto,
+                                                          line))
         if (gtarget, utarget) == (None, None):
             return
 
@@ -265,85 +291,35 @@ class ACLList(ACLBase, Command):
         else:
             kwds = {'target': [utarget.name]}
 
-        reason = line.kval.get('reason')
-        if reason:
-            kwds['reason'] = [reason]
-
         if gtarget:
             target = gtarget
         else:
             # ACL's should only be viewable by those with grant priv for users
             # TODO is this correct?
-            ret, msg = (yield from self.has_grant(server, user, gtarget,
-                                                  utarget, acl))
+            ret, msg = self.has_grant(server, user, gtarget, utarget, acl)
             if not ret:
-                server.error(user, line.command, msg, False, kwds)
+                server.error(proto, line.command, msg, False, kwds)
                 return
 
             target = utarget
 
-        entry = []
-        timestamp = []
-        setter = []
-        for acl, val in target.acl:
-            entry.append(acl)
-            timestamp.append(val.time)
-            setter.append(val.setter)
-
-        kwds.update({
-            'acl': entry,
-            'timestamp': time,
-            'setter': setter,
-        })
-        user.send_multipart(server, user, line.command,
-                            ('acl', 'timestamp', 'setter'), kwds)
+        self.send_list(server, proto, line, target, utarget, kwds)
 
     @asyncio.coroutine
     def ipc(self, server, proto, line):
-        gtarget, utarget = super().registered(server, proto, line)
+        gtarget, utarget = (yield from super().registered(server, proto, proto,
+                                                          line))
         if (gtarget, utarget) == (None, None):
             return
 
-        acl = line.kval['acl']
-
         if gtarget:
             kwds = {'target': [gtarget.name], 'user': [utarget.name]}
-        else:
-            kwds = {'target': [utarget.name]}
-
-        reason = line.kval.get('reason')
-        if reason:
-            kwds['reason'] = [reason]
-
-        if gtarget:
             target = gtarget
         else:
-            # ACL's should only be viewable by those with grant priv for users
-            # TODO is this correct?
-            ret, msg = (yield from self.has_grant(server, user, gtarget,
-                                                  utarget, acl))
-            if not ret:
-                server.error(user, line.command, msg, False, kwds)
-                return
-
+            kwds = {'target': [utarget.name]}
             target = utarget
 
-        entry = []
-        timestamp = []
-        setter = []
-        for acl, val in target.acl:
-            entry.append(acl)
-            timestamp.append(val.time)
-            setter.append(val.setter)
-
-        kwds.update({
-            'acl': entry,
-            'timestamp': time,
-            'setter': setter,
-        })
-        proto.send_multipart(server, None, line.command,
-                             ('acl', 'timestamp', 'setter'), kwds)
-
+        self.send_list(server, proto, line, target, utarget, kwds)
 
 register.update({
     'acl-set': ACLSet(),
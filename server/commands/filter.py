@@ -0,0 +1,137 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+
+from server.command import Command, register
+from server.filter import LITERAL
+from server.errors import GroupFilterError
+
+
+class FilterBase:
+    @asyncio.coroutine
+    def get_group(self, server, proto, line):
+        target = line.target
+        group = None
+        if target.startswith('#'):
+            group = (yield from server.group_manager.get(target))
+
+        if group is None:
+            server.error(proto, line.command, 'Invalid group', False,
+                         {'target': [target]})
+            return None
+
+        return group
+
+    def rule(self, server, proto, group, line):
+        kind = line.kval.get('type', [LITERAL])[0]
+        pattern = line.kval.get('pattern', [None])[0]
+        if pattern is None:
+            server.error(proto, line.command, 'No pattern', False,
+                         {'target': [group.name]})
+            return None
+
+        return (kind, pattern)
+
+    def can_alter(self, server, user, group):
+        return server.permissions.check(user, group, 'group:filter')
+
+
+class FilterSet(FilterBase, Command):
+    @asyncio.coroutine
+    def registered(self, server, user, proto, line):
+        group = (yield from self.get_group(server, proto, line))
+        if group is None:
+            return
+
+        rule = self.rule(server, proto, group, line)
+        if rule is None:
+            return
+
+        kval = {'target': [group.name], 'type': [rule[0]],
+                'pattern': [rule[1]]}
+
+        if not self.can_alter(server, user, group):
+            server.error(proto, line.command, 'No permission', False, kval)
+            return
+
+        try:
+            group.filter_add(rule[0], rule[1], user)
+        except GroupFilterError as e:
+            server.error(proto, line.command, str(e), False, kval)
+            return
+
+        user.send(server, user, line.command, kval)
+
+
+class FilterDel(FilterBase, Command):
+    @asyncio.coroutine
+    def registered(self, server, user, proto, line):
+        group = (yield from self.get_group(server, proto, line))
+        if group is None:
+            return
+
+        rule = self.rule(server, proto, group, line)
+        if rule is None:
+            return
+
+        kval = {'target': [group.name], 'type': [rule[0]],
+                'pattern': [rule[1]]}
+
+        if not self.can_alter(server, user, group):
+            server.error(proto, line.command, 'No permission', False, kval)
+            return
+
+        try:
+            group.filter_del(rule[0], rule[1])
+        except GroupFilterError as e:
+            server.error(proto, line.command, str(e), False, kval)
+            return
+
+        user.send(server, user, line.command, kval)
+
+
+class FilterList(FilterBase, Command):
+    @asyncio.coroutine
+    def registered(self, server, user, proto, line):
+        group = (yield from self.get_group(server, proto, line))
+        if group is None:
+            return
+
+        if (group not in user.groups and
+                not self.can_alter(server, user, group)):
+            server.error(proto, line.command, 'No permission', False,
+                         {'target': [group.name]})
+            return
+
+        kval = {
+            'target': [group.name],
+        }
+
+        if not group.filters:
+            proto.send(server, user, line.command, kval)
+            return
+
+        kind = []
+        pattern = []
+        hits = []
+        for rule in group.filters:
+            kind.append(rule[0])
+            pattern.append(rule[1])
+            hits.append(str(group.filter_hits[rule]))
+
+        kval['type'] = kind
+        kval['pattern'] = pattern
+        kval['hits'] = hits
+        proto.send_multipart(server, user, line.command,
+                             ('type', 'pattern', 'hits'), kval)
+
+
+register.update({
+    'filter-set': FilterSet(),
+    'filter-del': FilterDel(),
+    'filter-list': FilterList(),
+})
@@ -9,6 +9,7 @@ import asyncio
 import server.parser as parser
 
 from server.command import Command, register
+from server.commands.history import MAXHISTORY
 
 
 class GroupEnter(Command):
@@ -16,65 +17,67 @@ class GroupEnter(Command):
     def registered(self, server, user, proto, line):
         target = line.target
         if target == '*':
-            server.error(user, line.command, 'No valid target', False)
+            server.error(proto, line.command, 'No valid target', False)
             return
 
         if not target.startswith('#'):
-            server.error(user, line.command, 'Invalid group', False,
+            server.error(proto, line.command, 'Invalid group', False,
                          {'target': [target]})
             return
 
         if len(target) > parser.MAXTARGET:
-            server.error(user, line.command, 'Group name too long', False,
+            server.error(proto, line.command, 'Group name too long', False,
                          {'target': [target]})
             return
 
-        if target not in server.groups:
-            logger.info('Creating group %s', target)
-            server.groups[target] = Group(target)
-
-        group = server.groups[target]
+        group = (yield from server.group_manager.get_or_create(target))
         if group in user.groups:
             assert user in group.users
-            server.error(user, line.command, 'You are already entered', False,
+            server.error(proto, line.command, 'You are already entered', False,
                          {'target': [target]})
             return
 
-        kval = {}
-        reason = line.kval.get('reason')
-        if reason is not None:
-            kval['reason'] = [reason]
-
+        reason = line.kval.get('reason', [None])[0]
         group.member_add(user, reason)
 
+        # Recent scrollback, unless they asked for less
+        try:
+            count = int(line.kval.get('history', [server.scrollback_join])[0])
+        except ValueError:
+            count = server.scrollback_join
+
+        count = max(0, min(count, MAXHISTORY))
+        if count:
+            yield from group.history(proto, count)
+
 
 class GroupExit(Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         target = line.target
         if target == '*':
-            server.error(user, line.command, 'No valid target', False)
+            server.error(proto, line.command, 'No valid target', False)
             return
 
         if not target.startswith('#') or target not in server.groups:
-            server.error(user, line.command, 'Invalid group', False,
+            server.error(proto, line.command, 'Invalid group', False,
                          {'target': [target]})
             return
 
         group = server.groups[target]
         if group not in user.groups:
             assert user not in group.users
-            server.error(user, line.command, 'You are not in that group',
+            server.error(proto, line.command, 'You are not in that group',
                          False, {'target': [target]})
             return
 
         kval = {}
-        reason = line.kval.get('reason')
+        reason = line.kval.get('reason', [None])[0]
         if reason is not None:
             kval['reason'] = [reason]
 
         group.member_del(user, kval)
-        group.send(self, user, 'group-exit', kval)
+        user.send(user, group, 'group-exit', kval)
 
 register.update({
     'group-enter': GroupEnter(),
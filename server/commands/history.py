@@ -0,0 +1,43 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+
+from server.command import Command, register
+
+
+MAXHISTORY = 500
+
+
+class History(Command):
+    @asyncio.coroutine
+    def registered(self, server, user, proto, line):
+        target = line.target
+        if target == '*':
+            server.error(proto, line.command, 'No valid target', False)
+            return
+
+        group = server.groups.get(target) if target.startswith('#') else None
+        if group is None or group not in user.groups:
+            server.error(proto, line.command, 'You are not in that group',
+                         False, {'target': [target]})
+            return
+
+        try:
+            count = int(line.kval.get('count', [str(MAXHISTORY)])[0])
+            since = line.kval.get('since', [None])[0]
+            if since is not None:
+                since = float(since)
+        except ValueError:
+            server.error(proto, line.command, 'Invalid count or timestamp',
+                         False)
+            return
+
+        count = max(0, min(count, MAXHISTORY))
+        yield from group.history(proto, count, since)
+
+
+register['history'] = History()
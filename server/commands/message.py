@@ -14,22 +14,36 @@ class Message(Command):
     def registered(self, server, user, proto, line):
         target = line.target
         if target == '*':
-            server.error(user, line.command, 'No valid target', False)
+            server.error(proto, line.command, 'No valid target', False)
             return
 
         # Lookup the target...
         if target.startswith(('=', '&')):
-            server.error(user, line.command, 'Cannot message servers yet, '
+            server.error(proto, line.command, 'Cannot message servers yet, '
                          'sorry', False, {'target': [target]})
             return
 
-        target = server.get_online_target(target)
-
         # Get our message
         message = line.kval.get('body', [''])
 
+        target = server.get_online_target(line.target)
+        if target is None and not line.target.startswith('#'):
+            target = (yield from server.get_any_target(line.target))
+            if target is not None:
+                # Registered, but not here; keep it for them
+                server.offline.enqueue(target, user, message)
+                return
+
+        if target is None:
+            server.error(proto, line.command, 'No such target', False,
+                         {'target': [line.target]})
+            return
+
         # Bam
-        target.Message(user, message)
+        if line.target.startswith('#'):
+            target.message(user, message, proto)
+        else:
+            target.message(user, message)
 
 
 register['message'] = Message()
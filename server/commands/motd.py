@@ -12,7 +12,7 @@ import asyncio
 class MOTD(Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
-        server.user_MOTD(user)
+        server.user_motd(user, proto)
 
 
 register['motd'] = MOTD()
@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import cProfile
+import inspect
+import os
+import threading
+import logging
+
+from collections import Counter
+from time import strftime
+
+from server.command import Command, register
+from server.profiler import SamplingProfiler
+from server.storage.asyncstorage import AsyncStorage
+
+logger = logging.getLogger(__name__)
+
+MAXSECONDS = 300
+
+
+def _command_codes():
+    """ Map the code of every command handler to the command's name """
+    ret = {}
+    for name, instance in register.items():
+        for attr in ('registered', 'unregistered', 'sts', 'ipc'):
+            func = getattr(type(instance), attr, None)
+            if func is None or func is getattr(Command, attr):
+                continue
+
+            code = getattr(inspect.unwrap(func), '__code__', None)
+            if code is not None:
+                ret.setdefault(code, name)
+
+    return ret
+
+
+class Profile(Command):
+    def __init__(self):
+        self.running = False
+
+    @staticmethod
+    @asyncio.coroutine
+    def _pstats(seconds):
+        """ Deterministic profile of the loop thread only """
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield from asyncio.sleep(seconds)
+        finally:
+            prof.disable()
+
+        os.makedirs('data', exist_ok=True)
+        path = os.path.join('data', strftime('profile-%Y%m%d-%H%M%S.pstats'))
+        prof.dump_stats(path)
+        return (path, Counter())
+
+    @staticmethod
+    @asyncio.coroutine
+    def _sampled(server, seconds, interval):
+        loop_ident = threading.get_ident()
+
+        def threads():
+            ret = {ident: 'storage' for ident in server.proto_store.threads()}
+            ret[loop_ident] = 'loop'
+            return ret
+
+        profiler = SamplingProfiler(threads, interval,
+                                    type(server)._call_func.__code__,
+                                    AsyncStorage.run_callback.__code__,
+                                    _command_codes())
+        profiler.start()
+        try:
+            yield from asyncio.sleep(seconds)
+        finally:
+            profiler.stop()
+
+        path = profiler.write()
+        return (path, profiler.commands)
+
+    @asyncio.coroutine
+    def ipc(self, server, proto, line):
+        try:
+            seconds = float(line.kval.get('seconds', ['10'])[0])
+            interval = float(line.kval.get('interval', ['5'])[0]) / 1000
+        except ValueError:
+            server.error(proto, line.command, 'Invalid seconds/interval',
+                         False)
+            return
+
+        if not 0 < seconds <= MAXSECONDS:
+            server.error(proto, line.command, 'Seconds must be between 0 and '
+                         '{}'.format(MAXSECONDS), False)
+            return
+
+        if interval <= 0:
+            server.error(proto, line.command, 'Interval must be more than 0',
+                         False)
+            return
+
+        fmt = line.kval.get('format', ['collapsed'])[0]
+        if fmt not in ('collapsed', 'pstats'):
+            server.error(proto, line.command, 'Invalid format', False,
+                         {'format': [fmt]})
+            return
+
+        if self.running:
+            server.error(proto, line.command, 'A profile is already running',
+                         False)
+            return
+
+        logger.info('Profiling (%s) for %g seconds', fmt, seconds)
+
+        self.running = True
+        try:
+            if fmt == 'pstats':
+                path, commands = (yield from self._pstats(seconds))
+            else:
+                path, commands = (yield from self._sampled(server, seconds,
+                                                           interval))
+        finally:
+            self.running = False
+
+        logger.info('Profile written to %s', path)
+
+        kval = {
+            'path': [path],
+            'context': [],
+            'samples': [],
+        }
+        for context, count in commands.most_common():
+            kval['context'].append(context)
+            kval['samples'].append(str(count))
+
+        if not commands:
+            del kval['context'], kval['samples']
+            proto.send(server, None, line.command, kval)
+            return
+
+        proto.send_multipart(server, None, line.command,
+                             ('context', 'samples'), kval)
+
+
+register['profile'] = Profile()
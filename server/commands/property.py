@@ -7,37 +7,36 @@
 import asyncio
 
 from server.command import Command, register
-from server.property import UserPropertyValues, GroupPropertyValues
+from server.errors import PropertyError
 
 
 class PropertySet(Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         if 'property' not in line.kval:
-            server.error(user, line.command, 'No property specified', False,
+            server.error(proto, line.command, 'No property specified', False,
                          {'target': [line.target]})
             return
 
         property = line.kval['property']
-        value = line.kval.get('value')
+        value = line.kval.get('value', [])
 
         if len(property) != len(value):
-            server.error(user, line.command, 'property-value length mismatch',
+            server.error(proto, line.command, 'property-value length mismatch',
                          False,
                          {'target': [line.target], 'property': property})
             return
 
         target = (yield from server.get_any_target(line.target))
         if not target:
-            server.error(user, line.command, 'Invalid target', False,
+            server.error(proto, line.command, 'Invalid target', False,
                          {'target': [line.target], 'property': property})
             return
 
         if target.name[0] == '#':
             # Must have the correct ACL
-            acl_check = ('grant', 'grant:*', 'grant:property')
-            if not target.acl.has_acl_any(acl_check):
-                server.error(user, line.command, 'No permission', False,
+            if not server.permissions.check(user, target, 'group:property'):
+                server.error(proto, line.command, 'No permission', False,
                              {'target': [line.target], 'property': property})
                 return
 
@@ -45,86 +44,79 @@ class PropertySet(Command):
             target.property.set(property, value, user.name)
         except PropertyError as e:
             error = 'Error setting property: {}'.format(str(e))
-            server.error(user, line.command, error, False,
+            server.error(proto, line.command, error, False,
                          {'target': [line.target], 'property': property})
             return
 
-        if target.proto or target[0] == '#':
-            target.send(user, line.command, line.kval)
+        if target.name[0] == '#' or target.sessions:
+            target.send(user, target, line.command, line.kval)
 
-        user.send(user, line.command, line.kval)
+        user.send(user, target, line.command, line.kval)
 
 
 class PropertyDel(Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         if 'property' not in line.kval:
-            server.error(user, line.command, 'No property specified', False,
+            server.error(proto, line.command, 'No property specified', False,
                          {'target': [line.target]})
             return
 
         property = line.kval['property']
-        value = line.kval.get('value')
-
-        if len(property) != len(value):
-            server.error(user, line.command, 'Property-value length mismatch',
-                         False,
-                         {'target': [line.target], 'property': property})
-            return
 
         target = (yield from server.get_any_target(line.target))
         if not target:
-            server.error(user, line.command, 'Invalid target', False,
+            server.error(proto, line.command, 'Invalid target', False,
                          {'target': [line.target], 'property': property})
             return
 
         if target.name[0] == '#':
             # Must have the correct ACL
-            acl_check = ('grant', 'grant:*', 'grant:property')
-            if not target.acl.has_acl_any(acl_check):
-                server.error(user, line.command, 'No permission', False,
+            if not server.permissions.check(user, target, 'group:property'):
+                server.error(proto, line.command, 'No permission', False,
                              {'target': [line.target], 'property': property})
                 return
 
         try:
-            target.property.delete(property, value, user.name)
+            target.property.delete(property)
         except PropertyError as e:
             error = 'Error revoking property: {}'.format(str(e))
-            server.error(user, line.command, error, False,
+            server.error(proto, line.command, error, False,
                          {'target': [line.target], 'property': property})
             return
 
-        if target.proto or target[0] == '#':
-            target.send(user, line.command, line.kval)
+        if target.name[0] == '#' or target.sessions:
+            target.send(user, target, line.command, line.kval)
 
-        user.send(user, line.command, line.kval)
+        user.send(user, target, line.command, line.kval)
 
 class PropertyList(Command):
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         if 'property' not in line.kval:
-            server.error(user, line.command, 'No property specified', False,
+            server.error(proto, line.command, 'No property specified', False,
                          {'target': [line.target]})
             return
 
         target = (yield from server.get_any_target(line.target))
         if not target:
-            server.error(user, line.command, 'Invalid target', False,
+            server.error(proto, line.command, 'Invalid target', False,
                          {'target': [line.target], 'property': property})
             return
 
         if target.name[0] == '#':
             # Verify they're in the group
-            if not (user in group.members or 
-                    user.acl.has_acl('group:auspex')):
-                server.error(user, line.command, 'No permission', False,
+            if not (user in target.users or
+                    server.permissions.check(user, None, 'group:auspex')):
+                server.error(proto, line.command, 'No permission', False,
                              {'target': [line.target], 'property': property})
                 return
 
             # TODO more checks
         else:
-            if not (target == user or user.acl.has_acl('user:auspex')):
-                server.error(user, line.command, 'No permission', False,
+            if not (target == user or
+                    server.permissions.check(user, None, 'user:auspex')):
+                server.error(proto, line.command, 'No permission', False,
                              {'target': [line.target], 'property': property})
                 return
 
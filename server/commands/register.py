@@ -13,6 +13,8 @@ from settings import *
 
 
 class Register(Command):
+    expensive = True
+
     @asyncio.coroutine
     def unregistered(self, server, proto, line):
         if server.servpass:
@@ -60,10 +62,12 @@ class Register(Command):
         proto.send('*', '*', line.command, {'message': 'ok'})
 
 class FRegister(Command):
+    expensive = True
+
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         if acl.UserACLValues.user_register not in user.acl:
-            server.error(user, line.command, 'No permission', False)
+            server.error(proto, line.command, 'No permission', False)
             return
 
         name = line.kval.get('handle', [None])[0]
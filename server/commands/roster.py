@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+
+from server.command import Command, register
+
+
+class RosterSync(Command):
+    """ Send the roster entries that changed since the version the client
+    has; or all of them if it has none, or is too far behind """
+
+    @asyncio.coroutine
+    def registered(self, server, user, proto, line):
+        try:
+            since = int(line.kval.get('version', ['0'])[0])
+        except ValueError:
+            server.error(proto, line.command, 'Invalid version', False)
+            return
+
+        roster = (yield from user.roster.load())
+
+        kval = {'version': [str(roster.version)]}
+
+        changes = roster.changes(since) if since else None
+        if changes is None:
+            kval['full'] = ['*']
+            changed = sorted(roster.roster_map.values(),
+                             key=lambda e: e.target)
+            deleted = []
+        else:
+            changed, deleted = changes
+
+        if not changed and not deleted:
+            proto.send(server, user, line.command, kval)
+            return
+
+        keys = []
+        if changed:
+            target = []
+            alias = []
+            group_tag = []
+            pending = []
+            blocked = []
+            for entry in changed:
+                target.append(entry.target)
+                alias.append(entry.alias)
+                group_tag.append(entry.group_tag or '')
+                pending.append('1' if getattr(entry, 'pending', False)
+                               else '0')
+                blocked.append('1' if getattr(entry, 'blocked', False)
+                               else '0')
+
+            kval.update({
+                'target': target,
+                'alias': alias,
+                'group-tag': group_tag,
+                'pending': pending,
+                'blocked': blocked,
+            })
+            keys.extend(('target', 'alias', 'group-tag', 'pending',
+                         'blocked'))
+
+        if deleted:
+            kval['deleted'] = deleted
+            keys.append('deleted')
+
+        proto.send_multipart(server, user, line.command, keys, kval)
+
+register['roster-sync'] = RosterSync()
@@ -0,0 +1,65 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+
+import server.parser as parser
+
+from server.command import Command, register
+
+
+MAXRESULTS = 200
+
+
+class Search(Command):
+    expensive = True
+
+    @asyncio.coroutine
+    def registered(self, server, user, proto, line):
+        prefix = line.kval.get('prefix', [''])[0]
+        if len(prefix) > parser.MAXTARGET:
+            server.error(proto, line.command, 'Prefix too long', False,
+                         {'prefix': [prefix]})
+            return
+
+        kind = line.kval.get('type', ['user'])[0]
+        if kind not in ('user', 'group'):
+            server.error(proto, line.command, 'Invalid search type', False,
+                         {'type': [kind]})
+            return
+
+        try:
+            limit = int(line.kval.get('limit', ['50'])[0])
+        except ValueError:
+            server.error(proto, line.command, 'Invalid limit', False)
+            return
+
+        limit = max(1, min(limit, MAXRESULTS))
+
+        after = line.kval.get('after', [None])[0]
+        online = 'online' in line.kval
+
+        results, more = (yield from server.search.search(
+            prefix, kind == 'group', after, limit, online))
+
+        kval = {
+            'prefix': [prefix],
+            'type': [kind],
+        }
+
+        if more:
+            # Cursor for the next page
+            kval['next'] = [results[-1]]
+
+        if not results:
+            proto.send(server, user, line.command, kval)
+            return
+
+        kval['results'] = results
+        proto.send_multipart(server, user, line.command, ('results',), kval)
+
+
+register['search'] = Search()
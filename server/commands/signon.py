@@ -11,6 +11,7 @@ import hmac
 import server.parser as parser
 
 from server.command import Command, register
+from server.storage.scheduler import PRIORITY_SIGNON
 
 
 class Signon(Command):
@@ -33,16 +34,18 @@ class Signon(Command):
             return
 
         # Retrieve the user info
-        user = (yield from server.get_any_target(name.lower()))
+        user = (yield from server.get_any_target(name, PRIORITY_SIGNON))
         if not user:
             server.error(proto, line.command, 'You are not registered with '
                          'the server', False, {'handle': [name]})
             return
-        elif len(user.sessions):
-            # TODO - burst all state to the user
-            server.error(proto, line.command, 'No multiple users at the '
-                         'moment', True, {'handle': [name]})
-            return
+
+        token = line.kval.get('resume', [None])[0]
+        if token is not None:
+            old = server.sessions.take(token, user)
+            if old is not None:
+                yield from server.user_resume(proto, old)
+                return
 
         if 'password' not in line.kval:
             server.error(proto, line.command, 'No password given')
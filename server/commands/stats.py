@@ -0,0 +1,30 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import json
+
+from server.command import Command, register
+from server.metrics import metrics
+
+
+class Stats(Command):
+    @asyncio.coroutine
+    def ipc(self, server, proto, line):
+        snapshot = metrics.snapshot()
+
+        names = sorted(snapshot)
+        kval = {
+            'metric': names,
+            'value': [json.dumps(snapshot[n], separators=(',', ':')) for n in
+                      names],
+        }
+
+        proto.send_multipart(server, None, line.command, ('metric', 'value'),
+                             kval)
+
+
+register['stats'] = Stats()
@@ -0,0 +1,32 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import json
+
+from server.command import Command, register
+from server.trace import tracer
+
+
+class Trace(Command):
+    @asyncio.coroutine
+    def ipc(self, server, proto, line):
+        # One value per span, so big traces still fit in frames
+        spans = [json.dumps(row, separators=(',', ':')) for row in
+                 tracer.rows()]
+
+        if 'clear' in line.kval:
+            tracer.traces.clear()
+
+        if not spans:
+            proto.send(server, None, line.command, {})
+            return
+
+        proto.send_multipart(server, None, line.command, ('span',),
+                             {'span': spans})
+
+
+register['trace'] = Trace()
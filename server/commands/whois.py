@@ -12,11 +12,13 @@ import server.property as property
 
 
 class Whois(Command):
+    expensive = True
+
     @asyncio.coroutine
     def registered(self, server, user, proto, line):
         target = line.target
         if target == '*' or target.startswith(('=', '#')):
-            server.error(user, line.command, 'No valid target', False)
+            server.error(proto, line.command, 'No valid target', False)
             return
 
         t_user = (yield from server.get_any_target(target))
@@ -29,7 +31,8 @@ class Whois(Command):
         if len(t_user.sessions):
             kval['online'] = ['*']
 
-        if user.acl.has_acl('user:auspex'):
+        auspex = server.permissions.check(user, None, 'user:auspex')
+        if auspex:
             ip = []
             host = []
             for p in user.sessions:
@@ -43,11 +46,8 @@ class Whois(Command):
             })
 
         if t_user.groups:
-            group_prop = 'private'
-            user_acl = 'user:auspex'
             kval['groups'] = [group for group in user.groups if not
-                              (group_prop in group.property and not user_acl in
-                               user.acl)]
+                              ('private' in group.property and not auspex)]
 
         # FIXME - if WHOIS info is too big, split it up
 
@@ -87,6 +87,11 @@ class GroupRemovalError(UserError, GroupError):
     pass
 
 
+class GroupFilterError(GroupError):
+    "Bad group message filter"
+    pass
+
+
 class CommandError(DCPError):
     "Base error for command-related doodads"
     pass
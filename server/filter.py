@@ -0,0 +1,226 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import logging
+import re
+import sre_constants
+import sre_parse
+
+from collections import deque
+from functools import lru_cache
+
+from server.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LITERAL = 'literal'
+REGEX = 'regex'
+
+KINDS = (LITERAL, REGEX)
+
+# Limits per group
+MAXFILTERS = 100
+MAXPATTERN = 200
+
+# Regexes run on the event loop against every message, so they're kept
+# small and simple enough not to backtrack badly
+MAXREGEX = 100
+MAXREPEATS = 3
+
+# Things that would break when patterns are glued together into one regex
+bad_regex = re.compile(r'\(\?P|\(\?[aiLmsux]+\)|\\[1-9]')
+
+filter_compiles = metrics.counter('filter.compiles')
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+
+class AhoCorasick:
+    """ Finds any of a set of strings in a text, in one pass over the text
+    however many strings there are """
+
+    __slots__ = ['goto', 'fail', 'out']
+
+    def __init__(self, words):
+        # Node 0 is the root; goto[n] maps a character to the next node, and
+        # out[n] is the index of the word ending at n (or one of its
+        # suffixes), or None
+        self.goto = [dict()]
+        self.fail = [0]
+        self.out = [None]
+
+        for i, word in enumerate(words):
+            node = 0
+            for c in word:
+                nxt = self.goto[node].get(c)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][c] = nxt
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.out.append(None)
+
+                node = nxt
+
+            if self.out[node] is None:
+                self.out[node] = i
+
+        # Breadth first, so a node's fail link is always ready before its
+        # children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self.goto[node].items():
+                queue.append(child)
+
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+
+                f = self.goto[f].get(c, 0)
+                self.fail[child] = f
+                if self.out[child] is None:
+                    self.out[child] = self.out[f]
+
+    def search(self, text):
+        """ Get the index of the first word found in text, or None """
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        node = 0
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+
+            node = goto[node].get(c, 0)
+            if out[node] is not None:
+                return out[node]
+
+        return None
+
+
+def check_pattern(kind, pattern):
+    """ Check a rule is usable, returning an error string or None """
+    if kind not in KINDS:
+        return 'Invalid filter type'
+
+    if not pattern or len(pattern) > MAXPATTERN:
+        return 'Invalid filter pattern length'
+
+    if kind == REGEX:
+        if bad_regex.search(pattern):
+            return 'Named groups, inline flags and backreferences are not ' \
+                'allowed in filters'
+
+        if len(pattern) > MAXREGEX:
+            return 'Invalid filter pattern length'
+
+        try:
+            parsed = sre_parse.parse(pattern)
+        except re.error as e:
+            return 'Invalid regular expression: {}'.format(e)
+
+        try:
+            repeats = _count_repeats(parsed, False)
+        except ValueError as e:
+            return str(e)
+
+        if repeats > MAXREPEATS:
+            return 'Too many repeats in regular expression'
+
+    return None
+
+
+def _subpatterns(av):
+    """ Get the parsed subpatterns within an opcode's arguments """
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (tuple, list)):
+        for item in av:
+            yield from _subpatterns(item)
+
+
+def _count_repeats(parsed, repeated):
+    """ Count the repeats in a parsed regex, raising ValueError for the
+    shapes that backtrack exponentially: a repeat or alternation inside a
+    repeat """
+    count = 0
+    for op, av in parsed:
+        if op in REPEATS:
+            if repeated:
+                raise ValueError('Nested repeats are not allowed in filters')
+
+            count += 1 + _count_repeats(av[2], True)
+        elif op == sre_constants.BRANCH and repeated:
+            raise ValueError('Alternation inside a repeat is not allowed in '
+                             'filters')
+        else:
+            for sub in _subpatterns(av):
+                count += _count_repeats(sub, repeated)
+
+    return count
+
+
+class Matcher:
+    """ A set of filter rules compiled together.
+
+    All matching ignores case, for regexes as well as literals. Literals go
+    into one Aho-Corasick automaton, and regexes are joined into one
+    alternation with a named group per rule, so checking a message is one
+    pass of each whatever the number of rules.
+    """
+
+    __slots__ = ['rules', 'literals', 'literal_rules', 'regex']
+
+    def __init__(self, rules):
+        self.rules = rules
+
+        words = []
+        self.literal_rules = []
+        patterns = []
+        for i, (kind, pattern) in enumerate(rules):
+            error = check_pattern(kind, pattern)
+            if error is not None:
+                # Stored before the current limits
+                logger.warning('Skipping filter %r: %s', pattern, error)
+                continue
+
+            if kind == LITERAL:
+                words.append(pattern.casefold())
+                self.literal_rules.append(i)
+            else:
+                patterns.append('(?P<r{}>{})'.format(i, pattern))
+
+        self.literals = AhoCorasick(words) if words else None
+
+        if patterns:
+            # Matching ignores case for every kind of rule
+            self.regex = re.compile('|'.join(patterns), re.IGNORECASE)
+        else:
+            self.regex = None
+
+    def match(self, text):
+        """ Get the first rule text matches, or None """
+        if self.literals is not None:
+            i = self.literals.search(text.casefold())
+            if i is not None:
+                return self.rules[self.literal_rules[i]]
+
+        if self.regex is not None:
+            m = self.regex.search(text)
+            if m is not None:
+                return self.rules[int(m.lastgroup[1:])]
+
+        return None
+
+
+@lru_cache(maxsize=256)
+def compile_rules(rules):
+    """ Get a Matcher for a tuple of (kind, pattern) rules. Groups with the
+    same rules share one. """
+    filter_compiles.inc()
+    return Matcher(rules)
@@ -4,24 +4,52 @@
 # under the terms of the Do What The Fuck You Want To Public License, Version
 # 2, as published by Sam Hocevar. See the LICENSE file for more details.
 
+import asyncio
+import functools
+import logging
 import time
-from collections import defaultdict
+
+from sys import intern
+from collections import Counter, OrderedDict
 
 from server.user import User
+from server.names import NameRegistry, canonical, key_of
+from server.scrollback import Scrollback
+from server.filter import compile_rules, check_pattern, MAXFILTERS
+from server.metrics import metrics
 from server.parser import MAXFRAME
 from server.acl import GroupACLSet
 from server.property import GroupPropertySet
 from server.errors import *
 
+logger = logging.getLogger(__name__)
+
+group_messages = metrics.counter('group.messages')
+group_loads = metrics.counter('group.loads')
+group_evictions = metrics.counter('group.evictions')
+group_deltas = metrics.counter('group.deltas')
+group_filtered = metrics.counter('group.filtered')
+
+# Sessions that negotiate this get batched membership changes
+DELTA_OPTION = 'group-delta'
+
 
 class Group:
 
     """ Like an IRC channel """
 
+    __slots__ = ['server', 'name', 'key', '_topic', 'acl', 'property',
+                 'users', 'scrollback', 'filters', 'filter_hits', '_matcher',
+                 'pending', 'pending_handle', 'ts', '__weakref__']
+
     def __init__(self, server, name, topic=None, acl=None, property=None,
-                 ts=None):
+                 ts=None, filters=None):
+        if not name[0] == '#':
+            name = '#' + name
+
         self.server = server
-        self.name = name
+        self.name = intern(name)
+        self.key = canonical(name)
         self._topic = topic
 
         if acl is None:
@@ -36,13 +64,22 @@ class Group:
 
         self.users = set()
 
-        self.ts = None
+        self.scrollback = server.group_manager.scrollback(self.key)
+
+        # Message filters as (kind, pattern); compiled on first use
+        self.filters = [(f['kind'], f['pattern']) for f in filters or ()]
+        self.filter_hits = Counter()
+        self._matcher = None
+
+        # Membership changes waiting to go out as a group-delta, as (user,
+        # command, kval)
+        self.pending = []
+        self.pending_handle = None
 
-        if self.ts is None:
-            self.ts = round(time.time())
+        if ts is None:
+            ts = round(time.time())
 
-        if not self.name[0] == '#':
-            self.name = '#' + self.name
+        self.ts = ts
 
     @property
     def topic(self):
@@ -52,8 +89,8 @@ class Group:
     def topic(self, value):
         self._topic = value
 
-        asyncio.async(self.server.proto_store.set_group(self.name.lower(),
-                      topic=value))
+        self.server.proto_store.write('set_group', self.key, topic=value,
+                                      coalesce=self.key)
 
     def member_add(self, user, reason=None):
         if user in self.users:
@@ -62,28 +99,34 @@ class Group:
 
         user.groups.add(self)
         self.users.add(user)
+        self.server.group_manager.active(self)
 
         kval = dict()
         if reason:
             kval['reason'] = [reason]
 
-        self.send(user, self, 'group-enter', kval)
+        self.notify(user, 'group-enter', kval)
+
+        self.burst(user)
+
+    def burst(self, user, proto=None):
+        """ Send the group info and names to user's sessions, or just to
+        proto if given """
+        dest = user if proto is None else proto
 
-        # Burst the channel info
         kval = {
             'time': [str(self.ts)],
             'topic': [self.topic if self.topic else ''],
         }
-        user.send(self, user, 'group-info', kval)
+        dest.send(self, user, 'group-info', kval)
 
         kval = {
-            'users': list(self.users),
+            'users': [u.name for u in self.users],
         }
 
-        # TODO use multipart
-        user.send_multipart(self, user, 'group-names', ('users',), kval)
+        dest.send_multipart(self, user, 'group-names', ('users',), kval)
 
-    def member_del(self, user, reason=None, permanent=False):
+    def member_del(self, user, kval=None, permanent=False):
         if user not in self.users:
             raise GroupRemovalError('Nonexistent user {} removed'.format(
                 user.name))
@@ -91,17 +134,192 @@ class Group:
         self.users.remove(user)
         user.groups.remove(self)
 
-    def message(self, source, message):
+        if not self.users:
+            self.server.group_manager.idle(self)
+
+        self.notify(user, 'group-exit', kval)
+
+    def notify(self, user, command, kval=None):
+        """ Tell the members someone entered or exited.
+
+        Sessions that negotiated group-delta get the change with the next
+        flush; everyone else gets the frame right away.
+        """
+        if kval is None:
+            kval = dict()
+
+        batched = False
+
+        # Encoded once per wire format
+        encoded = dict()
+        for member in self.users:
+            for proto in member.sessions:
+                if DELTA_OPTION in proto.options:
+                    batched = True
+                    continue
+
+                data = encoded.get(proto.frame)
+                if data is None:
+                    data = encoded[proto.frame] = proto.pack(user, self,
+                                                             command, kval)
+
+                proto.write(data)
+
+        if not batched:
+            return
+
+        self.pending.append((user, command, kval))
+
+        if self.pending_handle is None:
+            loop = asyncio.get_event_loop()
+            self.pending_handle = loop.call_later(
+                self.server.group_manager.delta_window, self.flush_delta)
+
+    def flush_delta(self):
+        """ Send the queued membership changes to group-delta sessions as
+        one group-delta stream """
+        self.pending_handle = None
+        if not self.pending:
+            return
+
+        events, self.pending = self.pending, []
+
+        # Net change per user; entering and exiting within the window
+        # cancels out
+        net = OrderedDict()
+        for user, command, kval in events:
+            change = 'enter' if command == 'group-enter' else 'exit'
+            prev = net.pop(user.name, None)
+            if prev is None or prev[0] == change:
+                net[user.name] = (change, kval)
+
+        if not net:
+            return
+
+        delta = {'enter': [], 'enter-reason': [], 'exit': [],
+                 'exit-reason': [], 'exit-quit': []}
+        for name, (change, kval) in net.items():
+            delta[change].append(name)
+            delta[change + '-reason'].append(kval.get('reason', [''])[0])
+            if change == 'exit':
+                delta['exit-quit'].append('*' if 'quit' in kval else '')
+
+        keys = [k for k, v in delta.items() if v]
+        delta = {k: delta[k] for k in keys}
+
+        group_deltas.inc()
+
+        encoded = dict()
+        for member in self.users:
+            for proto in member.sessions:
+                if DELTA_OPTION not in proto.options:
+                    continue
+
+                ret = encoded.get(proto.frame)
+                if ret is None:
+                    frames = proto.pack_multipart(self.server, self,
+                                                  'group-delta', keys, delta)
+                    ret = encoded[proto.frame] = (b''.join(frames),
+                                                  len(frames))
+
+                proto.write(*ret)
+
+    def message(self, source, message, proto=None):
+        """ Send a message to the group. Errors go to proto, the session it
+        came from, if given, or else to source. """
+        error_dest = source if proto is None else proto
+
         # TODO various ACL checks
         if isinstance(source, User) and source not in self.users:
-            self.server.error(source, 'message', 'You aren\'t in that group',
-                              False)
+            self.server.error(error_dest, 'message', 'You aren\'t in that '
+                              'group', False)
             return
 
-        kval = defaultdict(list)
-        kval['body'] = message
+        rule = self.filter_match('\n'.join(message))
+        if rule is not None:
+            group_filtered.inc()
+            self.server.error(error_dest, 'message', 'Message blocked by a '
+                              'filter', False, {'target': [self.name]})
+            return
+
+        group_messages.inc()
+
+        if isinstance(source, User):
+            sname = source.name
+        else:
+            sname = '=' + source.name
+
+        # Encoded once here, and shared by every member and the scrollback
+        entry = self.scrollback.append(sname, self.name, {'body': message})
+
+        for user in self.users:
+            if user is source:
+                continue
+
+            for proto in user.sessions:
+                proto.write(entry.encode(proto.frame))
+
+    def filter_match(self, text):
+        """ Get the filter rule text matches, or None """
+        if not self.filters:
+            return None
+
+        if self._matcher is None:
+            self._matcher = compile_rules(tuple(self.filters))
+
+        rule = self._matcher.match(text)
+        if rule is not None:
+            self.filter_hits[rule] += 1
+
+        return rule
+
+    def filter_add(self, kind, pattern, setter=None):
+        rule = (kind, pattern)
+        if rule in self.filters:
+            raise GroupFilterError('Filter already exists')
+
+        if len(self.filters) >= MAXFILTERS:
+            raise GroupFilterError('Too many filters')
+
+        error = check_pattern(kind, pattern)
+        if error is not None:
+            raise GroupFilterError(error)
+
+        self.filters.append(rule)
+        self._matcher = None
+
+        self.server.proto_store.write('create_group_filter', self.key, kind,
+                                      pattern, key_of(setter))
+
+    def filter_del(self, kind, pattern):
+        rule = (kind, pattern)
+        if rule not in self.filters:
+            raise GroupFilterError('No such filter')
+
+        self.filters.remove(rule)
+        self.filter_hits.pop(rule, None)
+        self._matcher = None
+
+        self.server.proto_store.write('del_group_filter', self.key, kind,
+                                      pattern)
+
+    @asyncio.coroutine
+    def history(self, proto, count=None, since=None):
+        """ Replay scrollback to one session as a multipart stream: a
+        history frame, the message frames, and a closing history frame """
+        entries = (yield from self.scrollback.entries(count, since))
+
+        kval = {
+            'multipart': ['message'],
+            'count': [str(len(entries))],
+        }
+
+        data = [proto.pack(self, proto.user, 'history', kval)]
+        data.extend(e.encode(proto.frame) for e in entries)
+        data.append(proto.pack(self, proto.user, 'history',
+                               {'multipart': ['*']}))
 
-        self.send(source, self, 'message', kval, [source])
+        proto.write(b''.join(data), len(data))
 
     def send(self, source, target, command, kval=None, filter=[]):
         for user in self.users:
@@ -117,3 +335,151 @@ class Group:
                 continue
 
             user.send_multipart(source, target, command, keys, kval)
+
+
+class GroupManager:
+    """ Owns the live Group objects.
+
+    Groups are loaded from storage (with their ACL's and properties) the
+    first time they're asked for, and new groups are persisted as they're
+    created. Groups that have been empty for idle_timeout seconds are dropped
+    from memory; they'll just be loaded again when needed.
+    """
+
+    def __init__(self, server, idle_timeout=300, scrollback_size=100,
+                 scrollback_dir=None, scrollback_spill=1048576,
+                 delta_window=0.25):
+        self.server = server
+        self.groups = NameRegistry()
+        self.idle_timeout = idle_timeout
+        self.delta_window = delta_window
+
+        self.scrollback_size = scrollback_size
+        self.scrollback_dir = scrollback_dir
+        self.scrollback_spill = scrollback_spill
+
+        # Canonical name -> future for loads in flight, so concurrent
+        # lookups share one load
+        self.loading = dict()
+
+        # Canonical name -> loop time the group went empty
+        self.idle_since = dict()
+
+        self.handle = None
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        interval = max(1, min(60, self.idle_timeout))
+        self.handle = loop.call_later(interval, self._sweep)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def scrollback(self, key):
+        return Scrollback(key, self.scrollback_size, self.scrollback_dir,
+                          self.scrollback_spill)
+
+    def _add(self, group):
+        self.groups[group.name] = group
+        if not group.users:
+            self.idle(group)
+
+    def active(self, group):
+        self.idle_since.pop(group.key, None)
+
+    def idle(self, group):
+        loop = asyncio.get_event_loop()
+        self.idle_since[group.key] = loop.time()
+
+    def _sweep(self):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() - self.idle_timeout
+
+        expired = [k for k, t in self.idle_since.items() if t <= deadline]
+        for key in expired:
+            del self.idle_since[key]
+
+            group = self.groups.get(key)
+            if group is None or group.users:
+                continue
+
+            logger.debug('Evicting idle group %s', group.name)
+            group_evictions.inc()
+            group.scrollback.close()
+            del self.groups[key]
+
+        self.start()
+
+    @asyncio.coroutine
+    def _load(self, key):
+        data = (yield from self.server.proto_store.load_group(key))
+        if data is None:
+            return None
+
+        # It may have been created whilst we were waiting
+        group = self.groups.get(key)
+        if group is not None:
+            return group
+
+        g_data, acl_data, prop_data, filter_data = data
+
+        acl_set = GroupACLSet(self.server, key, acl_data)
+        prop_set = GroupPropertySet(self.server, key, prop_data)
+        group = Group(self.server, g_data['display'] or key, g_data['topic'],
+                      acl_set, prop_set, g_data['timestamp'], filter_data)
+
+        group_loads.inc()
+        self._add(group)
+        return group
+
+    def _load_done(self, key, future):
+        self.loading.pop(key, None)
+
+    @asyncio.coroutine
+    def get(self, name):
+        """ Get a group, loading it from storage if needs be. Returns None if
+        there is no such group. """
+        group = self.groups.get(name)
+        if group is not None:
+            return group
+
+        key = canonical(name)
+        future = self.loading.get(key)
+        if future is None:
+            future = asyncio.async(self._load(key))
+            future.add_done_callback(functools.partial(self._load_done, key))
+            self.loading[key] = future
+
+        return (yield from asyncio.shield(future))
+
+    @asyncio.coroutine
+    def get_or_create(self, name):
+        """ Get a group, creating and persisting it if it doesn't exist """
+        group = (yield from self.get(name))
+        if group is not None:
+            return group
+
+        # Someone else may have beaten us to it
+        group = self.groups.get(name)
+        if group is not None:
+            return group
+
+        logger.info('Creating group %s', name)
+
+        # Added before it's stored, so nobody else tries to create it
+        group = Group(self.server, name)
+        self._add(group)
+
+        try:
+            yield from self.server.proto_store.create_group(group.key, None,
+                                                            group.name)
+        except Exception:
+            del self.groups[group.key]
+            self.idle_since.pop(group.key, None)
+            group.scrollback.close()
+            raise
+
+        self.server.search.add(group.name)
+        return group
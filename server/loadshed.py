@@ -0,0 +1,139 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import logging
+
+from server.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Shedding levels; each includes the ones below it
+NORMAL = 0
+DEFER_ACCEPT = 1
+REJECT_EXPENSIVE = 2
+STRETCH_PING = 3
+
+LEVEL_NAMES = ('normal', 'defer-accept', 'reject-expensive', 'stretch-ping')
+
+# Times a ping deadline is put off for one client before it's dropped anyway,
+# so dead clients still go during a long overload
+MAX_PING_STRETCHES = 2
+
+
+class LagMonitor:
+    """ Measures how far behind the event loop is running, and degrades
+    service in stages when it falls too far behind.
+
+    Every interval seconds a callback is scheduled, and the difference
+    between when it was due and when it actually ran is the lag. The lag is
+    smoothed (quickly upwards, slowly downwards), and the shedding level is
+    the number of thresholds it exceeds. Levels only drop once the lag is
+    below recover times the threshold, so we don't flap.
+    """
+
+    def __init__(self, thresholds=(0.1, 0.25, 0.5), interval=0.25,
+                 recover=0.5, retry_after=30):
+        # One threshold per level above normal
+        self.thresholds = tuple(sorted(thresholds))[:len(LEVEL_NAMES) - 1]
+        self.interval = interval
+        self.recover = recover
+        self.retry_after = retry_after
+
+        self.lag = 0.0
+        self.level = NORMAL
+        self.expected = None
+        self.handle = None
+
+        # Connections waiting for the loop to catch up
+        self.deferred = []
+
+        self.lag_gauge = metrics.gauge('loop.lag')
+        self.lag_hist = metrics.histogram('loop.lag_samples')
+        self.level_gauge = metrics.gauge('loop.shed_level')
+        self.deferred_count = metrics.counter('loop.deferred_accepts')
+        self.rejected_count = metrics.counter('loop.rejected_commands')
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.expected = loop.time() + self.interval
+        self.handle = loop.call_at(self.expected, self._tick)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _tick(self):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+
+        lag = max(0.0, now - self.expected)
+        self.lag_hist.observe(lag)
+
+        alpha = 0.5 if lag > self.lag else 0.1
+        self.lag += alpha * (lag - self.lag)
+        self.lag_gauge.set(self.lag)
+
+        self._set_level()
+
+        self.expected = now + self.interval
+        self.handle = loop.call_at(self.expected, self._tick)
+
+    def _set_level(self):
+        level = sum(1 for t in self.thresholds if self.lag >= t)
+        if level < self.level:
+            # Only come down once we're well clear of each threshold
+            level = self.level
+            while (level > NORMAL and
+                   self.lag < self.thresholds[level - 1] * self.recover):
+                level -= 1
+
+        if level == self.level:
+            return
+
+        logger.warning('Event loop lag %.3fs, shedding level %s -> %s',
+                       self.lag, LEVEL_NAMES[self.level], LEVEL_NAMES[level])
+
+        self.level = level
+        self.level_gauge.set(level)
+
+        if level < DEFER_ACCEPT:
+            self._resume_deferred()
+
+    def _resume_deferred(self):
+        deferred, self.deferred = self.deferred, []
+        for proto in deferred:
+            if proto.transport is None:
+                # Went away whilst waiting
+                continue
+
+            proto.transport.resume_reading()
+            proto.accept()
+
+    def defer_accept(self, proto):
+        """ Park a new connection if we're overloaded. Returns True if it was
+        deferred, in which case proto.accept() is called on recovery. """
+        if self.level < DEFER_ACCEPT:
+            return False
+
+        self.deferred_count.inc()
+        proto.transport.pause_reading()
+        self.deferred.append(proto)
+        return True
+
+    def reject(self, instance):
+        """ Check if a command should be refused right now """
+        if self.level < REJECT_EXPENSIVE or not instance.expensive:
+            return False
+
+        self.rejected_count.inc()
+        return True
+
+    @property
+    def ping_stretch(self):
+        """ Multiplier for ping deadlines """
+        return 2 if self.level >= STRETCH_PING else 1
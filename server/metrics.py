@@ -0,0 +1,132 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+""" Runtime metrics.
+
+Instruments are meant to be looked up once (at import or construction time)
+and then updated directly, so the hot paths only pay for an attribute add.
+Everything is updated from the event loop thread, so there's no locking.
+"""
+
+from bisect import bisect_left
+from time import time
+
+
+class Counter:
+    """ A monotonically increasing count """
+
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """ A value that goes up and down. If fn is given, the value is computed
+    by calling it when a snapshot is taken. """
+
+    __slots__ = ['value', 'fn']
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def snapshot(self):
+        if self.fn is not None:
+            return self.fn()
+
+        return self.value
+
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """ Bucketed distribution of observed values """
+
+    __slots__ = ['buckets', 'counts', 'count', 'sum', 'max']
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Last slot is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        buckets = {str(b): c for b, c in zip(self.buckets, self.counts)}
+        buckets['+inf'] = self.counts[-1]
+
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': buckets,
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.instruments = dict()
+        self.started = time()
+
+    def _get(self, name, cls, *args):
+        inst = self.instruments.get(name)
+        if inst is None:
+            inst = self.instruments[name] = cls(*args)
+        elif not isinstance(inst, cls):
+            raise TypeError('Metric {} is a {}'.format(
+                name, type(inst).__name__))
+
+        return inst
+
+    def counter(self, name):
+        return self._get(name, Counter)
+
+    def gauge(self, name, fn=None):
+        gauge = self._get(name, Gauge)
+        if fn is not None:
+            gauge.fn = fn
+
+        return gauge
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS):
+        return self._get(name, Histogram, buckets)
+
+    def snapshot(self):
+        """ Get the current value of every instrument, by name """
+        ret = {name: inst.snapshot() for name, inst in
+               self.instruments.items()}
+        ret['uptime'] = round(time() - self.started)
+        return ret
+
+
+metrics = MetricsRegistry()
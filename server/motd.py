@@ -0,0 +1,89 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import os
+import logging
+
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Lines longer than this get truncated (see the README)
+MAXLINE = 200
+
+
+class MOTDCache:
+    """ The MOTD, packed into multipart frames once per wire format.
+
+    The file is stat'd at most once every check_interval seconds, and the
+    cached frames are thrown away whenever its mtime or size changes, so
+    edits show up without a restart.
+    """
+
+    def __init__(self, server, path='motd.txt', check_interval=1.0):
+        self.server = server
+        self.path = path
+        self.check_interval = check_interval
+
+        self.lines = None
+        self.stamp = None
+        self.next_check = 0
+
+        # Frame class -> (encoded bytes, number of frames)
+        self.frames = dict()
+
+        self.check(force=True)
+
+    def load(self):
+        self.frames.clear()
+
+        try:
+            with open(self.path, 'r') as f:
+                self.lines = [l[:MAXLINE] for l in f.read().splitlines()]
+        except Exception as e:
+            logger.exception('Could not read MOTD')
+            self.lines = None
+
+    def check(self, force=False):
+        """ Reload the MOTD if the file has changed """
+        now = monotonic()
+        if not force and now < self.next_check:
+            return
+
+        self.next_check = now + self.check_interval
+
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+
+        if stamp == self.stamp and not force:
+            return
+
+        self.stamp = stamp
+        self.load()
+
+    def get(self, proto):
+        """ Get the encoded MOTD for proto's wire format, as (data, number
+        of frames) """
+        self.check()
+
+        ret = self.frames.get(proto.frame)
+        if ret is not None:
+            return ret
+
+        # The frames are addressed to * so they can be shared by everyone
+        if not self.lines:
+            ret = (proto.pack(self.server, None, 'motd', {}), 1)
+        else:
+            kval = {'text': list(self.lines)}
+            frames = proto.pack_multipart(self.server, None, 'motd', ['text'],
+                                          kval)
+            ret = (b''.join(frames), len(frames))
+
+        self.frames[proto.frame] = ret
+        return ret
@@ -0,0 +1,129 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+from collections import OrderedDict
+from sys import intern
+
+
+# Spelling -> canonical name. Bounded so hostile clients can't grow it
+# forever; it just gets dropped and refilled when full.
+_canonical_cache = dict()
+_CANONICAL_CACHE_MAX = 65536
+
+
+def canonical(name):
+    """ Get the canonical form of a name (lowercased and interned).
+
+    This must stay lower() and not casefold(): stored names were keyed with
+    lower(), and the two differ for names like ß. Each distinct spelling is
+    only lowercased once; after that it's a dict hit. Canonical names are
+    interned so comparisons are mostly pointer comparisons and every index
+    shares the same string object. """
+    try:
+        return _canonical_cache[name]
+    except KeyError:
+        pass
+
+    key = intern(name.lower())
+
+    if len(_canonical_cache) >= _CANONICAL_CACHE_MAX:
+        _canonical_cache.clear()
+
+    _canonical_cache[name] = key
+    _canonical_cache[key] = key
+    return key
+
+
+def key_of(target):
+    """ Get the canonical name of a User/Group or a plain name """
+    if target is None:
+        return None
+
+    key = getattr(target, 'key', None)
+    if key is None:
+        key = canonical(target)
+
+    return key
+
+
+class NameRegistry:
+    """ An index of live objects by canonical name.
+
+    Behaves like a dict, but every key passed in is canonicalised, and the
+    display name used when the object was added is kept alongside it.
+
+    If maxsize is given, the registry is an LRU cache: lookups refresh an
+    entry and adding past maxsize evicts the least recently used one.
+    """
+
+    __slots__ = ['objects', 'display_names', 'maxsize']
+
+    def __init__(self, maxsize=None):
+        self.objects = OrderedDict() if maxsize else dict()
+        self.display_names = dict()
+        self.maxsize = maxsize
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __contains__(self, name):
+        return canonical(name) in self.objects
+
+    def __getitem__(self, name):
+        key = canonical(name)
+        obj = self.objects[key]
+        if self.maxsize:
+            self.objects.move_to_end(key)
+
+        return obj
+
+    def __setitem__(self, name, obj):
+        key = canonical(name)
+        self.objects[key] = obj
+        self.display_names[key] = name
+
+        if self.maxsize:
+            self.objects.move_to_end(key)
+            while len(self.objects) > self.maxsize:
+                old, _ = self.objects.popitem(last=False)
+                del self.display_names[old]
+
+    def __delitem__(self, name):
+        key = canonical(name)
+        del self.objects[key]
+        del self.display_names[key]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def pop(self, name, *default):
+        key = canonical(name)
+        self.display_names.pop(key, None)
+        return self.objects.pop(key, *default)
+
+    def display(self, name):
+        """ Get the display name an object was registered under """
+        return self.display_names.get(canonical(name))
+
+    def keys(self):
+        return self.objects.keys()
+
+    def values(self):
+        return self.objects.values()
+
+    def items(self):
+        return self.objects.items()
+
+    def clear(self):
+        self.objects.clear()
+        self.display_names.clear()
+
@@ -0,0 +1,128 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import json
+import logging
+
+from time import time
+
+from server.metrics import metrics
+from server.storage.scheduler import PRIORITY_SIGNON, PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+offline_queued = metrics.counter('offline.queued')
+offline_delivered = metrics.counter('offline.delivered')
+
+# Messages encoded between trips back to the event loop when draining
+DRAIN_BATCH = 64
+
+
+class OfflineQueue:
+    """ Store-and-forward for messages to registered users who are offline.
+
+    Messages are held for up to flush_interval seconds and then written in
+    one batch. Each user keeps at most cap messages, and messages older
+    than expiry seconds are dropped. When the user signs on the queue is
+    read in a storage thread and sent as one multipart stream.
+    """
+
+    def __init__(self, server, cap=100, expiry=604800, flush_interval=0.5):
+        self.server = server
+        self.cap = cap
+        self.expiry = expiry
+        self.flush_interval = flush_interval
+
+        # (name, source, body, timestamp) waiting to be written
+        self.pending = []
+        self.handle = None
+
+        # The write in progress, if any
+        self.flushing = None
+
+    def enqueue(self, user, source, message):
+        """ Queue message (a list of body lines) for user """
+        offline_queued.inc()
+
+        self.pending.append((user.key, source.name, json.dumps(message),
+                             round(time())))
+
+        if self.handle is None:
+            loop = asyncio.get_event_loop()
+            self.handle = loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """ Start writing out pending messages; returns the write's future
+        (or None if there was nothing to do) """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if not self.pending:
+            return self.flushing
+
+        pending, self.pending = self.pending, []
+        expire = round(time()) - self.expiry
+
+        store = self.server.proto_store.at(PRIORITY_BULK)
+        self.flushing = asyncio.async(store.create_offline(pending, self.cap,
+                                                           expire))
+        return self.flushing
+
+    @asyncio.coroutine
+    def drain(self, user, proto):
+        """ Send user's queued messages to proto, then delete them """
+        if any(p[0] == user.key for p in self.pending):
+            self.flush()
+
+        if self.flushing is not None:
+            try:
+                yield from asyncio.shield(self.flushing)
+            except Exception:
+                # Logged by the storage layer
+                pass
+
+        since = round(time()) - self.expiry
+        # Part of signing on, so it goes ahead of other reads
+        store = self.server.proto_store.at(PRIORITY_SIGNON)
+        rows = (yield from store.get_offline(user.key, since, self.cap))
+        if not rows:
+            return
+
+        data = [proto.pack(self.server, user, 'offline', {
+            'multipart': ['message'],
+            'count': [str(len(rows))],
+        })]
+
+        for i, row in enumerate(rows):
+            kval = {
+                'body': json.loads(row['body']),
+                'time': [str(row['timestamp'])],
+                'offline': ['*'],
+            }
+            data.append(bytes(proto.frame(row['source'], user.name,
+                                          'message', kval)))
+
+            if i % DRAIN_BATCH == DRAIN_BATCH - 1:
+                # Don't hog the loop with a big backlog
+                yield from asyncio.sleep(0)
+
+        data.append(proto.pack(self.server, user, 'offline',
+                               {'multipart': ['*']}))
+
+        if proto.user is not user or (not proto.transport and
+                                      proto.backlog is None):
+            # The session went away whilst we waited; the write would be
+            # dropped, so keep the messages for next time
+            return
+
+        proto.write(b''.join(data), len(data))
+
+        offline_delivered.inc(len(rows))
+
+        yield from self.server.proto_store.del_offline(user.key,
+                                                       rows[-1]['id'])
@@ -0,0 +1,141 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+from collections import defaultdict
+
+from server.acl import USER_ACL_BITS, GROUP_ACL_BITS, user_mask, group_mask
+from server.names import key_of
+from server.metrics import metrics
+
+permission_hits = metrics.counter('permissions.hits')
+permission_misses = metrics.counter('permissions.misses')
+
+# Bound on cached answers; the cache starts over when it's reached
+MAXENTRIES = 65536
+
+
+class Rule:
+    """ What allows an action: any of the user ACL's in user_any, any of the
+    group ACL's in group_any (held in the group the action is on), or all of
+    the user ACL's in user_all """
+
+    __slots__ = ['user_any', 'group_any', 'user_all']
+
+    def __init__(self, user_any=(), group_any=(), user_all=()):
+        self.user_any = user_mask(user_any)
+        self.group_any = group_mask(group_any)
+        self.user_all = user_mask(user_all)
+
+    def allows(self, umask, gmask):
+        if umask & self.user_any or gmask & self.group_any:
+            return True
+
+        return bool(self.user_all) and umask & self.user_all == self.user_all
+
+
+# Group ACL's that let a member manage the group's filters
+FILTER_ACLS = ('grant:*', 'user:owner', 'user:admin', 'user:op',
+               'group:property')
+
+ACTIONS = {
+    'user:auspex': Rule(user_any='user:auspex'),
+    'group:auspex': Rule(user_any='group:auspex'),
+    'group:property': Rule(user_any='group:override',
+                           group_any=('grant:*', 'grant:group:property',
+                                      'group:property')),
+    'group:filter': Rule(user_any='group:override', group_any=FILTER_ACLS),
+}
+
+
+def rule_for(action):
+    """ Get the Rule for an action, or None if there's no such action.
+
+    Besides the fixed actions there is one per ACL for granting it:
+    grant:<acl> for a group ACL (needs grant:* or grant:<acl> in the group,
+    or group:override) and grant-user:<acl> for a user ACL (needs
+    user:grant and the ACL itself).
+    """
+    rule = ACTIONS.get(action)
+    if rule is not None:
+        return rule
+
+    kind, _, acl = action.partition(':')
+    if kind == 'grant' and acl in GROUP_ACL_BITS:
+        rule = Rule(user_any='group:override',
+                    group_any=('grant:*', 'grant:' + acl))
+    elif kind == 'grant-user' and acl in USER_ACL_BITS:
+        rule = Rule(user_all=('user:grant', acl))
+    else:
+        return None
+
+    ACTIONS[action] = rule
+    return rule
+
+
+class PermissionCache:
+    """ Memoised answers to "may user do action (in group)?".
+
+    An answer depends only on the user's ACL's and the user's ACL's in that
+    group, so UserACLSet and GroupACLSet call invalidate when they change and
+    exactly the answers that depended on the change are dropped. Everything
+    else is one dict lookup.
+    """
+
+    def __init__(self):
+        # (user key, group key or None, action) -> bool
+        self.entries = dict()
+
+        # User key -> keys of entries for that user
+        self.by_user = defaultdict(set)
+
+    def check(self, user, group, action):
+        """ Whether user may do action, in group if it isn't None """
+        gkey = None if group is None else group.key
+        key = (user.key, gkey, action)
+        allowed = self.entries.get(key)
+        if allowed is not None:
+            permission_hits.inc()
+            return allowed
+
+        permission_misses.inc()
+
+        rule = rule_for(action)
+        if rule is None:
+            # Nobody may do what doesn't exist; not cached, as action may
+            # have come off the wire
+            return False
+
+        gmask = 0 if group is None else group.acl.mask(user)
+        allowed = rule.allows(user.acl.mask, gmask)
+
+        if len(self.entries) >= MAXENTRIES:
+            self.clear()
+
+        self.entries[key] = allowed
+        self.by_user[user.key].add(key)
+        return allowed
+
+    def invalidate(self, user, group=None):
+        """ Forget answers for user: all of them, or only those in group """
+        user = key_of(user)
+        if group is None:
+            keys = self.by_user.pop(user, ())
+        else:
+            group = key_of(group)
+            keys = self.by_user.get(user)
+            if not keys:
+                return
+
+            stale = [k for k in keys if k[1] == group]
+            keys.difference_update(stale)
+            keys = stale
+
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_user.clear()
@@ -0,0 +1,100 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import logging
+
+from server.names import key_of
+from server.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+presence_sent = metrics.counter('presence.sent')
+
+
+class PresenceIndex:
+    """ Who is watching whom, for presence notifications.
+
+    watchers maps a user's name to the online users that have them on their
+    roster (pending and blocked entries don't count). It only ever holds
+    online watchers: their entries go in at signon and come out at signoff,
+    and roster changes whilst online update it as they happen. Telling
+    everyone that a user came or went is then proportional to the number of
+    watchers, not the number of rosters.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+        # Target name -> set of online watching Users
+        self.watchers = dict()
+
+        # Users whose rosters are in watchers
+        self.indexed = set()
+
+    def watch(self, watcher, target):
+        target = key_of(target)
+        watching = self.watchers.get(target)
+        if watching is None:
+            watching = self.watchers[target] = set()
+
+        watching.add(watcher)
+
+    def unwatch(self, watcher, target):
+        target = key_of(target)
+        watching = self.watchers.get(target)
+        if watching is None:
+            return
+
+        watching.discard(watcher)
+        if not watching:
+            del self.watchers[target]
+
+    @asyncio.coroutine
+    def user_online(self, user):
+        """ Index user's roster and tell user's watchers they're here """
+        try:
+            roster = (yield from user.roster.load())
+        except Exception:
+            logger.exception('Could not load roster for %s', user.name)
+            return
+
+        if not user.sessions or user in self.indexed:
+            # Gone again already
+            return
+
+        self.indexed.add(user)
+        for target in roster.watched():
+            self.watch(user, target)
+
+        self.notify(user, roster, 'online')
+
+    def user_offline(self, user):
+        """ Tell user's watchers they've gone and unindex user's roster """
+        if user not in self.indexed:
+            # Never got as far as saying they were here
+            return
+
+        self.indexed.discard(user)
+
+        roster = user.roster.loaded
+        self.notify(user, roster, 'offline')
+
+        for target in roster.watched():
+            self.unwatch(user, target)
+
+    def notify(self, user, roster, status):
+        watching = self.watchers.get(user.key)
+        if not watching:
+            return
+
+        kval = {'status': [status]}
+        for watcher in list(watching):
+            if roster.blocks(watcher):
+                continue
+
+            watcher.send(user, watcher, 'presence', kval)
+            presence_sent.inc()
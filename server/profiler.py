@@ -0,0 +1,130 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import os
+import sys
+import threading
+import logging
+
+from collections import Counter
+from time import strftime
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """ A statistical profiler for the event loop and storage threads.
+
+    A background thread grabs the stacks of the watched threads every
+    interval seconds and counts them in collapsed form (root first,
+    separated by semicolons), which flamegraph tools understand.
+
+    threads is a callable returning a dict of thread ident -> label; it is
+    called for every sample, so threads started later are picked up.
+
+    Samples are attributed to the command being dispatched by finding the
+    dispatch_code frame on the stack and looking up the code of the frame
+    it called in command_codes (code -> command name), and storage samples
+    to the method called by the storage_code frame. Only f_code and
+    f_lineno are read from other threads' frames; their locals can change
+    under us, so reading them isn't safe.
+    """
+
+    def __init__(self, threads, interval=0.005, dispatch_code=None,
+                 storage_code=None, command_codes=None):
+        self.threads = threads
+        self.interval = interval
+        self.dispatch_code = dispatch_code
+        self.storage_code = storage_code
+        self.command_codes = command_codes or {}
+
+        self.stacks = Counter()
+        self.commands = Counter()
+        self.samples = 0
+
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name='minnow-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _context(self, frame):
+        """ Find what the sampled thread is doing on behalf of """
+        # The frame called by the one being looked at
+        called = None
+        while frame is not None:
+            code = frame.f_code
+            if code is self.dispatch_code:
+                if called is None:
+                    return 'command:?'
+
+                command = self.command_codes.get(called, called.co_name)
+                return 'command:' + command
+            elif code is self.storage_code:
+                method = '?' if called is None else called.co_name
+                return 'storage:' + method
+
+            called = code
+            frame = frame.f_back
+
+        return None
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, label in self.threads().items():
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+
+            context = self._context(frame)
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+
+            stack.append(context or '(none)')
+            stack.append(label)
+            stack.reverse()
+
+            self.stacks[';'.join(stack)] += 1
+            if context is not None:
+                self.commands[context] += 1
+
+        self.samples += 1
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                logger.exception('Profiler sample failed')
+
+    def write(self, directory='data'):
+        """ Write collapsed stacks to a file, returning its path """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory,
+                            strftime('profile-%Y%m%d-%H%M%S.folded'))
+
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+        return path
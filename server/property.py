@@ -7,6 +7,9 @@
 import enum
 from time import time
 
+from server.names import canonical, key_of
+from server.errors import *
+
 class UserPropertyValues(enum.Enum):
     private = None
     wallops = None
@@ -32,23 +35,33 @@ class Property:
         self.time = time_
 
 class BasePropertySet:
-    __slots__ = ['server', 'prop_map']
+    __slots__ = ['server', 'name', 'prop_map']
+
+    # The property enum, and the storage method that commits a batch
+    values = None
+    store_method = None
 
-    def __init__(self, server, prop_data=[]):
+    def __init__(self, server, name, prop_data=None):
         # NOTE - we use prop_data here separate instead of getting it ourselves
         # because __init__ being a coroutine is probably dodgy.
         self.server = server
+
+        # Canonical name of what these properties belong to
+        self.name = canonical(name)
         self.prop_map = dict()
 
         if not prop_data:
             return
 
         for prop in prop_data:
-            self._set_nocommit(prop['property'], prop['setter'],
-                               prop['timestamp'])
+            self._set_nocommit(prop['property'], prop['value'],
+                               prop['setter'], prop['timestamp'])
 
     def __iter__(self):
-        return self.prop_map.items()
+        return iter(self.prop_map.items())
+
+    def __contains__(self, property):
+        return property in self.prop_map
 
     def has_property(self, property):
         return property in self.prop_map
@@ -56,116 +69,84 @@ class BasePropertySet:
     def get(self, property):
         return self.prop_map.get(property)
 
-    def _set_nocommit(self, property, value, setter=None, time_=None):
-        self.prop_map[property] = Property(value, setter, time_)
-        return (True, None)
-
-    def set(self, property, value, setter=None):
-        if not isinstance(property, str):
-            assert len(property) == len(value)
-
-            for i, p in enumerate(property):
-                self.set(p, value[i], setter)
-
-            return
-
-        self._set_nocommit(property, value, setter)
-
-    def delete(self, property):
-        if not isinstance(property, str):
-            for p in property:
-                self.delete(a)
-
-            return
-
-        if property not in self.prop_map:
-            raise PropertyDoesNotExistError('Property does not exist')
-
-        del self.prop_map[property]
-
-
-class UserPropertySet(BasePropertySet):
-    __slots__ = BasePropertySet.__slots__ + ['user']
-
-    def __init__(self, server, user, prop_data=None):
-        super().__init__(server, prop_data)
-        self.user = user.lower()
-
-    def _set_nocommit(self, property, value, setter=None, time_=None):
+    def check(self, property, value):
+        """ Validate a property, returning (property, value) cast to the
+        right type """
         property = property.lower()
 
-        if property not in UserPropertyValues:
-            return (False, PropertyInvalidError(property))
-
-        if not setter:
-            setter = self.user
+        if property not in self.values.__members__:
+            raise PropertyInvalidError(property)
 
-        typecast = UserPropertyValues[property].value
+        typecast = self.values[property].value
         if typecast is not None:
             try:
                 value = typecast(value)
             except Exception as e:
-                return (False, PropertyValueError(str(e)))
+                raise PropertyValueError(str(e)) from e
 
-        return super()._set_nocommit(property, value, setter, time_)
+        return (property, value)
+
+    def _set_nocommit(self, property, value, setter=None, time_=None):
+        self.prop_map[property] = Property(value, setter, time_)
 
     def set(self, property, value, setter=None):
-        property = property.lower()
-        if property in self.prop_map:
-            function = self.server.proto_store.set_property_user
-        else:
-            function = self.server.proto_store.create_property_user
+        """ Set a property or a list of them (with a matching list of
+        values). All are checked before any are set, and they're stored in
+        one transaction. """
+        if isinstance(property, str):
+            property, value = [property], [value]
+
+        if len(property) != len(value):
+            raise PropertyValueError('Property-value length mismatch')
+
+        props = [self.check(p, v) for p, v in zip(property, value)]
 
-        setter = getattr(setter, 'name', setter).lower()
-        super().set(property, value, setter)
-        if not ret:
-            raise code
+        setter = key_of(setter)
+        created = []
+        changed = []
+        for p, v in props:
+            if p in self.prop_map:
+                changed.append((p, v))
+            else:
+                created.append((p, v, setter))
 
-        asyncio.async(function(self.user, property, value, setter))
+            self._set_nocommit(p, v, setter)
+
+        self.server.proto_store.write(self.store_method, self.name, created,
+                                      changed)
 
     def delete(self, property):
-        super().delete(property)
-        function = self.server.proto_store.delete_property_user
-        asyncio.async(function(self.user, property))
+        """ Delete a property or a list of them, all or nothing """
+        if isinstance(property, str):
+            property = [property]
 
+        property = [p.lower() for p in property]
+        for p in property:
+            if p not in self.prop_map:
+                raise PropertyDoesNotExistError('Property does not exist')
 
-class GroupPropertySet(BasePropertySet):
-    __slots__ = BasePropertySet.__slots__ + ['group']
+        for p in property:
+            self.prop_map.pop(p, None)
 
-    def __init__(self, server, group, prop_data=None):
-        super().__init__(server, prop_data)
-        self.group = group.lower()
+        self.server.proto_store.write(self.store_method, self.name,
+                                      deleted=property)
 
-    def _set_nocommit(self, property, value, setter=None, time_=None):
-        property = property.lower()
 
-        if property not in GroupPropertyValues:
-            return (False, PropertyInvalidError(property))
+class UserPropertySet(BasePropertySet):
+    __slots__ = []
 
-        typecast = GroupPropertyValues[property].value
-        if typecast is not None:
-            try:
-                value = typecast(value)
-            except Exception as e:
-                return (False, PropertyValueError(str(e)))
+    values = UserPropertyValues
+    store_method = 'set_user_properties'
 
-        return super()._set_nocommit(property, value, setter, time_)
+    def _set_nocommit(self, property, value, setter=None, time_=None):
+        if not setter:
+            setter = self.name
 
-    def set(self, property, value, setter=None):
-        property = property.lower()
-        if property in self.prop_map:
-            function = self.server.proto_store.set_property_user
-        else:
-            function = self.server.proto_store.create_property_user
+        super()._set_nocommit(property, value, setter, time_)
 
-        setter = getattr(setter, 'name', setter).lower()
-        ret, code = super().set(property, value, setter)
-        if not ret:
-            raise code
 
-        asyncio.async(function(self.group, property, value, setter))
+class GroupPropertySet(BasePropertySet):
+    __slots__ = []
 
-    def delete(self, property):
-        super().delete(property)
-        function = self.server.proto_store.delete_property_group
-        asyncio.async(function(self.group, property))
+    values = GroupPropertyValues
+    store_method = 'set_group_properties'
@@ -13,10 +13,13 @@ import traceback
 
 from sys import stderr
 from collections import defaultdict
+from time import perf_counter
 
 import server.parser as parser
 
 from server.server import DCPServer
+from server.metrics import metrics
+from server.trace import tracer
 from server.errors import *
 from settings import *
 
@@ -32,6 +35,15 @@ if globals().get('listen_websockets'):
 
 logger = logging.getLogger(__name__)
 
+conn_total = metrics.counter('proto.connections')
+conn_open = metrics.gauge('proto.connections_open')
+frames_in = metrics.counter('proto.frames_in')
+frames_out = metrics.counter('proto.frames_out')
+bytes_in = metrics.counter('proto.bytes_in')
+bytes_out = metrics.counter('proto.bytes_out')
+parse_errors = metrics.counter('proto.parse_errors')
+internal_errors = metrics.counter('proto.internal_errors')
+
 
 @asyncio.coroutine
 def rdns_check(ip, future):
@@ -67,6 +79,15 @@ class DCPBaseProto(asyncio.Protocol):
         # Global state
         self.server = server
 
+        # Options negotiated at signon
+        self.options = frozenset()
+
+        # Resume state (see server.session); backlog holds writes whilst
+        # we're detached
+        self.resume_token = None
+        self.backlog = None
+        self.backlog_lost = 0
+
         # Multipart storage stuff
         self.multipart = dict()
 
@@ -83,6 +104,8 @@ class DCPBaseProto(asyncio.Protocol):
         logger.info('Connection from %s', self.peername)
 
         self.transport = transport
+        conn_total.inc()
+        conn_open.inc()
         asyncio.async(self.process())
 
     def connection_lost(self, exc):
@@ -92,9 +115,11 @@ class DCPBaseProto(asyncio.Protocol):
         for callback in self.callbacks.values():
             callback.cancel()
 
+        conn_open.dec()
         self.transport = None
 
     def data_received(self, data):
+        bytes_in.inc(len(data))
         data = (self.__buf + data).split(self.frame.terminator)
         rem = data.pop()
         self.__buf = rem
@@ -109,22 +134,36 @@ class DCPBaseProto(asyncio.Protocol):
             if globals().get('frame_debug'):
                 logger.debug('Got frame: %r', line)
 
+            span = tracer.sample('frame')
+
             try:
                 frame = self.frame.parse(line)
             except ParserError as e:
+                parse_errors.inc()
                 logger.exception('Parser failure')
                 self.error('*', 'Parser failure', {'cause': [str(e)]})
                 break
 
+            if span is not None:
+                span.name = 'frame:' + str(frame.command).lower()
+                span.child('parse', span.start).finish()
+                frame.span = span
+
+            frames_in.inc()
             asyncio.async(self.recvq.put(frame))
 
     @asyncio.coroutine
     def process(self):
         while True:
             line = (yield from self.recvq.get())
+            span = getattr(line, 'span', None)
             try:
-                yield from self.server._call_func(self, line)
+                if span is None:
+                    yield from self.server._call_func(self, line)
+                else:
+                    yield from self._call_traced(line, span)
             except Exception as e:
+                internal_errors.inc()
                 logger.exception('Bug hit! (Exception below)')
                 self.error(line.command, 'Internal server error (this isn\'t '
                            'your fault)')
@@ -133,6 +172,21 @@ class DCPBaseProto(asyncio.Protocol):
             if self.transport is None:
                 break
 
+    @asyncio.coroutine
+    def _call_traced(self, line, span):
+        now = perf_counter()
+
+        # Time spent waiting in the receive queue
+        span.child('recvq', span.children[-1].end).finish(now)
+
+        dispatch = span.child('dispatch', now)
+        try:
+            yield from tracer.run(self.server._call_func(self, line), dispatch)
+        finally:
+            dispatch.finish()
+            span.finish()
+            tracer.record(span)
+
     @staticmethod
     def _proto_name(target):
         if isinstance(target, DCPServer):
@@ -146,27 +200,56 @@ class DCPBaseProto(asyncio.Protocol):
         else:
             return '&' + getattr(target, 'name', target)
 
-    def send(self, source, target, command, kval=None):
-        if not self.transport:
-            return
-
+    def pack(self, source, target, command, kval=None):
+        """ Encode a frame in this connection's wire format """
         source = self._proto_name(source)
         target = self._proto_name(target)
         if kval is None:
             kval = dict()
 
-        frame = self.frame(source, target, command, kval)
-        self.transport.write(bytes(frame))
+        return bytes(self.frame(source, target, command, kval))
 
-    def send_multipart(self, source, target, command, keys=list(), kval=None,
+    def write(self, data, frames=1):
+        """ Write pre-encoded frames; frames is how many are in data """
+        if not self.transport:
+            if self.backlog is not None:
+                if len(self.backlog) == self.backlog.maxlen:
+                    self.backlog_lost += 1
+
+                self.backlog.append((data, frames))
+
+            return
+
+        bytes_out.inc(len(data))
+        frames_out.inc(frames)
+        self.transport.write(data)
+
+    def send(self, source, target, command, kval=None):
+        if not self.transport and self.backlog is None:
+            return
+
+        span = tracer.current
+        if span is not None:
+            span = span.child('encode')
+
+        data = self.pack(source, target, command, kval)
+
+        if span is not None:
+            span.finish()
+
+        self.write(data)
+
+    def pack_multipart(self, source, target, command, keys=list(), kval=None,
                        use_size=False):
+        """ Encode a multipart stream, returning a list of frames """
         if kval is None:
             # No point
-            self.send(source, target, command, {})
-            return
+            return [self.pack(source, target, command, {})]
+
+        sname = self._proto_name(source)
+        tname = self._proto_name(target)
 
-        sname = source.name
-        tname = target.name
+        frames = []
 
         if any(k in ('multipart', 'transfer-size') for k in keys):
             raise MultipartKeyError('Bad multipart keys')
@@ -231,7 +314,7 @@ class DCPBaseProto(asyncio.Protocol):
             kval_first['transfer-size'] = str(sum(sum(len(v2) for v2 in v) for
                                                   v in kval_k.values()))
 
-        self.send(source, target, command, kval_first)
+        frames.append(self.pack(source, target, command, kval_first))
 
         # The goal of the below is to pack as much data as possible into a
         # single frame.
@@ -260,7 +343,7 @@ class DCPBaseProto(asyncio.Protocol):
 
             if (fit + len_kv(kval_cur) + len_kv(kval_next)) >= parser.MAXFRAME:
                 # Send what we have, replace kval_cur
-                self.send(source, target, command, kval_cur)
+                frames.append(self.pack(source, target, command, kval_cur))
 
                 kval_cur.clear()
 
@@ -274,10 +357,31 @@ class DCPBaseProto(asyncio.Protocol):
 
         if kval_cur:
             # Send whatever we have left
-            self.send(source, target, command, kval_cur)
+            frames.append(self.pack(source, target, command, kval_cur))
 
         # End of stream sentinel
-        self.send(source, target, command, {'multipart': ['*']})
+        frames.append(self.pack(source, target, command,
+                                {'multipart': ['*']}))
+
+        return frames
+
+    def send_multipart(self, source, target, command, keys=list(), kval=None,
+                       use_size=False):
+        if not self.transport and self.backlog is None:
+            return
+
+        span = tracer.current
+        if span is not None:
+            span = span.child('encode')
+
+        frames = self.pack_multipart(source, target, command, keys, kval,
+                                     use_size)
+        data = b''.join(frames)
+
+        if span is not None:
+            span.finish()
+
+        self.write(data, len(frames))
 
     def error(self, command, reason, fatal=True, extargs=None, source=None):
         if not self.transport:
@@ -345,22 +449,30 @@ class DCPSocketProto(DCPBaseProto):
 
         self.host = self.peername[0]
 
-        # Begin DNS lookup
-        self.rdns.add_done_callback(self.set_host)
-        dns = asyncio.wait_for(rdns_check(self.peername[0], self.rdns), 5)
-        asyncio.async(dns)
-
         # Start the connection timeout
         loop = asyncio.get_event_loop()
         cb = loop.call_later(60, self.server.conn_timeout, self)
         self.callbacks['signon'] = cb
 
+        if self.server.lag.defer_accept(self):
+            # Overloaded; we'll get back to this connection later
+            return
+
+        self.accept()
+
+    def accept(self):
+        """ Start processing a new connection """
+        # Begin DNS lookup
+        self.rdns.add_done_callback(self.set_host)
+        dns = asyncio.wait_for(rdns_check(self.peername[0], self.rdns), 5)
+        asyncio.async(dns)
+
     def connection_lost(self, exc):
         super().connection_lost(exc)
 
         self.rdns.cancel()
 
-        if self.user:
+        if self.user and not self.server.sessions.detach(self):
             self.server.user_exit(self.user, self)
 
 
@@ -6,105 +6,157 @@
 
 import asyncio
 
+from collections import OrderedDict
+
+from server.names import canonical, key_of
+from server.metrics import metrics
+from server.errors import *
+
+
+# Deleted entries remembered for roster-sync; older deletions are compacted
+# away, and clients that far behind get the whole roster again
+MAXDELETED = 256
+
+roster_loads = metrics.counter('roster.loads')
+
 
 class RosterEntryUser:
-    __slots__ = ['target', 'alias', 'group_tag', 'pending', 'blocked']
+    __slots__ = ['target', 'alias', 'group_tag', 'pending', 'blocked',
+                 'version']
 
     def __init__(self, target, alias=None, group_tag=None, pending=False,
-                 blocked=False):
+                 blocked=False, version=0):
         self.target = target
-        self.roster = roster
+        self.version = version
 
         if alias is None:
-            alias = target.name.lower()
+            alias = target
 
         self.alias = alias
         self.group_tag = group_tag
         self.pending = bool(pending)
         self.blocked = bool(blocked)
 
+    @property
+    def watching(self):
+        """ Whether the owner gets presence for the target """
+        return not (self.pending or self.blocked)
+
 
 class RosterEntryGroup:
-    __slots__ = ['target', 'alias', 'group_tag']
+    __slots__ = ['target', 'alias', 'group_tag', 'version']
 
-    def __init__(self, target, alias=None, group_tag=None):
+    def __init__(self, target, alias=None, group_tag=None, version=0):
         self.target = target
+        self.version = version
 
         if alias is None:
-            alias = target.name.lower()
+            alias = target
 
         self.alias = alias
         self.group_tag = group_tag
 
 
 class RosterSet:
-    def __init__(self, server, user, entries_u=[], entries_g=[]):
+    """ A user's roster. Entries are keyed by the canonical name of the
+    target, and hold names rather than User/Group objects so loading a
+    roster never loads anyone else.
+
+    Every change bumps version and stamps the entry it touched with it, and
+    deletions are remembered (up to MAXDELETED of them) so clients can ask
+    for just what changed since the version they last saw. compacted is
+    the newest deletion that has been forgotten.
+    """
+
+    __slots__ = ['server', 'user', 'roster_map', 'version', 'compacted',
+                 'deleted']
+
+    def __init__(self, server, user, roster=None, entries_u=[], entries_g=[],
+                 deleted=[]):
         self.server = server
-        self.proto_store = server.proto_store
-        self.user = user.lower()
+        self.user = canonical(user)
         self.roster_map = dict()
 
+        self.version = roster['version'] if roster else 0
+        self.compacted = roster['compacted'] if roster else 0
+
+        # Target -> version it was deleted at, oldest first
+        self.deleted = OrderedDict((row['target'], row['version'])
+                                   for row in deleted)
+
         if entries_u:
             for entry in entries_u:
+                entry = dict(entry)
                 self._add_nocommit(entry['name'], entry['alias'],
-                                   entry['group_tag'], entry['pending'],
-                                   entry['blocked'])
+                                   entry['group_tag'],
+                                   entry.get('pending', False),
+                                   entry.get('blocked', False),
+                                   entry.get('version', 0))
 
         if entries_g:
             for entry in entries_g:
+                entry = dict(entry)
                 self._add_nocommit(entry['name'], entry['alias'],
-                                   entry['group_tag'])
+                                   entry['group_tag'],
+                                   version=entry.get('version', 0))
 
-    def _add_nocommit(self, target, alias=None, group_tag=None,
-                      pending=False, blocked=False):
-        if not hasattr(target, 'name'):
-            target = (yield from server.get_any_target(target))
+    @property
+    def proto_store(self):
+        return self.server.proto_store
+
+    def _online(self):
+        """ The owner's User, if they're online and in the presence
+        index """
+        user = self.server.online_users.get(self.user)
+        if user not in self.server.presence.indexed:
+            return None
 
-        if not target:
-            return (False, TargetDoesNotExistError(target))
+        return user
 
-        tname = target.name.lower()
+    def _bump(self):
+        self.version += 1
+        return self.version
+
+    def _add_nocommit(self, target, alias=None, group_tag=None,
+                      pending=False, blocked=False, version=0):
+        tname = key_of(target)
+        if tname in self.roster_map:
+            raise TargetExistsError(tname)
 
         if tname[0] == '#':
-            inst = RosterEntryGroup
-            args = (target, alias, group_tag)
+            entry = RosterEntryGroup(tname, alias, group_tag, version)
         else:
-            inst = RosterEntryUser
-            args = (target, alias, group_tag, pending, blocked)
-
-        if target in self.roster_map:
-            return (False, TargetExistsError())
+            entry = RosterEntryUser(tname, alias, group_tag, pending,
+                                    blocked, version)
 
-        self.roster_map[tname] = inst(*args)
-        return (True, None)
+        self.roster_map[tname] = entry
+        return entry
 
     def add(self, target, alias=None, group_tag=None):
-        ret, exc = self._add_nocommit(target, alias, group_tag)
-        if not ret:
-            raise exc
+        entry = self._add_nocommit(target, alias, group_tag)
+        entry.version = self._bump()
+        target = entry.target
+        self.deleted.pop(target, None)
 
-        if target.name[0] == '#':
-            function = self.proto_store.create_roster_group
+        if target[0] == '#':
+            method = 'create_roster_group'
         else:
-            function = self.proto_store.create_roster_user
+            method = 'create_roster_user'
 
-        target = getattr(target, 'name', target).lower()
+            owner = self._online()
+            if owner is not None and entry.watching:
+                self.server.presence.watch(owner, target)
 
-        asyncio.async(function(user, target, alias, group_tag))
+        self.proto_store.write(method, self.user, target, alias, group_tag,
+                               entry.version)
 
     def set(self, target, **kwargs):
-        if not hasattr(target, 'name'):
-            target = (yield from server.get_any_target(target))
-
-        if not target:
-            raise TargetDoesNotExistError()
-
-        tname = target.name.lower()
-
+        tname = key_of(target)
         if tname not in self.roster_map:
-            raise RosterDoesNotExistError()
+            raise RosterDoesNotExistError(tname)
 
         roster = self.roster_map[tname]
+        watching = getattr(roster, 'watching', False)
 
         try:
             for k, v in kwargs.items():
@@ -112,28 +164,147 @@ class RosterSet:
         except AttributeError as e:
             raise RosterAttributeError from e
 
-        asyncio.async(function(user, tname, **kwargs))
+        roster.version = self._bump()
+
+        if tname[0] == '#':
+            method = 'set_roster_group'
+        else:
+            method = 'set_roster_user'
+
+            owner = self._online()
+            if owner is not None and roster.watching != watching:
+                if roster.watching:
+                    self.server.presence.watch(owner, tname)
+                else:
+                    self.server.presence.unwatch(owner, tname)
+
+        self.proto_store.write(method, self.user, tname,
+                               version=roster.version, **kwargs)
 
     def delete(self, target):
-        target = getattr(target, 'name', target).lower()
+        target = key_of(target)
 
         if target not in self.roster_map:
             raise RosterDoesNotExistError(target)
 
-        function = (self.proto_store.del_roster_group if target[0] == '#'
-                    else self.proto_store.del_roster_group)
+        if target[0] == '#':
+            method = 'del_roster_group'
+        else:
+            method = 'del_roster_user'
+
+            owner = self._online()
+            if owner is not None:
+                self.server.presence.unwatch(owner, target)
 
         del self.roster_map[target]
 
-        asyncio.async(function(user, target))
+        version = self.deleted[target] = self._bump()
+
+        compacted = None
+        while len(self.deleted) > MAXDELETED:
+            _, compacted = self.deleted.popitem(last=False)
+
+        if compacted is not None:
+            self.compacted = compacted
+
+        self.proto_store.write(method, self.user, target, version, compacted)
 
     def get(self, target):
-        target = getattr(target, 'name', target).lower()
+        target = key_of(target)
 
         if target not in self.roster_map:
-            RosterDoesNotExistError(target)
+            raise RosterDoesNotExistError(target)
 
         return self.roster_map[target]
 
+    def watched(self):
+        """ Names of the users whose presence the owner gets """
+        return [k for k, e in self.roster_map.items()
+                if k[0] != '#' and e.watching]
+
+    def blocks(self, target):
+        """ Whether the owner has blocked target """
+        entry = self.roster_map.get(key_of(target))
+        return entry is not None and getattr(entry, 'blocked', False)
+
+    def changes(self, since):
+        """ Get (changed entries, deleted targets) since version since, or
+        None if that's too far back (or ahead) to tell """
+        if since < self.compacted or since > self.version:
+            return None
+
+        changed = [e for e in self.roster_map.values() if e.version > since]
+        deleted = [t for t, v in self.deleted.items() if v > since]
+        return (changed, deleted)
+
+    def __iter__(self):
+        return iter(self.roster_map.items())
+
+    def __len__(self):
+        return len(self.roster_map)
+
+
+class LazyRoster:
+    """ Stands in for a user's RosterSet until someone needs it.
+
+    Nothing is read from storage until load is called; that takes one trip
+    to the storage thread, and everyone who calls load whilst it's under
+    way waits on the same trip. Once loaded, attributes are passed through
+    to the RosterSet, so code that knows the roster is loaded can use this
+    as one.
+    """
+
+    __slots__ = ['server', 'user', 'roster', 'loading']
+
+    def __init__(self, server, user, roster=None):
+        self.server = server
+        self.user = canonical(user)
+        self.roster = roster
+        self.loading = None
+
+    @property
+    def loaded(self):
+        """ The RosterSet, or None if it hasn't been loaded yet """
+        return self.roster
+
+    @asyncio.coroutine
+    def load(self):
+        """ Get the RosterSet, loading it if needs be """
+        if self.roster is not None:
+            return self.roster
+
+        if self.loading is None:
+            self.loading = asyncio.async(self._load())
+
+        return (yield from asyncio.shield(self.loading))
+
+    @asyncio.coroutine
+    def _load(self):
+        roster_loads.inc()
+        try:
+            data = (yield from self.server.proto_store.load_roster(self.user))
+        finally:
+            self.loading = None
+
+        if self.roster is None:
+            if data:
+                self.roster = RosterSet(self.server, self.user, *data)
+            else:
+                self.roster = RosterSet(self.server, self.user)
+
+        return self.roster
+
+    def _get(self):
+        if self.roster is None:
+            raise RosterError('Roster is not loaded')
+
+        return self.roster
+
+    def __getattr__(self, attr):
+        return getattr(self._get(), attr)
+
     def __iter__(self):
-        return self.roster_map.items()
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
@@ -0,0 +1,217 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import os
+import json
+import mmap
+import struct
+import logging
+
+from binascii import hexlify
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from server.parser import JSONFrame
+from server.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Spill file record header: timestamp, length of the frame that follows
+RECORD = struct.Struct('>dI')
+
+spill_reads = metrics.counter('scrollback.spill_reads')
+spill_bytes = metrics.counter('scrollback.spill_bytes')
+
+# Spill files are written and read on this thread, off the event loop. There
+# is only one so everything happens in the order it was asked for; a read
+# sees every write made before it.
+_spill_executor = ThreadPoolExecutor(1)
+
+
+class Entry:
+    """ One message, encoded at most once per wire format """
+
+    __slots__ = ['ts', 'message', 'frames']
+
+    def __init__(self, ts, data, message=None):
+        self.ts = ts
+
+        # (source, target, kval); entries read back from a spill file only
+        # have the JSON, and get this from it when needed
+        self.message = message
+
+        # Frame class -> bytes. JSON is the canonical copy; the others are
+        # made when someone asks.
+        self.frames = {JSONFrame: data}
+
+    def encode(self, frame):
+        data = self.frames.get(frame)
+        if data is None:
+            if self.message is None:
+                # Without the terminator, which isn't JSON
+                text = self.frames[JSONFrame][:-1].decode('utf-8')
+                header, kval = json.loads(text)
+                self.message = (header['source'], header['target'], kval)
+
+            source, target, kval = self.message
+            data = self.frames[frame] = bytes(frame(source, target,
+                                                    'message', kval))
+
+        return data
+
+
+class Scrollback:
+    """ Recent messages for a group.
+
+    The last size messages are kept in memory, already encoded. Every
+    message is also appended to a spill file (if directory is set), which is
+    mmap'd to answer requests reaching back further than the ring. When the
+    spill file grows past spill_max bytes it is moved aside to .old (one
+    generation is kept), so the disk used per group is bounded.
+
+    Spill files are only touched on the spill thread (see _spill_executor).
+    """
+
+    def __init__(self, key, size=100, directory=None, spill_max=1048576):
+        self.ring = deque(maxlen=size)
+        self.spill_max = spill_max
+
+        self.path = None
+        self.file = None
+
+        # Whether the ring holds everything we know about
+        self.complete = True
+
+        if directory and spill_max:
+            name = hexlify(key.encode('utf-8')).decode('ascii')
+            self.path = os.path.join(directory, name + '.log')
+
+            if (os.path.exists(self.path) or
+                    os.path.exists(self.path + '.old')):
+                self.complete = False
+
+    def append(self, source, target, kval, ts=None):
+        """ Record a message, returning its Entry """
+        if ts is None:
+            ts = time()
+
+        kval = dict(kval)
+        kval['time'] = [str(round(ts, 3))]
+
+        data = bytes(JSONFrame(source, target, 'message', kval))
+        entry = Entry(ts, data, (source, target, kval))
+
+        if len(self.ring) == self.ring.maxlen:
+            self.complete = False
+
+        self.ring.append(entry)
+
+        if self.path is not None:
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(_spill_executor, self._spill, ts, data)
+
+        return entry
+
+    def _spill(self, ts, data):
+        try:
+            self._spill_write(ts, data)
+        except OSError:
+            logger.exception('Could not write scrollback to %s', self.path)
+
+    def _spill_write(self, ts, data):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, 'ab')
+
+        if self.file.tell() + RECORD.size + len(data) > self.spill_max:
+            self.file.close()
+            os.replace(self.path, self.path + '.old')
+            self.file = open(self.path, 'ab')
+
+        self.file.write(RECORD.pack(ts, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self.path is not None:
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(_spill_executor, self._close)
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def _read(path, records):
+        """ Add (ts, data) for every record in a spill file to records,
+        returning the file's size """
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return 0
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                pos = 0
+                while pos + RECORD.size <= size:
+                    ts, length = RECORD.unpack_from(m, pos)
+                    pos += RECORD.size
+                    if pos + length > size:
+                        # Torn write at the end
+                        break
+
+                    records.append((ts, m[pos:pos + length]))
+                    pos += length
+
+        return size
+
+    def _spilled(self):
+        """ Get (records, bytes read) from both spill files """
+        if self.file is not None:
+            self.file.flush()
+
+        records = []
+        size = self._read(self.path + '.old', records)
+        size += self._read(self.path, records)
+        return (records, size)
+
+    @asyncio.coroutine
+    def entries(self, count=None, since=None):
+        """ Get messages, oldest first: the last count, or all those after
+        the timestamp since, whichever is fewer """
+        if count is not None and count <= 0:
+            return []
+
+        ring = self.ring
+        covered = self.complete or self.path is None
+        if not covered and ring:
+            if since is not None:
+                covered = ring[0].ts <= since
+            elif count is not None:
+                covered = count <= len(ring)
+
+        if covered:
+            entries = list(ring)
+        else:
+            loop = asyncio.get_event_loop()
+            records, size = (yield from loop.run_in_executor(_spill_executor,
+                                                             self._spilled))
+            spill_reads.inc()
+            spill_bytes.inc(size)
+            entries = [Entry(ts, data) for ts, data in records]
+        if since is not None:
+            entries = [e for e in entries if e.ts > since]
+
+        if count is not None:
+            entries = entries[-count:]
+
+        return entries
@@ -0,0 +1,317 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import logging
+
+from itertools import islice
+
+from server.names import canonical
+from server.storage.scheduler import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+
+class RadixNode:
+    """ A node in a RadixTree. label is the edge leading into this node;
+    value is None unless a key ends here. """
+
+    __slots__ = ['label', 'children', 'value']
+
+    def __init__(self, label, value=None):
+        self.label = label
+        self.children = None
+        self.value = value
+
+
+class RadixTree:
+    """ A compressed trie mapping string keys to values, kept in key order.
+
+    Chains of single-child nodes are collapsed into one edge, so memory is
+    proportional to the number of keys and not their total length. """
+
+    __slots__ = ['root', 'size']
+
+    def __init__(self):
+        self.root = RadixNode('')
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and node.value is not None
+
+    def _find(self, key):
+        node = self.root
+        i = 0
+        while i < len(key):
+            if not node.children:
+                return None
+
+            child = node.children.get(key[i])
+            if child is None or not key.startswith(child.label, i):
+                return None
+
+            node = child
+            i += len(child.label)
+
+        return node
+
+    def get(self, key, default=None):
+        node = self._find(key)
+        if node is None or node.value is None:
+            return default
+
+        return node.value
+
+    def insert(self, key, value=True):
+        node = self.root
+        i = 0
+        while i < len(key):
+            if node.children is None:
+                node.children = dict()
+
+            child = node.children.get(key[i])
+            if child is None:
+                node.children[key[i]] = RadixNode(key[i:], value)
+                self.size += 1
+                return
+
+            label = child.label
+            n = min(len(label), len(key) - i)
+            j = 0
+            while j < n and label[j] == key[i + j]:
+                j += 1
+
+            if j < len(label):
+                # Split the edge where the keys diverge
+                mid = RadixNode(label[:j])
+                child.label = label[j:]
+                mid.children = {child.label[0]: child}
+                node.children[key[i]] = mid
+                child = mid
+
+            node = child
+            i += j
+
+        if node.value is None:
+            self.size += 1
+
+        node.value = value
+
+    @staticmethod
+    def _merge(node):
+        """ Fold a valueless node with one child into that child """
+        (child,) = node.children.values()
+        node.label += child.label
+        node.children = child.children
+        node.value = child.value
+
+    def remove(self, key):
+        parent = None
+        node = self.root
+        i = 0
+        while i < len(key):
+            if not node.children:
+                return False
+
+            child = node.children.get(key[i])
+            if child is None or not key.startswith(child.label, i):
+                return False
+
+            parent, node = node, child
+            i += len(child.label)
+
+        if node.value is None:
+            return False
+
+        node.value = None
+        self.size -= 1
+
+        if parent is None:
+            # The empty key, nothing to compact
+            return True
+
+        if not node.children:
+            del parent.children[node.label[0]]
+            if not parent.children:
+                parent.children = None
+            elif (parent is not self.root and parent.value is None and
+                  len(parent.children) == 1):
+                self._merge(parent)
+        elif len(node.children) == 1:
+            self._merge(node)
+
+        return True
+
+    def _walk(self, node, path, after):
+        if node.value is not None and (after is None or path > after):
+            yield (path, node.value)
+
+        if not node.children:
+            return
+
+        for ch in sorted(node.children):
+            child = node.children[ch]
+            cpath = path + child.label
+            if after is None or cpath > after:
+                yield from self._walk(child, cpath, None)
+            elif after.startswith(cpath):
+                yield from self._walk(child, cpath, after)
+
+            # Otherwise every key below is before the cursor
+
+    def iter_prefix(self, prefix, after=None):
+        """ Iterate (key, value) pairs whose key starts with prefix, in order,
+        starting after the given key (exclusive) if one is given. """
+        node = self.root
+        path = ''
+        i = 0
+        while i < len(prefix):
+            if not node.children:
+                return
+
+            child = node.children.get(prefix[i])
+            if child is None:
+                return
+
+            rest = prefix[i:]
+            if rest.startswith(child.label):
+                i += len(child.label)
+            elif child.label.startswith(rest):
+                i = len(prefix)
+            else:
+                return
+
+            path += child.label
+            node = child
+
+        yield from self._walk(node, path, after)
+
+
+class SearchIndex:
+    """ Prefix search over registered/online user and group names.
+
+    The index is loaded lazily from storage the first time it's searched, and
+    kept up to date incrementally after that. Keys are canonical names, and
+    values are display names.
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+        self.users = RadixTree()
+        self.groups = RadixTree()
+
+        self.loaded = False
+        self.loading = None
+
+        # Changes seen while the initial load was in flight
+        self.pending = []
+
+    def _tree(self, name):
+        return self.groups if name[0] == '#' else self.users
+
+    def add(self, name):
+        """ Add a user or group name to the index """
+        if not self.loaded:
+            if self.loading is not None:
+                self.pending.append(name)
+
+            # Otherwise the load will see it
+            return
+
+        self._tree(name).insert(canonical(name), name)
+
+    def remove(self, name):
+        if not self.loaded:
+            if self.loading is not None:
+                self.pending.append((name,))
+
+            return
+
+        self._tree(name).remove(canonical(name))
+
+    def user_online(self, user):
+        """ Update the display name of a user who has just signed on """
+        self.add(user.name)
+
+    @staticmethod
+    def _build(names):
+        tree = RadixTree()
+        for name in names:
+            tree.insert(canonical(name), name)
+
+        return tree
+
+    @asyncio.coroutine
+    def _load(self):
+        store = self.server.proto_store.at(PRIORITY_BULK)
+        user_names = (yield from store.get_user_names())
+        group_names = (yield from store.get_group_names())
+        group_names.extend(self.server.groups.display_names.values())
+
+        # Building millions of nodes takes a while; keep it off the loop
+        loop = asyncio.get_event_loop()
+        users = (yield from loop.run_in_executor(None, self._build,
+                                                 user_names))
+        groups = (yield from loop.run_in_executor(None, self._build,
+                                                  group_names))
+        for user in self.server.online_users.values():
+            users.insert(user.key, user.name)
+
+        self.users, self.groups = users, groups
+        self.loaded = True
+
+        for item in self.pending:
+            if isinstance(item, tuple):
+                self.remove(item[0])
+            else:
+                self.add(item)
+
+        self.pending.clear()
+
+        logger.info('Search index loaded (%d users, %d groups)',
+                    len(users), len(groups))
+
+    @asyncio.coroutine
+    def load(self):
+        if self.loaded:
+            return
+
+        if self.loading is None:
+            self.loading = asyncio.async(self._load())
+
+        try:
+            yield from asyncio.shield(self.loading)
+        except Exception:
+            # Let the next search retry
+            self.loading = None
+            self.pending.clear()
+            raise
+
+    @asyncio.coroutine
+    def search(self, prefix, groups=False, after=None, limit=50,
+               online=False):
+        """ Search for names starting with prefix.
+
+        Returns (names, more), where more is True if there are further results
+        after the last one returned.
+        """
+        yield from self.load()
+
+        tree = self.groups if groups else self.users
+        it = tree.iter_prefix(canonical(prefix),
+                              canonical(after) if after else None)
+        if online:
+            live = self.server.groups if groups else self.server.online_users
+            it = ((k, v) for k, v in it if k in live.objects)
+
+        results = [v for k, v in islice(it, limit + 1)]
+        more = len(results) > limit
+        return (results[:limit], more)
@@ -8,48 +8,93 @@ import enum
 import time
 import asyncio
 import re
-import functools
 import crypt
 import logging
 
 import server.command as command
 import server.parser as parser
 
-from server.acl import UserACLSet, GroupACLSet
-from server.property import UserPropertySet, GroupPropertySet
-from server.roster import RosterSet
+from server.acl import UserACLSet
+from server.property import UserPropertySet
 from server.user import User
-from server.group import Group
+from server.group import GroupManager, DELTA_OPTION
+from server.names import NameRegistry, canonical
+from server.motd import MOTDCache
+from server.metrics import metrics
+from server.loadshed import LagMonitor, STRETCH_PING, MAX_PING_STRETCHES
+from server.trace import tracer
+from server.search import SearchIndex
+from server.permissions import PermissionCache
+from server.presence import PresenceIndex
+from server.session import SessionManager
+from server.offline import OfflineQueue
 from server.storage.asyncstorage import AsyncStorage
+from server.storage.scheduler import PRIORITY_NORMAL
 from server.errors import *
 from settings import *
 
 logging.basicConfig(level=log_level)
 logger = logging.getLogger(__name__)
 
+commands_total = metrics.counter('server.commands')
+command_errors = metrics.counter('server.command_errors')
+
 # This is subject to change
 valid_handle = re.compile(r'^[^#!=&$,\?\*\[\]][^=$,\?\*\[\]]+$')
 
+# Signon options we support
+OPTIONS = frozenset([DELTA_OPTION])
+
 
 class DCPServer:
     def __init__(self, name, servpass=servpass):
         self.name = name
         self.servpass = servpass
 
-        self.online_users = dict()
-        self.groups = dict()
+        # All name lookups go through these (see server.names)
+        self.online_users = NameRegistry()
 
-        self.proto_store = AsyncStorage(store_backend, store_backend_args)
+        self.group_manager = GroupManager(self, group_idle_timeout,
+                                          scrollback_size, scrollback_dir,
+                                          scrollback_spill,
+                                          group_delta_window)
+        self.scrollback_join = scrollback_join
+        self.groups = self.group_manager.groups
 
-        self.motd = None
-        self.motd_load()
+        # Offline targets we've loaded from storage
+        self.target_cache = NameRegistry(max_cache)
 
-    def motd_load(self):
-        try:
-            with open('motd.txt', 'r') as f:
-                self.motd = f.read()
-        except Exception as e:
-            logger.exception('Could not read MOTD')
+        self.proto_store = AsyncStorage(store_backend, store_backend_args,
+                                        write_flush_interval, write_flush_ops,
+                                        storage_readers, storage_connections)
+
+        self.search = SearchIndex(self)
+
+        self.permissions = PermissionCache()
+
+        self.presence = PresenceIndex(self)
+
+        self.sessions = SessionManager(self, resume_grace, resume_buffer)
+
+        self.offline = OfflineQueue(self, offline_cap, offline_expiry)
+
+        self.group_manager.start()
+
+        metrics.gauge('server.users_online', lambda: len(self.online_users))
+        metrics.gauge('server.groups', lambda: len(self.groups))
+        metrics.gauge('server.target_cache', lambda: len(self.target_cache))
+        metrics.gauge('storage.writes_pending',
+                      lambda: len(self.proto_store.writes.pending))
+        metrics.gauge('permissions.entries',
+                      lambda: len(self.permissions.entries))
+
+        self.motd = MOTDCache(self)
+
+        tracer.configure(trace_sample_rate, trace_buffer)
+
+        self.lag = LagMonitor(lag_thresholds, lag_interval,
+                              retry_after=shed_retry_after)
+        self.lag.start()
 
     def error(self, dest, command_, reason, fatal=True, extargs=None,
               source=None):
@@ -68,11 +113,21 @@ class DCPServer:
         proto.error(command_, reason, fatal, extargs, source)
 
     def _call_func(self, proto, line):
-        instance = command.register.get(line.command.lower(), None)
+        name = line.command.lower()
+        instance = command.register.get(name, None)
         if instance is None:
+            command_errors.inc()
             self.error(proto, line.command, 'No such command', False)
             return
 
+        commands_total.inc()
+        metrics.counter('command.' + name).inc()
+
+        if hasattr(proto, 'user') and self.lag.reject(instance):
+            self.error(proto, line.command, 'Server is busy, try again later',
+                       False, {'retry-after': [str(self.lag.retry_after)]})
+            return
+
         # Determine which function to use
         if hasattr(proto, 'user'):
             # User found
@@ -93,16 +148,37 @@ class DCPServer:
         try:
             return (yield from function(*args))
         except CommandError as e:
+            command_errors.inc()
             if proto:
                 self.error(proto, line.command, str(e), False)
 
+    @asyncio.coroutine
+    def shutdown(self):
+        """ Write out everything still waiting to be stored """
+        flushing = self.offline.flush()
+        if flushing is not None:
+            yield from asyncio.wait([flushing])
+
+        yield from self.proto_store.close()
+
     @asyncio.coroutine
     def user_enter(self, proto, user, options):
-        proto.user = self.online_users[user.name.lower()] = user
+        first = not user.sessions
+
+        proto.user = self.online_users[user.name] = user
         user.sessions.add(proto)
 
         user.options = options
 
+        # Only keep the options we know about; the rest are ignored
+        proto.options = frozenset(o for o in options if o in OPTIONS)
+
+        self.search.user_online(user)
+
+        if first:
+            # Off the signon path; the roster may need loading first
+            asyncio.async(self.presence.user_online(user))
+
         # Cancel the timeout
         proto.call_cancel('signon')
 
@@ -110,26 +186,92 @@ class DCPServer:
             'name': [self.name],
             'time': [str(round(time.time()))],
             'version': ['Minnow prototype server', 'v0.1-prealpha'],
-            'options': [],
+            'options': sorted(proto.options),
         }
 
+        token = self.sessions.issue(proto)
+        if token is not None:
+            kval['resume-token'] = [token]
+
         yield from proto.rdns
         if proto.host != proto.peername[0]:
             kval['host'] = [proto.host]
 
-        user.send(self, user, 'signon', kval)
+        proto.send(self, user, 'signon', kval)
+
+        # Anything sent whilst they were away
+        yield from self.offline.drain(user, proto)
 
         # Send the MOTD
         self.user_motd(user, proto)
 
+        if not first:
+            # Catch this session up with the others
+            for group in user.groups:
+                group.burst(user, proto)
+
         # Ping timeout stuff
         proto.timeout = False
         self.ping_timeout(proto)
 
+    @asyncio.coroutine
+    def user_resume(self, proto, old):
+        """ Hand a detached session's user over to a new connection, and
+        replay what was sent whilst it was gone """
+        user = old.user
+        user.sessions.discard(old)
+        user.sessions.add(proto)
+
+        proto.user = user
+        proto.options = old.options
+
+        backlog, lost = old.backlog, old.backlog_lost
+        old.backlog = None
+        old.user = None
+
+        if proto.frame is not old.frame:
+            # Encoded for the wrong wire format
+            lost += len(backlog)
+            backlog = ()
+
+        proto.call_cancel('signon')
+
+        kval = {
+            'name': [self.name],
+            'time': [str(round(time.time()))],
+            'version': ['Minnow prototype server', 'v0.1-prealpha'],
+            'options': sorted(proto.options),
+            'resumed': ['*'],
+        }
+
+        if lost:
+            kval['lost'] = [str(lost)]
+
+        token = self.sessions.issue(proto)
+        if token is not None:
+            kval['resume-token'] = [token]
+
+        yield from proto.rdns
+        if proto.host != proto.peername[0]:
+            kval['host'] = [proto.host]
+
+        proto.send(self, user, 'signon', kval)
+        proto.write(b''.join(data for data, _ in backlog),
+                    sum(frames for _, frames in backlog))
+
+        proto.timeout = False
+        self.ping_timeout(proto)
+
     def user_exit(self, user, proto, reason=None):
+        self.sessions.revoke(proto)
         user.sessions.discard(proto)
-        if not user.sessions:
-            del self.online_users[user.name.lower()]
+        if user.sessions:
+            # Still here on another session
+            return
+
+        del self.online_users[user.name]
+
+        self.presence.user_offline(user)
 
         kval = {
             'quit': ['*'],
@@ -140,9 +282,7 @@ class DCPServer:
 
         for group in list(user.groups):
             # Part them from all groups
-            group.member_del(user)
-
-            group.send(self, user, 'group-exit', kval)
+            group.member_del(user, kval)
 
     @asyncio.coroutine
     def user_register(self, proto, name, gecos, password, command):
@@ -160,7 +300,8 @@ class DCPServer:
                        {'handle': [name]})
             return False
 
-        f = yield from self.proto_store.get_user(name.lower())
+        key = canonical(name)
+        f = yield from self.proto_store.get_user(key)
         if f is not None:
             self.error(proto, command, 'Handle already registered', False,
                        {'handle': [name]})
@@ -179,26 +320,27 @@ class DCPServer:
         password = crypt.crypt(password, crypt.mksalt())
 
         # Bang
-        yield from self.proto_store.create_user(name.lower(), gecos, password)
-
-        # Clear the user cache
-        self.get_any_target.cache_clear()
+        yield from self.proto_store.create_user(key, gecos, password)
+        self.search.add(name)
 
         # Poop out a new user object
         return User(self, name, gecos, password)
 
     def user_motd(self, user, proto):
-        if not self.motd:
-            proto.send(self, user, 'motd', {})
-            return
-
-        kval = {
-            'text': [self.motd],
-        }
-        proto.send_multipart(self, user, 'motd', ['text'], kval)
+        proto.write(*self.motd.get(proto))
 
     def ping_timeout(self, proto):
+        stretch = self.lag.ping_stretch
+
         if proto.timeout:
+            if (self.lag.level >= STRETCH_PING and
+                    proto.ping_stretches < MAX_PING_STRETCHES):
+                # Their pong may well be sat in our queue; wait it out
+                proto.ping_stretches += 1
+                proto.call_later('ping', 30 * stretch, self.ping_timeout,
+                                 proto)
+                return
+
             logger.debug('Connection %r timed out', proto.peername)
             self.error(proto, 'ping', 'Ping timeout')
             return
@@ -207,8 +349,10 @@ class DCPServer:
         proto.send(self, None, 'ping', {'time': [t]})
 
         proto.timeout = True
+        proto.ping_stretches = 0
 
-        proto.call_ish('ping', 45, 60, self.ping_timeout, proto)
+        proto.call_ish('ping', 45 * stretch, 60 * stretch, self.ping_timeout,
+                       proto)
 
     def conn_timeout(self, proto):
         if proto.user:
@@ -222,58 +366,56 @@ class DCPServer:
         if target == '*':
             return
 
-        target = target.lower()
-        if target[0] == '#' and target in self.groups:
-            return self.groups[target]
-        elif target in self.online_users:
-            return self.online_users[target]
+        if target[0] == '#':
+            return self.groups.get(target)
+        else:
+            return self.online_users.get(target)
 
     @asyncio.coroutine
-    @functools.lru_cache(maxsize=max_cache)
-    def get_any_target(self, target):
-        """ Get a target in any state
+    def get_any_target(self, target, priority=PRIORITY_NORMAL):
+        """ Get a target in any state. priority is that of any storage
+        reads needed to load it.
 
-        Note the target is offline if proto is None
+        Note the target is offline if it has no sessions
         """
 
-        target = target.lower()
+        target = canonical(target)
+        if target[0] == '#':
+            return (yield from self.group_manager.get(target))
 
-        ret = self.get_online_target(target)
+        ret = self.online_users.get(target)
         if ret is not None:
             return ret
 
-        if target.startswith('#'):
-            g_data = (yield from self.proto_store.get_group(target))
-            if g_data is None:
-                return None
-
-            acl_data = (yield from self.proto_store.get_group_acl(target))
-            acl_set = GroupACLSet(self, target, acl_data)
+        ret = self.target_cache.get(target)
+        if ret is not None:
+            return ret
 
-            prop_data = (yield from self.proto_store.get_group_property(
-                target))
-            prop_set = GroupPropertySet(self, target, prop_data)
+        ret = (yield from self._load_user(target, priority))
+        if ret is not None:
+            self.target_cache[ret.name] = ret
 
-            return Group(self, target, g_data['topic'], acl_set,
-                         prop_set, g_data['timestamp'])
-        else:
-            u_data = (yield from self.proto_store.get_user(target))
-            if u_data is None:
-                return None
+        return ret
 
-            acl_data = (yield from self.proto_store.get_user_acl(target))
-            acl_set = UserACLSet(self, target, acl_data)
+    @asyncio.coroutine
+    def _load_user(self, target, priority):
+        store = self.proto_store.at(priority)
 
-            prop_data = (yield from self.proto_store.get_user_property(
-                target))
-            prop_set = UserPropertySet(self, target, prop_data)
+        u_data = (yield from store.get_user(target))
+        if u_data is None:
+            return None
 
-            roster_data_u = (yield from self.proto_store.get_roster_user(
-                target))
-            roster_data_g = (yield from self.proto_store.get_roster_group(
-                target))
+        # Sets are only made for users that have something in them; User
+        # makes empty ones on demand
+        acl_data = (yield from store.get_user_acl(target))
+        acl_set = UserACLSet(self, target, acl_data) if acl_data else None
 
-            roster_set = RosterSet(self, target, roster_data_u, roster_data_g)
+        prop_data = (yield from store.get_user_property(target))
+        prop_set = None
+        if prop_data:
+            prop_set = UserPropertySet(self, target, prop_data)
 
-            return User(self, target, u_data['gecos'], u_data['password'],
-                        acl_set, prop_set, roster_set)
+        # The roster is loaded when something first needs it (see
+        # LazyRoster), which lookups like whois never do
+        return User(self, target, u_data['gecos'], u_data['password'],
+                    acl_set, prop_set)
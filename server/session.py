@@ -0,0 +1,85 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import os
+import logging
+
+from binascii import hexlify
+from collections import deque
+
+from server.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+resumed = metrics.counter('session.resumed')
+expired = metrics.counter('session.expired')
+
+
+class SessionManager:
+    """ Resume tokens for sessions.
+
+    Every session gets a token at signon. When the connection drops, the
+    session is kept detached for grace seconds: it stays in the user's
+    sessions (so the user stays online and in their groups), and whatever
+    would have been written to it is kept, up to buffer_size writes.
+    Signing on with the token within that time hands the user and the
+    buffered frames over to the new connection.
+    """
+
+    def __init__(self, server, grace=120, buffer_size=256):
+        self.server = server
+        self.grace = grace
+        self.buffer_size = buffer_size
+
+        # Token -> proto
+        self.tokens = dict()
+
+    def issue(self, proto):
+        """ Give proto a new resume token, replacing any old one """
+        self.revoke(proto)
+        if not self.grace:
+            return None
+
+        token = hexlify(os.urandom(16)).decode('ascii')
+        self.tokens[token] = proto
+        proto.resume_token = token
+        return token
+
+    def revoke(self, proto):
+        token = getattr(proto, 'resume_token', None)
+        if token is not None:
+            self.tokens.pop(token, None)
+            proto.resume_token = None
+
+    def detach(self, proto):
+        """ Hold on to a session whose connection went away. Returns False
+        if it can't be resumed, and should just exit. """
+        if getattr(proto, 'resume_token', None) is None:
+            return False
+
+        proto.backlog = deque(maxlen=self.buffer_size)
+        proto.backlog_lost = 0
+        proto.call_later('resume', self.grace, self.expire, proto)
+        return True
+
+    def expire(self, proto):
+        expired.inc()
+        self.revoke(proto)
+        proto.backlog = None
+
+        logger.debug('Resume window for %r expired', proto.peername)
+        self.server.user_exit(proto.user, proto, 'Connection lost')
+
+    def take(self, token, user):
+        """ Get the detached session for token, if it belongs to user """
+        proto = self.tokens.get(token)
+        if proto is None or proto.user is not user or proto.backlog is None:
+            return None
+
+        self.revoke(proto)
+        proto.call_cancel('resume')
+        resumed.inc()
+        return proto
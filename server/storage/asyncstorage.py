@@ -5,41 +5,172 @@
 # 2, as published by Sam Hocevar. See the LICENSE file for more details.
 
 import asyncio
-import queue
+import logging
 
-from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from time import perf_counter
 
+from server.metrics import metrics
+from server.trace import tracer
+from server.storage.scheduler import StorageScheduler, PRIORITY_NORMAL
+from server.storage.writebehind import WriteBehind
 
-# The pool of cached DCP storage objects
-proto_storage_pool = queue.Queue()
+logger = logging.getLogger(__name__)
 
-# The executor itself
-proto_storage_executor = ThreadPoolExecutor(32)
+storage_calls = metrics.counter('storage.calls')
+storage_errors = metrics.counter('storage.errors')
+storage_latency = metrics.histogram('storage.latency')
+
+class PriorityStorage:
+    """ Makes calls through an AsyncStorage at a given priority """
+
+    def __init__(self, storage, priority):
+        self.storage = storage
+        self.priority = priority
+
+    def __getattr__(self, attr):
+        ret = partial(self.storage.call_at, self.priority, attr)
+
+        setattr(self, attr, ret)
+        return ret
 
 
 class AsyncStorage:
-    def __init__(self, storeclass, args):
+    """ Runs storage calls off the event loop (see StorageScheduler).
+    Calling a method on this calls it on a storage object, and returns a
+    future.
+
+    Backends that set INLINE never block, so their calls are made there and
+    then on one storage object, and the future is already done.
+    """
+
+    def __init__(self, storeclass, args, flush_interval=0.05, flush_ops=256,
+                 readers=8, connections=None):
         self.storeclass = storeclass
         self.args = args
 
-    def run_callback(self, method_call, *args):
-        try:
-            storage = proto_storage_pool.get_nowait()
-        except queue.Empty:
-            storage = self.storeclass(*self.args)
+        if getattr(storeclass, 'INLINE', False):
+            self.storage = storeclass(*args)
+            self.scheduler = None
+        else:
+            self.storage = None
+            self.scheduler = StorageScheduler(partial(storeclass, *args),
+                                              readers, connections)
+
+        self.priorities = {}
+
+        self.writes = WriteBehind(self, flush_interval, flush_ops)
+
+    def at(self, priority):
+        """ Get an object whose storage calls are made at priority """
+        ret = self.priorities.get(priority)
+        if ret is None:
+            ret = self.priorities[priority] = PriorityStorage(self, priority)
+
+        return ret
+
+    def threads(self):
+        """ Get the idents of the storage threads """
+        if self.scheduler is None:
+            return []
+
+        return [t.ident for t in self.scheduler.threads()]
+
+    def write(self, method_call, *args, coalesce=None, **kwargs):
+        """ Queue a write to be committed with others (see WriteBehind);
+        writes with the same method and coalesce key are merged """
+        return self.writes.write(method_call, *args, coalesce=coalesce,
+                                 **kwargs)
+
+    @asyncio.coroutine
+    def close(self):
+        """ Commit all outstanding writes, then stop the storage
+        threads (or close the inline storage object) """
+        yield from self.writes.close()
+
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        else:
+            self.storage.close()
 
+    def run_callback(self, method_call, *args, **kwargs):
+        pool = self.scheduler.pool
+        storage = pool.get()
         try:
             method_call = getattr(storage, method_call)
-            return method_call(*args)
+            return method_call(*args, **kwargs)
         finally:
-            # Place back into the pool
-            proto_storage_pool.put(storage)
+            pool.put(storage)
 
-    def __getattr__(self, attr):
+    def run_traced(self, span, method_call, *args, **kwargs):
+        start = perf_counter()
+
+        # Time spent waiting for a storage thread
+        span.child('queue', span.start).finish(start)
+
+        tracer.set_thread_span(span)
+        try:
+            return self.run_callback(method_call, *args, **kwargs)
+        finally:
+            tracer.set_thread_span(None)
+            span.finish()
+
+    @staticmethod
+    def _call_done(method_call, start, future):
+        loop = asyncio.get_event_loop()
+        storage_latency.observe(loop.time() - start)
+
+        if future.cancelled():
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            # Most writes are fire and forget, so make sure this gets seen
+            storage_errors.inc()
+            logger.error('Storage call %s failed', method_call,
+                         exc_info=(type(exc), exc, exc.__traceback__))
+
+    def call(self, method_call, *args, **kwargs):
+        return self.call_at(PRIORITY_NORMAL, method_call, *args, **kwargs)
+
+    def call_inline(self, method_call, *args, **kwargs):
+        future = asyncio.Future()
+        try:
+            result = getattr(self.storage, method_call)(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+        return future
+
+    def call_at(self, priority, method_call, *args, **kwargs):
         loop = asyncio.get_event_loop()
-        ret = partial(loop.run_in_executor, proto_storage_executor,
-                      self.run_callback, attr)
+
+        if self.storage is not None:
+            start = loop.time()
+            storage_calls.inc()
+            future = self.call_inline(method_call, *args, **kwargs)
+            self._call_done(method_call, start, future)
+            return future
+
+        span = tracer.current
+        if span is None:
+            func = partial(self.run_callback, method_call, *args, **kwargs)
+        else:
+            span = span.child('storage:' + method_call)
+            func = partial(self.run_traced, span, method_call, *args,
+                           **kwargs)
+
+        future = self.scheduler.submit(method_call, priority, func)
+
+        storage_calls.inc()
+        future.add_done_callback(partial(self._call_done, method_call,
+                                         loop.time()))
+        return future
+
+    def __getattr__(self, attr):
+        ret = partial(self.call, attr)
 
         setattr(self, attr, ret)
         return ret
@@ -0,0 +1,818 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import json
+import marshal
+
+from functools import wraps
+from threading import Lock, RLock
+from time import time
+from logging import getLogger
+
+from server.storage.memory.journal import Journal
+
+
+class IntegrityError(Exception):
+    """ A change would break a constraint; raised where the SQLite backend
+    raises sqlite3.IntegrityError """
+
+
+_MISSING = object()
+
+
+class Tables:
+    """ Everything in a memory store. Rows are dicts keyed by column, as in
+    the SQLite schema, but kept under their owner's name rather than an id.
+    Users keep an id so setters that are deleted (or deleted and made
+    again) come back as None, as with ON DELETE SET NULL.
+
+    Changes go through set and pop, which remember what they replaced
+    whilst a change is being made so it can be rolled back.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+
+        # Undo log of the change being made, or None
+        self.undo = None
+
+        # Time of the change being made
+        self.now = 0
+
+        self.ids = {'user': 0, 'group': 0, 'filter': 0, 'offline': 0}
+
+        self.users = {}
+        self.user_names = {}
+        self.groups = {}
+
+        # Owner -> key -> row
+        self.acl_user = {}
+        self.property_user = {}
+        self.acl_group = {}
+        self.property_group = {}
+        self.filter_group = {}
+        self.offline = {}
+        self.roster_user = {}
+        self.roster_group = {}
+
+        # Owner -> row
+        self.roster = {}
+
+        # Owner -> target -> version
+        self.roster_deleted = {}
+
+        # Reverse indexes, for deletes: user -> groups they have ACL's in,
+        # and target -> owners of rosters with it in them. Entries can be
+        # stale (the other side is checked); they're only used to narrow
+        # down where to look.
+        self.acl_group_users = {}
+        self.roster_user_owners = {}
+        self.roster_group_owners = {}
+
+    def set(self, d, key, value):
+        if self.undo is not None:
+            self.undo.append((d, key, d.get(key, _MISSING)))
+
+        d[key] = value
+
+    def pop(self, d, key):
+        value = d.get(key, _MISSING)
+        if value is _MISSING:
+            return None
+
+        if self.undo is not None:
+            self.undo.append((d, key, value))
+
+        del d[key]
+        return value
+
+    def child(self, d, key):
+        """ Get d[key], making it an empty dict if it isn't there """
+        ret = d.get(key)
+        if ret is None:
+            ret = {}
+            self.set(d, key, ret)
+
+        return ret
+
+    def next_id(self, table):
+        ret = self.ids[table] + 1
+        self.set(self.ids, table, ret)
+        return ret
+
+    def rollback(self):
+        for d, key, value in reversed(self.undo):
+            if value is _MISSING:
+                d.pop(key, None)
+            else:
+                d[key] = value
+
+    def dump(self):
+        """ Get everything as something JSON can encode """
+        return {
+            'ids': self.ids,
+            'users': self.users,
+            'groups': self.groups,
+            'acl_user': self.acl_user,
+            'property_user': self.property_user,
+            'acl_group': {g: [[u, a, row] for (u, a), row in acls.items()]
+                          for g, acls in self.acl_group.items()},
+            'property_group': self.property_group,
+            'filter_group': {g: [[k, p, row] for (k, p), row in f.items()]
+                             for g, f in self.filter_group.items()},
+            'offline': {u: list(m.values()) for u, m in self.offline.items()},
+            'roster': self.roster,
+            'roster_user': self.roster_user,
+            'roster_group': self.roster_group,
+            'roster_deleted': self.roster_deleted,
+        }
+
+    def load(self, state):
+        """ Replace everything with what dump returned """
+        self.ids = state['ids']
+        self.users = state['users']
+        self.groups = state['groups']
+        self.acl_user = state['acl_user']
+        self.property_user = state['property_user']
+        self.acl_group = {g: {(u, a): row for u, a, row in acls}
+                          for g, acls in state['acl_group'].items()}
+        self.property_group = state['property_group']
+        self.filter_group = {g: {(k, p): row for k, p, row in f}
+                             for g, f in state['filter_group'].items()}
+        self.offline = {u: {row['id']: row for row in m}
+                        for u, m in state['offline'].items()}
+        self.roster = state['roster']
+        self.roster_user = state['roster_user']
+        self.roster_group = state['roster_group']
+        self.roster_deleted = state['roster_deleted']
+
+        self.user_names = {row['id']: n for n, row in self.users.items()}
+
+        for group, acls in self.acl_group.items():
+            for user, _ in acls:
+                self.acl_group_users.setdefault(user, {})[group] = True
+
+        for owners, entries in ((self.roster_user_owners, self.roster_user),
+                                (self.roster_group_owners,
+                                 self.roster_group)):
+            for owner, targets in entries.items():
+                for target in targets:
+                    owners.setdefault(target, {})[owner] = True
+
+
+def change(func):
+    """ Make func a change to the store: it's made under the lock, undone
+    if it raises, and journalled if it doesn't. Changes made by another
+    change (as in apply) are part of it. """
+    method = func.__name__
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        tables = self.tables
+        with tables.lock:
+            if tables.undo is not None:
+                return func(self, *args, **kwargs)
+
+            tables.undo = []
+            if not self.replaying:
+                tables.now = int(time())
+
+            try:
+                ret = func(self, *args, **kwargs)
+                if not self.replaying:
+                    self.journal.append(tables.now, method, args, kwargs)
+            except BaseException:
+                tables.rollback()
+                raise
+            finally:
+                tables.undo = None
+
+            return ret
+
+    return wrapper
+
+
+# Path -> (tables, journal), so every storage object on a path shares them
+_stores = {}
+_stores_lock = Lock()
+
+
+class ProtocolStorage:
+    """ Protocol storage kept in memory, and persisted by a journal (see
+    Journal). Does everything the SQLite backend does, and raises
+    IntegrityError where it would raise sqlite3.IntegrityError. """
+
+    # Calls only touch memory, so AsyncStorage makes them on the event loop
+    # instead of a storage thread
+    INLINE = True
+
+    def __init__(self, path='data/store', interval=0.05, snapshot_ops=100000):
+        self.path = path
+        self.log = getLogger(__name__ + '.ProtocolStorage')
+        self.replaying = False
+
+        with _stores_lock:
+            store = _stores.get(path)
+            if store is None:
+                store = _stores[path] = self._open(interval, snapshot_ops)
+
+        self.tables, self.journal = store
+
+    def _open(self, interval, snapshot_ops):
+        self.tables = Tables()
+        self.journal = Journal(self.path, interval, snapshot_ops)
+
+        state, records = self.journal.load()
+        if state is not None:
+            self.tables.load(state)
+
+        self.replaying = True
+        try:
+            for _, now, method, args, kwargs in records:
+                self.tables.now = now
+                getattr(self, method)(*args, **kwargs)
+        finally:
+            self.replaying = False
+
+        self.log.info('Loaded store at %d, replayed %d records',
+                      self.journal.seq, len(records))
+
+        self.journal.start(self._dump)
+        return (self.tables, self.journal)
+
+    def _dump(self):
+        # The loop waits on the lock, so only a copy is made under it:
+        # marshal is far quicker than encoding JSON. The copy is encoded
+        # after.
+        with self.tables.lock:
+            seq = self.journal.seq
+            state = marshal.dumps(self.tables.dump())
+
+        return (seq, json.dumps(marshal.loads(state)))
+
+    def close(self):
+        """ Write everything out and stop the journal """
+        with _stores_lock:
+            if _stores.get(self.path) is not None:
+                del _stores[self.path]
+                self.journal.close()
+
+    @change
+    def apply(self, calls):
+        """ Make (method, args, kwargs) calls to this object, all in one
+        change """
+        for method, args, kwargs in calls:
+            getattr(self, method)(*args, **kwargs)
+
+    # Lookups
+
+    def _user_id(self, name):
+        row = self.tables.users.get(name)
+        if row is None:
+            raise IntegrityError('No such user: {}'.format(name))
+
+        return row['id']
+
+    def _setter_id(self, name):
+        row = self.tables.users.get(name)
+        return None if row is None else row['id']
+
+    def _setter(self, row):
+        return self.tables.user_names.get(row['setter_id'])
+
+    def _group(self, name):
+        row = self.tables.groups.get(name)
+        if row is None:
+            raise IntegrityError('No such group: {}'.format(name))
+
+        return row
+
+    def _roster(self, name):
+        row = self.tables.roster.get(name)
+        if row is None:
+            raise IntegrityError('No roster for: {}'.format(name))
+
+        return row
+
+    def _bump_roster(self, name, version):
+        roster = self.tables.roster.get(name)
+        if roster is not None and version > roster['version']:
+            self.tables.set(roster, 'version', version)
+
+    # Retrieval
+
+    def get_user(self, name):
+        with self.tables.lock:
+            row = self.tables.users.get(name)
+            if row is None:
+                return None
+
+            return {'password': row['password'], 'gecos': row['gecos'],
+                    'timestamp': row['timestamp'], 'avatar': row['avatar']}
+
+    def get_user_names(self):
+        with self.tables.lock:
+            return list(self.tables.users)
+
+    def get_user_acl(self, name):
+        with self.tables.lock:
+            acls = self.tables.acl_user.get(name, {})
+            return [{'acl': acl, 'timestamp': row['timestamp'],
+                     'reason': row['reason'], 'setter': self._setter(row)}
+                    for acl, row in sorted(acls.items())]
+
+    def get_user_property(self, name):
+        with self.tables.lock:
+            props = self.tables.property_user.get(name, {})
+            return [{'property': prop, 'value': row['value'],
+                     'timestamp': row['timestamp'],
+                     'setter': self._setter(row)}
+                    for prop, row in sorted(props.items())]
+
+    def get_roster_user(self, name):
+        with self.tables.lock:
+            entries = self.tables.roster_user.get(name, {})
+            return [{'alias': row['alias'], 'group_tag': row['group_tag'],
+                     'blocked': row['blocked'], 'pending': row['pending'],
+                     'version': row['version'], 'name': target}
+                    for target, row in sorted(entries.items())]
+
+    def get_group(self, name):
+        with self.tables.lock:
+            row = self.tables.groups.get(name)
+            if row is None:
+                return None
+
+            return {'topic': row['topic'], 'timestamp': row['timestamp'],
+                    'display': row.get('display')}
+
+    def get_group_names(self):
+        with self.tables.lock:
+            return [row.get('display') or name
+                    for name, row in self.tables.groups.items()]
+
+    def get_group_acl(self, name):
+        with self.tables.lock:
+            acls = self.tables.acl_group.get(name, {})
+            return [{'acl': acl, 'timestamp': row['timestamp'],
+                     'reason': row['reason'], 'target': user,
+                     'setter': self._setter(row)}
+                    for (user, acl), row in acls.items()]
+
+    def get_group_acl_user(self, name, username):
+        with self.tables.lock:
+            acls = self.tables.acl_group.get(name, {})
+            return [{'acl': acl, 'timestamp': row['timestamp'],
+                     'reason': row['reason'], 'setter': self._setter(row)}
+                    for (user, acl), row in sorted(acls.items())
+                    if user == username]
+
+    def get_group_property(self, name):
+        with self.tables.lock:
+            props = self.tables.property_group.get(name, {})
+            return [{'property': prop, 'value': row['value'],
+                     'timestamp': row['timestamp'],
+                     'setter': self._setter(row)}
+                    for prop, row in sorted(props.items())]
+
+    def get_group_filter(self, name):
+        with self.tables.lock:
+            filters = self.tables.filter_group.get(name, {})
+            return [{'kind': kind, 'pattern': pattern,
+                     'timestamp': row['timestamp'],
+                     'setter': self._setter(row)}
+                    for (kind, pattern), row in filters.items()]
+
+    def load_group(self, name):
+        """ Get a group's row, ACL's, properties and filters in one go.
+        Returns None if the group doesn't exist. """
+        with self.tables.lock:
+            group = self.get_group(name)
+            if group is None:
+                return None
+
+            return (group, self.get_group_acl(name),
+                    self.get_group_property(name),
+                    self.get_group_filter(name))
+
+    def get_offline(self, name, since=0, limit=-1):
+        with self.tables.lock:
+            messages = self.tables.offline.get(name, {})
+            rows = [dict(row) for row in messages.values()
+                    if row['timestamp'] >= since]
+
+        return rows if limit < 0 else rows[:limit]
+
+    def get_roster_group(self, name):
+        with self.tables.lock:
+            entries = self.tables.roster_group.get(name, {})
+            return [{'alias': row['alias'], 'group_tag': row['group_tag'],
+                     'version': row['version'], 'name': group}
+                    for group, row in sorted(entries.items())]
+
+    def get_roster(self, name):
+        with self.tables.lock:
+            row = self.tables.roster.get(name)
+            return None if row is None else dict(row)
+
+    def get_roster_deleted(self, name):
+        with self.tables.lock:
+            deleted = self.tables.roster_deleted.get(name, {})
+            return [{'target': target, 'version': version}
+                    for target, version in sorted(deleted.items(),
+                                                  key=lambda d: d[1])]
+
+    def load_roster(self, name):
+        """ Get a user's roster row, user entries, group entries and
+        tombstones in one go. Returns None if the user has no roster. """
+        with self.tables.lock:
+            roster = self.get_roster(name)
+            if roster is None:
+                return None
+
+            return (roster, self.get_roster_user(name),
+                    self.get_roster_group(name),
+                    self.get_roster_deleted(name))
+
+    # Creation
+
+    @change
+    def create_user(self, name, gecos, password):
+        t = self.tables
+        if name in t.users:
+            raise IntegrityError('User exists: {}'.format(name))
+
+        if password is None:
+            raise IntegrityError('User has no password: {}'.format(name))
+
+        uid = t.next_id('user')
+        t.set(t.users, name, {'id': uid, 'password': password,
+                              'gecos': gecos, 'timestamp': t.now,
+                              'avatar': None})
+        t.set(t.user_names, uid, name)
+        t.set(t.roster, name, {'version': 0, 'compacted': 0})
+
+    @change
+    def create_group(self, name, topic, display=None):
+        t = self.tables
+        if name in t.groups:
+            raise IntegrityError('Group exists: {}'.format(name))
+
+        t.set(t.groups, name, {'id': t.next_id('group'), 'topic': topic,
+                               'timestamp': t.now, 'display': display})
+
+    @change
+    def create_user_acl(self, name, acl, setter=None, reason=None):
+        t = self.tables
+        self._user_id(name)
+
+        acls = t.child(t.acl_user, name)
+        if acl in acls:
+            raise IntegrityError('ACL exists: {} {}'.format(name, acl))
+
+        t.set(acls, acl, {'setter_id': self._setter_id(setter),
+                          'timestamp': t.now, 'reason': reason})
+
+    @change
+    def create_group_acl(self, name, username, acl, setter=None,
+                         reason=None):
+        t = self.tables
+        self._group(name)
+        self._user_id(username)
+
+        acls = t.child(t.acl_group, name)
+        if (username, acl) in acls:
+            raise IntegrityError('ACL exists: {} {} {}'.format(name,
+                                                              username, acl))
+
+        t.set(acls, (username, acl), {'setter_id': self._setter_id(setter),
+                                      'timestamp': t.now, 'reason': reason})
+        t.set(t.child(t.acl_group_users, username), name, True)
+
+    def _create_property(self, table, name, property, value, setter):
+        t = self.tables
+        props = t.child(table, name)
+        if property in props:
+            raise IntegrityError('Property exists: {} {}'.format(name,
+                                                                property))
+
+        t.set(props, property, {'value': value,
+                                'setter_id': self._setter_id(setter),
+                                'timestamp': t.now})
+
+    @change
+    def create_property_user(self, name, property, value=None, setter=None):
+        self._user_id(name)
+        self._create_property(self.tables.property_user, name, property,
+                              value, setter)
+
+    @change
+    def create_property_group(self, name, property, value=None, setter=None):
+        self._group(name)
+        self._create_property(self.tables.property_group, name, property,
+                              value, setter)
+
+    @change
+    def create_group_filter(self, name, kind, pattern, setter=None):
+        t = self.tables
+        self._group(name)
+
+        filters = t.child(t.filter_group, name)
+        if (kind, pattern) in filters:
+            raise IntegrityError('Filter exists: {} {} {}'.format(name, kind,
+                                                                 pattern))
+
+        t.set(filters, (kind, pattern), {'id': t.next_id('filter'),
+                                         'setter_id': self._setter_id(setter),
+                                         'timestamp': t.now})
+
+    @change
+    def create_user_acls(self, name, acls):
+        """ Add (acl, setter, reason) ACL's to a user in one change """
+        for acl, setter, reason in acls:
+            self.create_user_acl(name, acl, setter, reason)
+
+    @change
+    def create_group_acls(self, name, acls):
+        """ Add (username, acl, setter, reason) ACL's in a group in one
+        change """
+        for username, acl, setter, reason in acls:
+            self.create_group_acl(name, username, acl, setter, reason)
+
+    @change
+    def create_offline(self, messages, cap=None, expire=None):
+        """ Queue (name, source, body, timestamp) messages for offline
+        users, then trim each of those users' queues to the newest cap
+        messages and drop anything older than expire """
+        t = self.tables
+        for name, source, body, timestamp in messages:
+            self._user_id(name)
+
+            mid = t.next_id('offline')
+            t.set(t.child(t.offline, name), mid, {
+                'id': mid, 'source': source, 'body': body,
+                'timestamp': timestamp})
+
+        if cap is not None:
+            for name in {m[0] for m in messages}:
+                queue = t.offline[name]
+                for mid in list(queue)[:max(len(queue) - cap, 0)]:
+                    t.pop(queue, mid)
+
+        if expire is not None:
+            # Queues are in the order messages came in, and so (near
+            # enough) by time; stop at the first one that's new enough
+            for queue in t.offline.values():
+                for mid, row in list(queue.items()):
+                    if row['timestamp'] >= expire:
+                        break
+
+                    t.pop(queue, mid)
+
+    def _create_roster_entry(self, table, owners, name, target, row,
+                             version):
+        t = self.tables
+        self._roster(name)
+
+        entries = t.child(table, name)
+        if target in entries:
+            raise IntegrityError('Roster entry exists: {} {}'.format(name,
+                                                                    target))
+
+        t.set(entries, target, row)
+        t.set(t.child(owners, target), name, True)
+        t.pop(t.roster_deleted.get(name, {}), target)
+        self._bump_roster(name, version)
+
+    @change
+    def create_roster_user(self, name, user, alias=None, group_tag=None,
+                           version=0):
+        self._user_id(user)
+        self._create_roster_entry(self.tables.roster_user,
+                                  self.tables.roster_user_owners, name, user,
+                                  {'alias': alias, 'group_tag': group_tag,
+                                   'blocked': 0, 'pending': 0,
+                                   'version': version}, version)
+
+    @change
+    def create_roster_group(self, name, group, alias=None, group_tag=None,
+                            version=0):
+        self._group(group)
+        self._create_roster_entry(self.tables.roster_group,
+                                  self.tables.roster_group_owners, name,
+                                  group, {'alias': alias,
+                                          'group_tag': group_tag,
+                                          'version': version}, version)
+
+    # Alteration
+
+    @change
+    def set_user(self, name, *, gecos=None, password=None):
+        t = self.tables
+        row = t.users.get(name)
+        if row is None:
+            return
+
+        if gecos is not None:
+            t.set(row, 'gecos', gecos)
+
+        if password is not None:
+            t.set(row, 'password', password)
+
+    @change
+    def set_group(self, name, *, topic=None):
+        row = self.tables.groups.get(name)
+        if row is not None:
+            self.tables.set(row, 'topic', topic)
+
+    @change
+    def set_property_user(self, name, property, value=None, setter=None):
+        row = self.tables.property_user.get(name, {}).get(property)
+        if row is not None:
+            self.tables.set(row, 'value', value)
+
+    @change
+    def set_property_group(self, name, property, value=None, setter=None):
+        row = self.tables.property_group.get(name, {}).get(property)
+        if row is not None:
+            self.tables.set(row, 'value', value)
+
+    @change
+    def set_user_properties(self, name, created=(), changed=(),
+                            deleted=()):
+        """ Create (property, value, setter), change (property, value) and
+        delete property properties of a user in one change """
+        for p, v, setter in created:
+            self.create_property_user(name, p, v, setter)
+
+        for p, v in changed:
+            self.set_property_user(name, p, v)
+
+        for p in deleted:
+            self.del_property_user(name, p)
+
+    @change
+    def set_group_properties(self, name, created=(), changed=(),
+                             deleted=()):
+        """ Like set_user_properties, for a group """
+        for p, v, setter in created:
+            self.create_property_group(name, p, v, setter)
+
+        for p, v in changed:
+            self.set_property_group(name, p, v)
+
+        for p in deleted:
+            self.del_property_group(name, p)
+
+    @change
+    def set_roster_user(self, name, username, *, alias=None, group_tag=None,
+                        blocked=None, pending=None, version=0):
+        t = self.tables
+        row = t.roster_user.get(name, {}).get(username)
+        if row is not None:
+            for k, v in (('alias', alias), ('group_tag', group_tag),
+                         ('blocked', blocked), ('pending', pending)):
+                if v is not None:
+                    t.set(row, k, int(v) if isinstance(v, bool) else v)
+
+            t.set(row, 'version', version)
+
+        self._bump_roster(name, version)
+
+    @change
+    def set_roster_group(self, name, group, *, alias=None, group_tag=None,
+                         version=0):
+        t = self.tables
+        row = t.roster_group.get(name, {}).get(group)
+        if row is not None:
+            for k, v in (('alias', alias), ('group_tag', group_tag)):
+                if v is not None:
+                    t.set(row, k, v)
+
+            t.set(row, 'version', version)
+
+        self._bump_roster(name, version)
+
+    # Deletion
+
+    @change
+    def del_user(self, name):
+        """ Delete a user, and everything that belongs to them """
+        t = self.tables
+        row = t.pop(t.users, name)
+        if row is None:
+            return
+
+        t.pop(t.user_names, row['id'])
+        t.pop(t.acl_user, name)
+        t.pop(t.property_user, name)
+        t.pop(t.offline, name)
+        t.pop(t.roster, name)
+        t.pop(t.roster_deleted, name)
+
+        for target in t.pop(t.roster_user, name) or ():
+            t.pop(t.roster_user_owners.get(target, {}), name)
+
+        for group in t.pop(t.roster_group, name) or ():
+            t.pop(t.roster_group_owners.get(group, {}), name)
+
+        for owner in t.pop(t.roster_user_owners, name) or ():
+            t.pop(t.roster_user.get(owner, {}), name)
+
+        for group in t.pop(t.acl_group_users, name) or ():
+            acls = t.acl_group.get(group, {})
+            for key in [k for k in acls if k[0] == name]:
+                t.pop(acls, key)
+
+    @change
+    def del_user_acl(self, name, acl):
+        self.tables.pop(self.tables.acl_user.get(name, {}), acl)
+
+    @change
+    def del_user_acl_all(self, name):
+        self.tables.pop(self.tables.acl_user, name)
+
+    @change
+    def del_group_acl(self, name, username, acl):
+        self.tables.pop(self.tables.acl_group.get(name, {}), (username, acl))
+
+    @change
+    def del_user_acls(self, name, acls):
+        for acl in acls:
+            self.del_user_acl(name, acl)
+
+    @change
+    def del_group_acls(self, name, acls):
+        """ Remove (username, acl) ACL's in a group in one change """
+        for username, acl in acls:
+            self.del_group_acl(name, username, acl)
+
+    @change
+    def del_group_acl_all(self, name):
+        self.tables.pop(self.tables.acl_group, name)
+
+    @change
+    def del_group_filter(self, name, kind, pattern):
+        self.tables.pop(self.tables.filter_group.get(name, {}),
+                        (kind, pattern))
+
+    @change
+    def del_offline(self, name, last_id):
+        t = self.tables
+        queue = t.offline.get(name, {})
+        for mid in [mid for mid in queue if mid <= last_id]:
+            t.pop(queue, mid)
+
+    @change
+    def del_group(self, name):
+        """ Delete a group, and everything that belongs to it """
+        t = self.tables
+        if t.pop(t.groups, name) is None:
+            return
+
+        t.pop(t.acl_group, name)
+        t.pop(t.property_group, name)
+        t.pop(t.filter_group, name)
+
+        for owner in t.pop(t.roster_group_owners, name) or ():
+            t.pop(t.roster_group.get(owner, {}), name)
+
+    @change
+    def del_property_user(self, name, property):
+        self.tables.pop(self.tables.property_user.get(name, {}), property)
+
+    @change
+    def del_property_group(self, name, property):
+        self.tables.pop(self.tables.property_group.get(name, {}), property)
+
+    def _del_roster_entry(self, table, name, target, version, compacted):
+        t = self.tables
+        roster = self._roster(name)
+
+        t.pop(table.get(name, {}), target)
+
+        deleted = t.child(t.roster_deleted, name)
+        t.set(deleted, target, version)
+        self._bump_roster(name, version)
+
+        if compacted:
+            if compacted > roster['compacted']:
+                t.set(roster, 'compacted', compacted)
+
+            for old in [k for k, v in deleted.items() if v <= compacted]:
+                t.pop(deleted, old)
+
+    @change
+    def del_roster_user(self, name, username, version=0, compacted=None):
+        """ Remove a roster entry, leaving a tombstone at version. If
+        compacted is set, tombstones up to that version are dropped. """
+        self._del_roster_entry(self.tables.roster_user, name, username,
+                               version, compacted)
+
+    @change
+    def del_roster_group(self, name, group, version=0, compacted=None):
+        self._del_roster_entry(self.tables.roster_group, name, group,
+                               version, compacted)
@@ -0,0 +1,204 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import json
+import logging
+import os
+
+from threading import Condition, Thread
+from time import sleep
+
+logger = logging.getLogger(__name__)
+
+
+class JournalError(Exception):
+    """ The journal couldn't be written, so changes aren't being kept """
+
+
+class Journal:
+    """ An append-only log of changes to a memory store, with snapshots.
+
+    Each change is a line of JSON: [seq, time, method, args, kwargs]. Lines
+    are written and fsynced in batches on a thread of their own, so a
+    crash loses at most the last interval seconds of changes. Every
+    snapshot_ops changes (and on close) the whole store is written to a
+    snapshot and the journal is emptied; records at or before the
+    snapshot's seq are skipped on replay, so a crash between the two
+    doesn't apply anything twice.
+    """
+
+    def __init__(self, path, interval=0.05, snapshot_ops=100000):
+        self.journal_path = path + '.journal'
+        self.snapshot_path = path + '.snapshot'
+        self.interval = interval
+        self.snapshot_ops = snapshot_ops
+
+        # Last seq handed out
+        self.seq = 0
+
+        # Records written since the last snapshot
+        self.since_snapshot = 0
+
+        self.cond = Condition()
+        self.buffer = []
+        self.closing = False
+
+        # What stopped the thread, if it failed
+        self.error = None
+
+        self.file = None
+        self.thread = None
+        self.dump = None
+
+    def load(self):
+        """ Read the snapshot and journal. Returns (snapshot state or None,
+        records after the snapshot). """
+        state = None
+        snapshot_seq = 0
+        try:
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            pass
+        else:
+            state = snapshot['state']
+            snapshot_seq = self.seq = snapshot['seq']
+
+        records = []
+        good = 0
+        try:
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('Incomplete record')
+
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # Torn by a crash mid-write; it was never synced,
+                        # so nothing after it was either
+                        logger.warning('Discarding journal from byte %d',
+                                       good)
+                        break
+
+                    good += len(line)
+                    if record[0] > snapshot_seq:
+                        records.append(record)
+                        self.seq = record[0]
+        except FileNotFoundError:
+            pass
+        else:
+            os.truncate(self.journal_path, good)
+
+        self.since_snapshot = len(records)
+        return (state, records)
+
+    def start(self, dump):
+        """ Start writing. dump is called to get (seq, state encoded as
+        JSON) for snapshots. """
+        dirname = os.path.dirname(self.journal_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        self.dump = dump
+        self.file = open(self.journal_path, 'ab')
+        self.thread = Thread(target=self._run, name='storage-journal',
+                             daemon=True)
+        self.thread.start()
+
+    def append(self, now, method, args, kwargs):
+        """ Queue a record to be written. Raises if it can't be encoded, or
+        JournalError if writing has failed, before anything is queued. """
+        line = json.dumps([self.seq + 1, now, method, args, kwargs])
+
+        with self.cond:
+            if self.error is not None:
+                raise JournalError('Journal write failed') from self.error
+
+            self.seq += 1
+            self.buffer.append(line)
+            self.cond.notify()
+
+    def _run(self):
+        try:
+            self._write_loop()
+        except Exception as e:
+            logger.exception('Journal write failed; changes are no longer '
+                             'being kept')
+            with self.cond:
+                self.error = e
+                self.buffer = []
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.buffer and not self.closing:
+                    self.cond.wait()
+
+                lines, self.buffer = self.buffer, []
+                closing = self.closing
+
+            if lines:
+                self.file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.since_snapshot += len(lines)
+
+            if closing:
+                break
+
+            if self.since_snapshot >= self.snapshot_ops:
+                self.snapshot()
+
+            if self.interval:
+                # Let the next batch build up
+                sleep(self.interval)
+
+    def snapshot(self):
+        """ Write the whole store out and empty the journal """
+        seq, state = self.dump()
+        data = '{{"seq": {}, "state": {}}}'.format(seq, state)
+
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp, self.snapshot_path)
+
+        dirname = os.path.dirname(self.snapshot_path) or '.'
+        fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        # Anything after seq is still in the buffer, since only this thread
+        # writes to the file
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+        self.since_snapshot = 0
+
+        logger.info('Journal compacted into snapshot at %d', seq)
+
+    def close(self):
+        """ Write out everything, snapshot if there's anything new, and
+        stop """
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+
+        self.thread.join()
+
+        try:
+            if self.error is not None:
+                raise JournalError('Journal write failed') from self.error
+
+            if self.since_snapshot:
+                self.snapshot()
+        finally:
+            self.file.close()
@@ -0,0 +1,163 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+""" Runs storage calls on threads, split into lanes.
+
+Reads go to a pool of reader threads, and everything else to a single
+writer thread, so a burst of writes never queues in front of reads (SQLite
+only has one writer at a time anyway). Within a lane calls are taken in
+priority order, then in the order they came in.
+"""
+
+import asyncio
+import logging
+import queue
+
+from concurrent.futures import Future
+from itertools import count
+from threading import Lock, Thread
+from time import perf_counter
+
+from server.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first
+PRIORITY_SIGNON = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Storage methods starting with these only read
+READ_PREFIXES = ('get_', 'load_')
+
+
+def is_read(method_call):
+    return method_call.startswith(READ_PREFIXES)
+
+
+class StoragePool:
+    """ A bounded pool of storage objects (and so of connections). Objects
+    are made as they're needed, up to size; after that, get waits for one
+    to be put back. """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+
+        # Most recently used first, so idle objects stay idle
+        self.free = queue.LifoQueue()
+
+        self.created = 0
+        self.created_lock = Lock()
+
+    def get(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.created_lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+
+        if not create:
+            return self.free.get()
+
+        try:
+            return self.factory()
+        except Exception:
+            with self.created_lock:
+                self.created -= 1
+
+            raise
+
+    def put(self, storage):
+        self.free.put(storage)
+
+
+class Lane:
+    """ Worker threads taking calls off one priority queue """
+
+    def __init__(self, name, threads):
+        self.name = name
+
+        # (priority, sequence, call); the sequence keeps calls of the same
+        # priority in order, and means calls are never compared
+        self.queue = queue.PriorityQueue()
+        self.seq = count()
+
+        self.wait = metrics.histogram('storage.queue_wait.' + name)
+        metrics.gauge('storage.queue_depth.' + name, self.queue.qsize)
+
+        self.threads = [Thread(target=self._run, daemon=True,
+                               name='storage-{}-{}'.format(name, n))
+                        for n in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, priority, func):
+        """ Queue func to be called on one of this lane's threads. Returns
+        a concurrent.futures.Future. """
+        loop = asyncio.get_event_loop()
+        future = Future()
+        self.queue.put((priority, next(self.seq),
+                        (loop, future, func, perf_counter())))
+        return future
+
+    def _run(self):
+        while True:
+            _, _, call = self.queue.get()
+            if call is None:
+                break
+
+            loop, future, func, queued = call
+
+            # Metrics are only touched on the loop thread
+            loop.call_soon_threadsafe(self.wait.observe,
+                                      perf_counter() - queued)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = func()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def stop(self):
+        """ Have the threads exit once everything queued is done """
+        for _ in self.threads:
+            self.queue.put((float('inf'), next(self.seq), None))
+
+
+class StorageScheduler:
+    """ The reader and writer lanes, and the storage objects they share.
+    connections bounds the number of storage objects; by default there's
+    one for each thread. """
+
+    def __init__(self, factory, readers=8, connections=None):
+        if connections is None:
+            connections = readers + 1
+
+        self.pool = StoragePool(factory, connections)
+
+        self.read = Lane('read', readers)
+        self.write = Lane('write', 1)
+
+    def threads(self):
+        return self.read.threads + self.write.threads
+
+    def submit(self, method_call, priority, func):
+        """ Call func on the lane for method_call """
+        lane = self.read if is_read(method_call) else self.write
+        return asyncio.wrap_future(lane.submit(priority, func))
+
+    def stop(self):
+        self.read.stop()
+        self.write.stop()
@@ -7,7 +7,9 @@
 import sqlite3
 
 from collections import defaultdict
-from threading import Lock
+from threading import Lock, local
+
+from server.trace import tracer
 
 
 class Counter:
@@ -65,6 +67,9 @@ class Database:
 
         self.locks = _db_locks[dbname]
 
+        # Set whilst transaction is running its function
+        self.in_transaction = False
+
     def __del__(self):
         self.conn.close()
 
@@ -81,18 +86,55 @@ class Database:
         database. """
         if func is None:
             func = self.conn.execute
-        else:
+        elif isinstance(func, str):
             func = getattr(self.conn, func)
 
+        if self.in_transaction:
+            # Part of a bigger transaction, which holds the lock
+            return func(*data)
+
+        span = tracer.thread_span()
+        if span is not None:
+            span = span.child('lock')
+
         with self.locks.waiting:
             self.locks.accessing.acquire()
 
+        if span is not None:
+            span.finish()
+            span = tracer.thread_span().child('execute')
+
         try:
             with self.conn:
                 return func(*data)
         finally:
             self.locks.accessing.release()
 
+            if span is not None:
+                span.finish()
+
+    def _executemany_all(self, statements):
+        for query, rows in statements:
+            if rows:
+                self.conn.executemany(query, rows)
+
+    def batch(self, statements):
+        """ Run several (query, rows) pairs with executemany, all in one
+        transaction """
+        return self.modify(statements, func=self._executemany_all)
+
+    def transaction(self, func, *args):
+        """ Call func(*args), with every modify, batch and read it makes
+        going into one transaction """
+        def run(*args):
+            self.in_transaction = True
+            try:
+                return func(*args)
+            finally:
+                self.in_transaction = False
+
+        return self.modify(*args, func=run)
+
     def read(self, *data, func=None):
         """ Call this if your statement reads from the database """
         if func is None:
@@ -100,15 +142,160 @@ class Database:
         else:
             func = getattr(self.conn, func)
 
+        if self.in_transaction:
+            return func(*data)
+
+        span = tracer.thread_span()
+        if span is not None:
+            span = span.child('lock')
+
         with self.locks.waiting:
             val = self.locks.nreaders.inc()
 
             if val == 1:
                 self.locks.accessing.acquire()
 
+        if span is not None:
+            span.finish()
+            span = tracer.thread_span().child('execute')
+
         try:
             return func(*data)
         finally:
             val = self.locks.nreaders.dec()
             if val == 0:
                 self.locks.accessing.release()
+
+            if span is not None:
+                span.finish()
+
+
+# Pragmas for WAL mode: fsync only at checkpoints (a crash can lose the last
+# few commits but never corrupts the database), map the first 256MiB of the
+# file, and give each connection a 16MiB page cache
+WAL_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -16384,
+}
+
+
+class WALConnections:
+    """ The per-thread connections to one database in WAL mode. Shared by
+    every WALDatabase on that file, so the number of connections is the
+    number of threads and not the number of storage objects. """
+
+    def __init__(self, dbname, pragmas):
+        self.dbname = dbname
+        self.pragmas = pragmas
+        self.local = local()
+
+        # WAL lets readers carry on whilst someone writes, but there is
+        # still only one writer; queue them here instead of in SQLite's
+        # busy handler
+        self.write_lock = Lock()
+
+        self.all_lock = Lock()
+        self.all = []
+
+    def get(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbname, timeout=30,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            for pragma, value in self.pragmas.items():
+                conn.execute('PRAGMA {}={}'.format(pragma, value))
+
+            self.local.conn = conn
+            with self.all_lock:
+                self.all.append(conn)
+
+        return conn
+
+    def close(self):
+        with self.write_lock, self.all_lock:
+            for conn in self.all:
+                conn.close()
+
+            self.all.clear()
+            self.local = local()
+
+_wal_connections = dict()
+_wal_connections_lock = Lock()
+
+
+class WALDatabase(Database):
+    """ An SQLite database in WAL mode, with the same interface as Database.
+
+    Every thread gets its own connection, so reads never wait: they see
+    the database as of the last commit, whatever the writer is doing.
+    Writes are still one at a time.
+    """
+
+    def __init__(self, dbname='data/store.db', pragmas=None):
+        if pragmas is None:
+            pragmas = WAL_PRAGMAS
+
+        with _wal_connections_lock:
+            conns = _wal_connections.get(dbname)
+            if conns is None:
+                conns = _wal_connections[dbname] = WALConnections(dbname,
+                                                                  pragmas)
+
+        self.connections = conns
+        self.in_transaction = False
+
+    def __del__(self):
+        pass
+
+    @property
+    def conn(self):
+        return self.connections.get()
+
+    def close(self):
+        self.connections.close()
+
+    def modify(self, *data, func=None):
+        conn = self.conn
+        if func is None:
+            func = conn.execute
+        elif isinstance(func, str):
+            func = getattr(conn, func)
+
+        if self.in_transaction:
+            return func(*data)
+
+        span = tracer.thread_span()
+        if span is not None:
+            span = span.child('lock')
+
+        with self.connections.write_lock:
+            if span is not None:
+                span.finish()
+                span = tracer.thread_span().child('execute')
+
+            try:
+                with conn:
+                    return func(*data)
+            finally:
+                if span is not None:
+                    span.finish()
+
+    def read(self, *data, func=None):
+        conn = self.conn
+        if func is None:
+            func = conn.execute
+        else:
+            func = getattr(conn, func)
+
+        span = tracer.thread_span()
+        if span is not None:
+            span = span.child('execute')
+
+        try:
+            return func(*data)
+        finally:
+            if span is not None:
+                span.finish()
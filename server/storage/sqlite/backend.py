@@ -20,19 +20,27 @@ class ProtocolStorage:
     inter-dependent. """
 
     BASEPATH = pathlib.Path('server', 'storage', 'sqlite')
-    SCHEMA_VER = 2
+    SCHEMA_VER = 8
 
     _initdb = False
     _init_lock = Lock()
 
-    def __init__(self, dbname):
-        self.database = atomic.Database(dbname)
+    def __init__(self, dbname, mode='wal', pragmas=None):
+        """ mode is 'wal' for a connection per thread with the database in
+        WAL mode, or 'locked' for one connection shared under a
+        readers/writer lock. pragmas are extra PRAGMA settings for WAL
+        mode. """
+        if mode == 'wal':
+            self.database = atomic.WALDatabase(dbname, pragmas)
+        else:
+            self.database = atomic.Database(dbname)
+
         self.log = getLogger(__name__ + '.ProtocolStorage')
 
         with self._init_lock:
-            if not self._initdb:
+            if not ProtocolStorage._initdb:
                 self.initalise()
-                self._initdb = True
+                ProtocolStorage._initdb = True
 
     def initalise(self):
         self.sql_file(self.BASEPATH.joinpath('schema.sql'))
@@ -44,15 +52,25 @@ class ProtocolStorage:
         self.log.info('Present schema at %d', schema_ver)
 
         if schema_ver < self.SCHEMA_VER:
-            for p in self.BASEPATH.joinpath('upgrade').rglob('*.sql'):
-                ver = int(p.name[:-4])
-                if ver >= schema_ver:
+            upgrades = self.BASEPATH.joinpath('upgrade').glob('*.sql')
+            for p in sorted(upgrades, key=lambda p: int(p.stem)):
+                ver = int(p.stem)
+                if ver > schema_ver:
                     self.log.info('Upgrading schema to version %d', ver)
                     self.sql_file(p)
 
             self.database.modify('UPDATE "version" SET "version"=?',
                                  (self.SCHEMA_VER,))
 
+    def apply(self, calls):
+        """ Make (method, args, kwargs) calls to this object, all in one
+        transaction """
+        return self.database.transaction(self._apply, calls)
+
+    def _apply(self, calls):
+        for method, args, kwargs in calls:
+            getattr(self, method)(*args, **kwargs)
+
     def sql_file(self, path):
         with path.open() as f:
             self.database.modify(f.read(), func='executescript')
@@ -61,6 +79,10 @@ class ProtocolStorage:
         c = self.database.read(queries.s_get_user, (name,))
         return c.fetchone()
 
+    def get_user_names(self):
+        c = self.database.read(queries.s_get_user_names)
+        return [row['name'] for row in c]
+
     def get_user_acl(self, name):
         c = self.database.read(queries.s_get_user_acl, (name,))
         return c.fetchall()
@@ -74,9 +96,13 @@ class ProtocolStorage:
         return c.fetchall()
 
     def get_group(self, name):
-        c = self.database.read(queries.s_get_group, (name,)),
+        c = self.database.read(queries.s_get_group, (name,))
         return c.fetchone()
 
+    def get_group_names(self):
+        c = self.database.read(queries.s_get_group_names)
+        return [row['name'] for row in c]
+
     def get_group_acl(self, name):
         c = self.database.read(queries.s_get_group_acl, (name,))
         return c.fetchall()
@@ -89,23 +115,57 @@ class ProtocolStorage:
         c = self.database.read(queries.s_get_group_property, (name,))
         return c.fetchall()
 
+    def get_group_filter(self, name):
+        c = self.database.read(queries.s_get_group_filter, (name,))
+        return c.fetchall()
+
+    def load_group(self, name):
+        """ Get a group's row, ACL's, properties and filters in one go.
+        Returns None if the group doesn't exist. """
+        group = self.get_group(name)
+        if group is None:
+            return None
+
+        return (group, self.get_group_acl(name), self.get_group_property(name),
+                self.get_group_filter(name))
+
+    def get_offline(self, name, since=0, limit=-1):
+        c = self.database.read(queries.s_get_offline, (name, since, limit))
+        return c.fetchall()
+
     def get_roster_group(self, name):
         c = self.database.read(queries.s_get_roster_group, (name,))
         return c.fetchall()
 
+    def get_roster(self, name):
+        c = self.database.read(queries.s_get_roster, (name,))
+        return c.fetchone()
+
+    def get_roster_deleted(self, name):
+        c = self.database.read(queries.s_get_roster_deleted, (name,))
+        return c.fetchall()
+
+    def load_roster(self, name):
+        """ Get a user's roster row, user entries, group entries and
+        tombstones in one go. Returns None if the user has no roster. """
+        roster = self.get_roster(name)
+        if roster is None:
+            return None
+
+        return (roster, self.get_roster_user(name),
+                self.get_roster_group(name), self.get_roster_deleted(name))
+
     def create_user(self, name, gecos, password):
-        self.log.critical('creating user')
-        c = self.database.modify(queries.s_create_user,
-                                 (name, gecos, password))
-        self.log.critical('executed with', name, gecos, password)
-        return c
+        return self.database.modify(queries.s_create_user,
+                                    (name, gecos, password))
 
-    def create_group(self, name, topic):
-        return self.database.modify(queries.s_create_group, (name, topic))
+    def create_group(self, name, topic, display=None):
+        return self.database.modify(queries.s_create_group,
+                                    (name, topic, display))
 
     def create_user_acl(self, name, acl, setter=None, reason=None):
         return self.database.modify(queries.s_create_user_acl,
-                                    (acl, name, reason))
+                                    (acl, name, setter, reason))
 
     def create_group_acl(self, name, username, acl, setter=None, reason=None):
         return self.database.modify(queries.s_create_group_acl,
@@ -119,13 +179,55 @@ class ProtocolStorage:
         return self.database.modify(queries.s_create_property_group,
                                     (property, value, name, setter))
 
-    def create_roster_user(self, name, user, alias=None, group_tag=None):
-        return self.database.modify(queries.s_create_roster_user,
-                                    (name, user, alias, group_tag))
-
-    def create_roster_group(self, name, group, alias=None, group_tag=None):
-        return self.database.modify(queries.s_create_roster_group,
-                                    (name, group, alias, group_tag))
+    def create_group_filter(self, name, kind, pattern, setter=None):
+        return self.database.modify(queries.s_create_group_filter,
+                                    (kind, pattern, name, setter))
+
+    def create_user_acls(self, name, acls):
+        """ Add (acl, setter, reason) ACL's to a user in one transaction """
+        rows = [(acl, name, setter, reason) for acl, setter, reason in acls]
+        return self.database.batch([(queries.s_create_user_acl, rows)])
+
+    def create_group_acls(self, name, acls):
+        """ Add (username, acl, setter, reason) ACL's in a group in one
+        transaction """
+        rows = [(acl, name, username, setter, reason) for username, acl,
+                setter, reason in acls]
+        return self.database.batch([(queries.s_create_group_acl, rows)])
+
+    def create_offline(self, messages, cap=None, expire=None):
+        """ Queue (name, source, body, timestamp) messages for offline
+        users, then trim each of those users' queues to the newest cap
+        messages and drop anything older than expire """
+        statements = [(queries.s_create_offline, messages)]
+
+        if cap is not None:
+            names = {m[0] for m in messages}
+            statements.append((queries.s_del_offline_over,
+                               [(n, n, cap) for n in names]))
+
+        if expire is not None:
+            statements.append((queries.s_del_offline_expired, [(expire,)]))
+
+        return self.database.batch(statements)
+
+    def create_roster_user(self, name, user, alias=None, group_tag=None,
+                           version=0):
+        return self.database.batch([
+            (queries.s_create_roster_user,
+             [(name, user, alias, group_tag, version)]),
+            (queries.s_del_roster_deleted, [(name, user)]),
+            (queries.s_set_roster_version, [(version, name)]),
+        ])
+
+    def create_roster_group(self, name, group, alias=None, group_tag=None,
+                            version=0):
+        return self.database.batch([
+            (queries.s_create_roster_group,
+             [(name, group, alias, group_tag, version)]),
+            (queries.s_del_roster_deleted, [(name, group)]),
+            (queries.s_set_roster_version, [(version, name)]),
+        ])
 
     def set_user(self, name, *, gecos=None, password=None):
         return self.database.modify(queries.s_set_user,
@@ -142,14 +244,44 @@ class ProtocolStorage:
         return self.database.modify(queries.s_set_property_group,
                                     (value, property, name))
 
-    def set_roster_user(self, name, *, alias=None, group_tag=None,
-                        blocked=None):
-        return self.database.modify(queries.s_set_roster_user,
-                                    (alias, group_tag, blocked, name))
-
-    def set_roster_group(self, name, *, alias=None, group_tag=None):
-        return self.database.modify(queries.s_set_roster_group,
-                                    (alias, group_tag, blocked, name))
+    def set_user_properties(self, name, created=(), changed=(),
+                            deleted=()):
+        """ Create (property, value, setter), change (property, value) and
+        delete property properties of a user in one transaction """
+        return self.database.batch([
+            (queries.s_create_property_user,
+             [(p, v, name, setter) for p, v, setter in created]),
+            (queries.s_set_property_user,
+             [(v, p, name) for p, v in changed]),
+            (queries.s_del_property_user, [(p, name) for p in deleted]),
+        ])
+
+    def set_group_properties(self, name, created=(), changed=(),
+                             deleted=()):
+        """ Like set_user_properties, for a group """
+        return self.database.batch([
+            (queries.s_create_property_group,
+             [(p, v, name, setter) for p, v, setter in created]),
+            (queries.s_set_property_group,
+             [(v, p, name) for p, v in changed]),
+            (queries.s_del_property_group, [(p, name) for p in deleted]),
+        ])
+
+    def set_roster_user(self, name, username, *, alias=None, group_tag=None,
+                        blocked=None, pending=None, version=0):
+        return self.database.batch([
+            (queries.s_set_roster_user,
+             [(alias, group_tag, blocked, pending, version, name, username)]),
+            (queries.s_set_roster_version, [(version, name)]),
+        ])
+
+    def set_roster_group(self, name, group, *, alias=None, group_tag=None,
+                         version=0):
+        return self.database.batch([
+            (queries.s_set_roster_group,
+             [(alias, group_tag, version, name, group)]),
+            (queries.s_set_roster_version, [(version, name)]),
+        ])
 
     def del_user(self, name):
         return self.database.modify(queries.s_del_user, (name,))
@@ -164,9 +296,26 @@ class ProtocolStorage:
         return self.database.modify(queries.s_del_group_acl,
                                     (acl, username, name))
 
+    def del_user_acls(self, name, acls):
+        return self.database.batch([(queries.s_del_user_acl,
+                                     [(acl, name) for acl in acls])])
+
+    def del_group_acls(self, name, acls):
+        """ Remove (username, acl) ACL's in a group in one transaction """
+        return self.database.batch([(queries.s_del_group_acl,
+                                     [(acl, username, name) for username, acl
+                                      in acls])])
+
     def del_group_acl_all(self, name):
         return self.database.modify(queries.s_del_group_acl_all, (name,))
 
+    def del_group_filter(self, name, kind, pattern):
+        return self.database.modify(queries.s_del_group_filter,
+                                    (kind, pattern, name))
+
+    def del_offline(self, name, last_id):
+        return self.database.modify(queries.s_del_offline, (name, last_id))
+
     def del_group(self, name):
         return self.database.modify(queries.s_del_group, (name,))
 
@@ -178,10 +327,27 @@ class ProtocolStorage:
         return self.database.modify(queries.s_del_property_group,
                                     (property, name))
 
-    def del_roster_user(self, name, username):
-        return self.database.modify(queries.s_del_roster_user,
-                                    (name, username))
-
-    def del_roster_group(self, name, group):
-        return self.database.modify(queries.s_del_roster_group,
-                                    (name, group))
+    def _del_roster_entry(self, query, name, target, version, compacted):
+        statements = [
+            (query, [(name, target)]),
+            (queries.s_create_roster_deleted, [(name, target, version)]),
+            (queries.s_set_roster_version, [(version, name)]),
+        ]
+
+        if compacted:
+            statements.extend([
+                (queries.s_set_roster_compacted, [(compacted, name)]),
+                (queries.s_del_roster_deleted_upto, [(name, compacted)]),
+            ])
+
+        return self.database.batch(statements)
+
+    def del_roster_user(self, name, username, version=0, compacted=None):
+        """ Remove a roster entry, leaving a tombstone at version. If
+        compacted is set, tombstones up to that version are dropped. """
+        return self._del_roster_entry(queries.s_del_roster_user, name,
+                                      username, version, compacted)
+
+    def del_roster_group(self, name, group, version=0, compacted=None):
+        return self._del_roster_entry(queries.s_del_roster_group, name,
+                                      group, version, compacted)
@@ -8,9 +8,10 @@
 s_get_user = 'SELECT "user".password,"user".gecos,"user".timestamp,' \
     '"user".avatar FROM "user" WHERE "user".name=? ORDER BY "user".name'
 
-s_get_user_acl = 'SELECT "acl_user".acl,"acl_user".timestamp,"setter".name ' \
-    'AS setter FROM "acl_user","user" LEFT OUTER JOIN "user" AS "setter" ' \
-    'ON "acl_user".setter_id="user2".id WHERE "user".name=? AND ' \
+s_get_user_acl = 'SELECT "acl_user".acl,"acl_user".timestamp,' \
+    '"acl_user".reason,"setter".name AS setter FROM "acl_user","user" ' \
+    'LEFT OUTER JOIN "user" AS "setter" ON "acl_user".setter_id=' \
+    '"setter".id WHERE "user".name=? AND ' \
     '"acl_user".user_id="user".id ORDER BY "acl_user".acl'
 
 s_get_user_property = 'SELECT "property_user".property,' \
@@ -21,47 +22,85 @@ s_get_user_property = 'SELECT "property_user".property,' \
 
 s_get_roster_user = 'SELECT "roster_entry_user".alias,' \
     '"roster_entry_user".group_tag,"roster_entry_user".blocked,' \
+    '"roster_entry_user".pending,"roster_entry_user".version,' \
     '"target".name FROM "roster","roster_entry_user","user","user" AS ' \
     '"target" WHERE "user".name=? AND "roster".user_id="user".id AND ' \
     '"roster".id="roster_entry_user".roster_id AND "target".id=' \
     '"roster_entry_user".user_id ORDER BY "target".name'
 
-s_get_group = 'SELECT "group".topic,"group".timestamp FROM "group" WHERE ' \
+s_get_user_names = 'SELECT "user".name FROM "user"'
+
+s_get_group = 'SELECT "group".topic,"group".timestamp,"group".display ' \
+    'FROM "group" WHERE ' \
     '"name"=?'
 
+s_get_group_names = 'SELECT IFNULL("group".display,"group".name) AS name ' \
+    'FROM "group"'
+
 s_get_group_acl = 'SELECT "acl_group".acl,"acl_group".timestamp,' \
     '"acl_group".reason,"target".name AS target,"setter".name AS setter ' \
     'FROM "acl_group","group","user" AS "target" LEFT OUTER JOIN "user" AS ' \
     '"setter" ON "acl_group".setter_id="setter".id WHERE "group".name=? ' \
-    'AND "acl_group".user_id="target".id'
+    'AND "acl_group".group_id="group".id AND "acl_group".user_id="target".id'
 
-s_get_group_acl_user = 'SELECT "acl_group".acl,"acl_group".timestamp",' \
-    '"acl_group".reason,"setter".name AS setter FROM "acl_group","user" ' \
-    'LEFT OUTER JOIN "user" as "setter" ON "acl_user".setter_id="user2".id ' \
-    'WHERE "group".name=? AND "user".name=? AND "group".id=' \
-    '"acl_group".group_id AND "user".id="acl_user".user_id ORDER BY ' \
+s_get_group_acl_user = 'SELECT "acl_group".acl,"acl_group".timestamp,' \
+    '"acl_group".reason,"setter".name AS setter FROM "acl_group","group",' \
+    '"user" LEFT OUTER JOIN "user" AS "setter" ON "acl_group".setter_id=' \
+    '"setter".id WHERE "group".name=? AND "user".name=? AND "group".id=' \
+    '"acl_group".group_id AND "user".id="acl_group".user_id ORDER BY ' \
     '"acl_group".acl'
 
 s_get_group_property = 'SELECT "property_group".property,' \
-    '"property_group".value,"property_user".timestamp,"user".name AS ' \
+    '"property_group".value,"property_group".timestamp,"user".name AS ' \
     'setter FROM "property_group","group" LEFT OUTER JOIN "user" ON ' \
-    '"property_user".setter_id="user2".id WHERE "group".name=? AND ' \
+    '"property_group".setter_id="user".id WHERE "group".name=? AND ' \
     '"group".id="property_group".group_id ORDER BY "property_group".property'
 
+s_get_group_filter = 'SELECT "filter_group".kind,"filter_group".pattern,' \
+    '"filter_group".timestamp,"setter".name AS setter FROM "filter_group",' \
+    '"group" LEFT OUTER JOIN "user" AS "setter" ON "filter_group".setter_id=' \
+    '"setter".id WHERE "group".name=? AND "filter_group".group_id=' \
+    '"group".id ORDER BY "filter_group".id'
+
+s_get_offline = 'SELECT "offline_message".id,"offline_message".source,' \
+    '"offline_message".body,"offline_message".timestamp FROM ' \
+    '"offline_message" WHERE "offline_message".user_id=(SELECT "user".id ' \
+    'FROM "user" WHERE "user".name=?) AND "offline_message".timestamp>=? ' \
+    'ORDER BY "offline_message".id LIMIT ?'
+
 s_get_roster_group = 'SELECT "roster_entry_group".alias,' \
-    '"roster_entry_group".group_tag,"group".name FROM "roster",' \
+    '"roster_entry_group".group_tag,"roster_entry_group".version,' \
+    '"group".name FROM "roster",' \
     '"roster_entry_group","user","group" WHERE "user".name=? AND ' \
     '"roster".user_id="user".id AND "roster".id=' \
     '"roster_entry_group".roster_id AND "group".id=' \
     '"roster_entry_group".group_id ORDER BY "group".name'
 
+s_get_roster = 'SELECT "roster".version,"roster".compacted FROM "roster",' \
+    '"user" WHERE "user".name=? AND "roster".user_id="user".id'
+
+s_get_roster_deleted = 'SELECT "roster_deleted".target,' \
+    '"roster_deleted".version FROM "roster_deleted" WHERE ' \
+    '"roster_deleted".roster_id=(SELECT "roster".id FROM "roster","user" ' \
+    'WHERE "user".name=? AND "roster".user_id="user".id) ORDER BY ' \
+    '"roster_deleted".version'
+
 # Creation
 s_create_user = 'INSERT INTO "user" (name,gecos,password) VALUES (?,?,?)'
 
-s_create_group = 'INSERT INTO "group" (name,topic) VALUES(?,?)'
+s_create_group = 'INSERT INTO "group" (name,topic,display) VALUES(?,?,?)'
 
-s_create_user_acl = 'INSERT INTO "acl_user" (acl,user_id,reason) VALUES(' \
-    '(SELECT ?,"user".id FROM "user" WHERE "user".name=?),?)'
+s_create_user_acl = 'INSERT INTO "acl_user" (acl,user_id,setter_id,reason) ' \
+    'VALUES(?,(SELECT "user".id FROM "user" WHERE "user".name=?),(SELECT ' \
+    '"user".id FROM "user" WHERE "user".name=?),?)'
+
+s_create_group_filter = 'INSERT INTO "filter_group" (kind,pattern,' \
+    'group_id,setter_id) VALUES(?,?,(SELECT "group".id FROM "group" WHERE ' \
+    '"group".name=?),(SELECT "user".id FROM "user" WHERE "user".name=?))'
+
+s_create_offline = 'INSERT INTO "offline_message" (user_id,source,body,' \
+    'timestamp) VALUES((SELECT "user".id FROM "user" WHERE "user".name=?),' \
+    '?,?,?)'
 
 s_create_group_acl = 'INSERT INTO "acl_group" (acl,group_id,user_id,' \
     'setter_id,reason) VALUES(?,(SELECT "group".id FROM "group" WHERE ' \
@@ -77,14 +116,18 @@ s_create_property_group = 'INSERT INTO "property_group" (property,value,' \
     '"group".name=?),(SELECT "user".id FROM "user" WHERE "user".name=?))'
 
 s_create_roster_user = 'INSERT INTO "roster_entry_user" (roster_id,user_id,' \
-    'alias,group_tag) VALUES((SELECT "roster".id FROM "roster","user" ' \
-    'WHERE "user".name=? AND "roster".user_id="user".id),(SELECT ' \
-    '"user".id FROM "user" WHERE "user".name=?),?,?)'
+    'alias,group_tag,version) VALUES((SELECT "roster".id FROM "roster",' \
+    '"user" WHERE "user".name=? AND "roster".user_id="user".id),(SELECT ' \
+    '"user".id FROM "user" WHERE "user".name=?),?,?,?)'
 
 s_create_roster_group = 'INSERT INTO "roster_entry_group" (roster_id,' \
-    'group_id,alias,group_tag) VALUES((SELECT "roster".roster_id FROM ' \
+    'group_id,alias,group_tag,version) VALUES((SELECT "roster".id FROM ' \
     '"roster","user" WHERE "user".name=? AND "roster".user_id="user".id),' \
-    '(SELECT "group".id FROM "group" WHERE "group".name=?)'
+    '(SELECT "group".id FROM "group" WHERE "group".name=?),?,?,?)'
+
+s_create_roster_deleted = 'INSERT INTO "roster_deleted" (roster_id,target,' \
+    'version) VALUES((SELECT "roster".id FROM "roster","user" WHERE ' \
+    '"user".name=? AND "roster".user_id="user".id),?,?)'
 
 # Alteration
 s_set_user = 'UPDATE "user" SET gecos=IFNULL(?,gecos),password=' \
@@ -101,13 +144,26 @@ s_set_property_group = 'UPDATE "property_group" SET value=? WHERE ' \
     '"group".id FROM "group" WHERE "group".name=?)'
 
 s_set_roster_user = 'UPDATE "roster_entry_user" SET alias=IFNULL(?,alias),' \
-    'group_tag=IFNULL(?,group_tag),blocked=IFNULL(?,blocked) WHERE ' \
-    '"roster_entry_user".roster_id=(SELECT "user".id FROM "user" WHERE ' \
-    '"user".name=?)'
+    'group_tag=IFNULL(?,group_tag),blocked=IFNULL(?,blocked),' \
+    'pending=IFNULL(?,pending),version=? WHERE ' \
+    '"roster_entry_user".roster_id=' \
+    '(SELECT "roster".id FROM "roster","user" WHERE "user".name=? AND ' \
+    '"roster".user_id="user".id) AND "roster_entry_user".user_id=(SELECT ' \
+    '"user".id FROM "user" WHERE "user".name=?)'
 
 s_set_roster_group = 'UPDATE "roster_entry_group" SET alias=IFNULL(?,alias),' \
-    'group_tag=IFNULL(?,group_tag) WHERE "roster_entry_group".roster_id=' \
-    '(SELECT "user".id FROM "user" WHERE "user".name=?)'
+    'group_tag=IFNULL(?,group_tag),version=? WHERE ' \
+    '"roster_entry_group".roster_id=' \
+    '(SELECT "roster".id FROM "roster","user" WHERE "user".name=? AND ' \
+    '"roster".user_id="user".id) AND "roster_entry_group".group_id=(SELECT ' \
+    '"group".id FROM "group" WHERE "group".name=?)'
+
+s_set_roster_version = 'UPDATE "roster" SET version=MAX(version,?) WHERE ' \
+    '"roster".user_id=(SELECT "user".id FROM "user" WHERE "user".name=?)'
+
+s_set_roster_compacted = 'UPDATE "roster" SET compacted=MAX(compacted,?) ' \
+    'WHERE "roster".user_id=(SELECT "user".id FROM "user" WHERE ' \
+    '"user".name=?)'
 
 # Deletion
 s_del_user = 'DELETE FROM "user" WHERE "user".name=?'
@@ -126,6 +182,25 @@ s_del_group_acl = 'DELETE FROM "acl_group" WHERE "acl_group".acl=? AND ' \
 s_del_group_acl_all = 'DELETE FROM "acl_group" WHERE "acl_group".group_id =' \
     '(SELECT "group".id FROM "group" WHERE "group".name=?)'
 
+s_del_group_filter = 'DELETE FROM "filter_group" WHERE ' \
+    '"filter_group".kind=? AND "filter_group".pattern=? AND ' \
+    '"filter_group".group_id=(SELECT "group".id FROM "group" WHERE ' \
+    '"group".name=?)'
+
+s_del_offline = 'DELETE FROM "offline_message" WHERE ' \
+    '"offline_message".user_id=(SELECT "user".id FROM "user" WHERE ' \
+    '"user".name=?) AND "offline_message".id<=?'
+
+# Drop all but the newest n messages for a user
+s_del_offline_over = 'DELETE FROM "offline_message" WHERE ' \
+    '"offline_message".user_id=(SELECT "user".id FROM "user" WHERE ' \
+    '"user".name=?) AND "offline_message".id<=(SELECT "o".id FROM ' \
+    '"offline_message" AS "o" WHERE "o".user_id=(SELECT "user".id FROM ' \
+    '"user" WHERE "user".name=?) ORDER BY "o".id DESC LIMIT 1 OFFSET ?)'
+
+s_del_offline_expired = 'DELETE FROM "offline_message" WHERE ' \
+    '"offline_message".timestamp<?'
+
 s_del_group = 'DELETE FROM "group" WHERE "group".name=?'
 
 s_del_property_user = 'DELETE FROM "property_user" WHERE ' \
@@ -147,3 +222,13 @@ s_del_roster_group = 'DELETE FROM "roster_entry_group" WHERE ' \
     '"user" WHERE "user".name=? AND "user".id="roster".user_id) AND ' \
     '"roster_entry_group".group_id=(SELECT "group".id FROM "group" WHERE ' \
     '"group".name=?)'
+
+s_del_roster_deleted = 'DELETE FROM "roster_deleted" WHERE ' \
+    '"roster_deleted".roster_id=(SELECT "roster".id FROM "roster","user" ' \
+    'WHERE "user".name=? AND "roster".user_id="user".id) AND ' \
+    '"roster_deleted".target=?'
+
+s_del_roster_deleted_upto = 'DELETE FROM "roster_deleted" WHERE ' \
+    '"roster_deleted".roster_id=(SELECT "roster".id FROM "roster","user" ' \
+    'WHERE "user".name=? AND "roster".user_id="user".id) AND ' \
+    '"roster_deleted".version<=?'
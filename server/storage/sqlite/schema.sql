@@ -35,6 +35,7 @@ CREATE TABLE IF NOT EXISTS 'property_user' (
     UNIQUE(property, user_id)
 );
 
+-- The display column is added by upgrade/8.sql
 CREATE TABLE IF NOT EXISTS 'group' (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name VARCHAR(48) UNIQUE NOT NULL,
@@ -73,6 +74,38 @@ CREATE TABLE IF NOT EXISTS 'property_group' (
     UNIQUE(property, group_id)
 );
 
+CREATE TABLE IF NOT EXISTS 'filter_group' (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind VARCHAR(16) NOT NULL,
+    pattern VARCHAR(200) NOT NULL,
+    group_id INTEGER NOT NULL,
+    setter_id INTEGER,
+    timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+    FOREIGN KEY(group_id) REFERENCES 'group(id)' ON DELETE CASCADE ON UPDATE
+        CASCADE,
+    FOREIGN KEY(setter_id) REFERENCES 'user(id)' ON DELETE SET NULL ON
+        UPDATE CASCADE,
+    UNIQUE(kind, pattern, group_id)
+);
+
+CREATE TABLE IF NOT EXISTS 'offline_message' (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    source VARCHAR(48) NOT NULL,
+    body TEXT NOT NULL,
+    timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+    FOREIGN KEY(user_id) REFERENCES 'user(id)' ON DELETE CASCADE ON UPDATE
+        CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS 'offline_message_user' ON 'offline_message' (
+    user_id, id
+);
+
+CREATE INDEX IF NOT EXISTS 'offline_message_timestamp' ON
+    'offline_message' (timestamp);
+
+-- The version columns of the roster tables are added by upgrade/6.sql
 CREATE TABLE IF NOT EXISTS 'roster' (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
@@ -109,14 +142,50 @@ CREATE TABLE IF NOT EXISTS 'roster_entry_group' (
     UNIQUE(group_id, roster_id)
 );
 
+CREATE TABLE IF NOT EXISTS 'roster_deleted' (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    roster_id INTEGER NOT NULL,
+    target VARCHAR(48) NOT NULL,
+    version INTEGER NOT NULL,
+    FOREIGN KEY(roster_id) REFERENCES 'roster(id)' ON DELETE CASCADE ON UPDATE
+        CASCADE,
+    UNIQUE(roster_id, target) ON CONFLICT REPLACE
+);
+
+-- Also in upgrade/7.sql
+CREATE INDEX IF NOT EXISTS 'acl_user_user' ON 'acl_user' (user_id, acl);
+
+CREATE INDEX IF NOT EXISTS 'acl_group_group' ON 'acl_group' (
+    group_id, user_id, acl
+);
+
+CREATE INDEX IF NOT EXISTS 'property_user_user' ON 'property_user' (
+    user_id, property
+);
+
+CREATE INDEX IF NOT EXISTS 'property_group_group' ON 'property_group' (
+    group_id, property
+);
+
+CREATE INDEX IF NOT EXISTS 'filter_group_group' ON 'filter_group' (
+    group_id, id
+);
+
+CREATE INDEX IF NOT EXISTS 'roster_entry_user_roster' ON
+    'roster_entry_user' (roster_id, user_id);
+
+CREATE INDEX IF NOT EXISTS 'roster_entry_group_roster' ON
+    'roster_entry_group' (roster_id, group_id);
+
+CREATE INDEX IF NOT EXISTS 'roster_deleted_roster' ON 'roster_deleted' (
+    roster_id, version
+);
+
 CREATE TRIGGER IF NOT EXISTS "user_create_trigger" AFTER INSERT ON "user"
 BEGIN
-    INSERT INTO "roster" (user_id) VALUES (NEW.user_id);
+    INSERT INTO "roster" (user_id) VALUES (NEW.id);
 END;
 
--- Ugh I botched updates. :(
-DROP TABLE IF EXISTS 'version';
-
 CREATE TABLE IF NOT EXISTS 'version' (
     id INTEGER PRIMARY KEY ON CONFLICT IGNORE,
     version INTEGER UNIQUE DEFAULT (2)
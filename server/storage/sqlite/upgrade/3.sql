@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS 'filter_group' (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind VARCHAR(16) NOT NULL,
+    pattern VARCHAR(200) NOT NULL,
+    group_id INTEGER NOT NULL,
+    setter_id INTEGER,
+    timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+    FOREIGN KEY(group_id) REFERENCES 'group(id)' ON DELETE CASCADE ON UPDATE
+        CASCADE,
+    FOREIGN KEY(setter_id) REFERENCES 'user(id)' ON DELETE SET NULL ON
+        UPDATE CASCADE,
+    UNIQUE(kind, pattern, group_id)
+);
@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS 'offline_message' (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    source VARCHAR(48) NOT NULL,
+    body TEXT NOT NULL,
+    timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),
+    FOREIGN KEY(user_id) REFERENCES 'user(id)' ON DELETE CASCADE ON UPDATE
+        CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS 'offline_message_user' ON 'offline_message' (
+    user_id, id
+);
+
+CREATE INDEX IF NOT EXISTS 'offline_message_timestamp' ON
+    'offline_message' (timestamp);
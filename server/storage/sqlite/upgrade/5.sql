@@ -0,0 +1,10 @@
+-- The trigger used to refer to a column that doesn't exist, so no user
+-- ever got a roster
+DROP TRIGGER IF EXISTS "user_create_trigger";
+
+CREATE TRIGGER IF NOT EXISTS "user_create_trigger" AFTER INSERT ON "user"
+BEGIN
+    INSERT INTO "roster" (user_id) VALUES (NEW.id);
+END;
+
+INSERT OR IGNORE INTO "roster" (user_id) SELECT "user".id FROM "user";
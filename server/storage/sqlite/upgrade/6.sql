@@ -0,0 +1,19 @@
+-- Roster versions, for roster-sync. Every change bumps the roster's
+-- version and stamps the entry with it; deleted entries leave a tombstone
+-- until they're compacted away.
+ALTER TABLE 'roster' ADD COLUMN version INTEGER NOT NULL DEFAULT (0);
+ALTER TABLE 'roster' ADD COLUMN compacted INTEGER NOT NULL DEFAULT (0);
+ALTER TABLE 'roster_entry_user' ADD COLUMN version INTEGER NOT NULL DEFAULT
+    (0);
+ALTER TABLE 'roster_entry_group' ADD COLUMN version INTEGER NOT NULL DEFAULT
+    (0);
+
+CREATE TABLE IF NOT EXISTS 'roster_deleted' (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    roster_id INTEGER NOT NULL,
+    target VARCHAR(48) NOT NULL,
+    version INTEGER NOT NULL,
+    FOREIGN KEY(roster_id) REFERENCES 'roster(id)' ON DELETE CASCADE ON UPDATE
+        CASCADE,
+    UNIQUE(roster_id, target) ON CONFLICT REPLACE
+);
@@ -0,0 +1,31 @@
+-- Indexes for looking things up by their owner. The UNIQUE constraints
+-- lead with the ACL or property name, so they can't be used for "all of
+-- this user's ACL's" and the like; these lead with the owner, and carry
+-- the column results are ordered by so there's no sort either.
+CREATE INDEX IF NOT EXISTS 'acl_user_user' ON 'acl_user' (user_id, acl);
+
+CREATE INDEX IF NOT EXISTS 'acl_group_group' ON 'acl_group' (
+    group_id, user_id, acl
+);
+
+CREATE INDEX IF NOT EXISTS 'property_user_user' ON 'property_user' (
+    user_id, property
+);
+
+CREATE INDEX IF NOT EXISTS 'property_group_group' ON 'property_group' (
+    group_id, property
+);
+
+CREATE INDEX IF NOT EXISTS 'filter_group_group' ON 'filter_group' (
+    group_id, id
+);
+
+CREATE INDEX IF NOT EXISTS 'roster_entry_user_roster' ON
+    'roster_entry_user' (roster_id, user_id);
+
+CREATE INDEX IF NOT EXISTS 'roster_entry_group_roster' ON
+    'roster_entry_group' (roster_id, group_id);
+
+CREATE INDEX IF NOT EXISTS 'roster_deleted_roster' ON 'roster_deleted' (
+    roster_id, version
+);
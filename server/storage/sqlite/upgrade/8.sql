@@ -0,0 +1,3 @@
+-- Groups keep the name they were created with for display; "name" is the
+-- canonical key they're looked up by
+ALTER TABLE 'group' ADD COLUMN display VARCHAR(48);
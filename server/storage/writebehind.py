@@ -0,0 +1,161 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import asyncio
+import logging
+
+from collections import OrderedDict
+from itertools import count
+
+from server.metrics import metrics
+from server.storage.scheduler import PRIORITY_BULK
+
+logger = logging.getLogger(__name__)
+
+writes_queued = metrics.counter('storage.writes_queued')
+writes_coalesced = metrics.counter('storage.writes_coalesced')
+flush_errors = metrics.counter('storage.flush_errors')
+flush_latency = metrics.histogram('storage.flush_latency')
+flush_size = metrics.histogram('storage.flush_size')
+
+
+class WriteBehind:
+    """ Collects storage writes and commits them together.
+
+    Writes are held for up to interval seconds, or until max_ops are
+    waiting, and then made in one transaction (see the backend's apply).
+    A write given a coalesce key replaces any waiting write with the same
+    method and key, so setting the same thing twice in a row only writes
+    the last value. Only one flush runs at a time.
+
+    If a flush fails, its writes are retried one at a time so that one bad
+    write doesn't take the rest with it. Failures are logged and counted,
+    and raised to anyone waiting on the write.
+    """
+
+    def __init__(self, storage, interval=0.05, max_ops=256):
+        self.storage = storage
+        self.interval = interval
+        self.max_ops = max_ops
+
+        # Key -> (method, args, kwargs, future)
+        self.pending = OrderedDict()
+        self.ids = count()
+
+        self.handle = None
+        self.flushing = None
+
+    def write(self, method, *args, coalesce=None, **kwargs):
+        """ Queue a call to a storage method. Returns a future that's done
+        when the write is committed. """
+        writes_queued.inc()
+        future = asyncio.Future()
+
+        if coalesce is None:
+            key = next(self.ids)
+        else:
+            key = (method, coalesce)
+            old = self.pending.pop(key, None)
+            if old is not None:
+                # Whoever waited on the old write waits on this one instead
+                writes_coalesced.inc()
+                future.add_done_callback(lambda f, old=old[3]:
+                                         self._settle(old, f.exception()))
+
+        # Moved to the end, so it still comes after anything queued since
+        self.pending[key] = (method, args, kwargs, future)
+
+        if len(self.pending) >= self.max_ops:
+            self.flush()
+        elif self.handle is None:
+            loop = asyncio.get_event_loop()
+            self.handle = loop.call_later(self.interval, self.flush)
+
+        return future
+
+    @staticmethod
+    def _settle(future, exc=None):
+        if future.done():
+            return
+
+        if exc is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exc)
+
+            # Already logged; don't complain again if nobody was waiting
+            future.exception()
+
+    def flush(self):
+        """ Start committing what's waiting. Returns the flush's future, or
+        None if there's nothing to do. """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.flushing is not None and not self.flushing.done():
+            # Picked up when the current flush finishes
+            return self.flushing
+
+        if not self.pending:
+            return None
+
+        batch = list(self.pending.values())
+        self.pending = OrderedDict()
+
+        self.flushing = asyncio.async(self._flush(batch))
+        return self.flushing
+
+    @asyncio.coroutine
+    def _flush(self, batch):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+
+        flush_size.observe(len(batch))
+
+        try:
+            yield from self.storage.call_at(PRIORITY_BULK, 'apply',
+                                            [(m, a, k) for m, a, k, _
+                                             in batch])
+        except Exception:
+            flush_errors.inc()
+            logger.error('Flush of %d writes failed, retrying them one by '
+                         'one', len(batch))
+
+            for method, args, kwargs, future in batch:
+                try:
+                    yield from self.storage.call_at(PRIORITY_BULK, method,
+                                                    *args, **kwargs)
+                except Exception as e:
+                    self._settle(future, e)
+                else:
+                    self._settle(future)
+        else:
+            for *_, future in batch:
+                self._settle(future)
+        finally:
+            flush_latency.observe(loop.time() - start)
+
+            if self.pending:
+                if len(self.pending) >= self.max_ops:
+                    loop.call_soon(self.flush)
+                elif self.handle is None:
+                    self.handle = loop.call_later(self.interval, self.flush)
+
+    @asyncio.coroutine
+    def close(self):
+        """ Flush until nothing is left """
+        while True:
+            if self.flushing is not None and not self.flushing.done():
+                yield from asyncio.wait([self.flushing])
+            elif self.pending:
+                self.flush()
+            else:
+                break
+
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
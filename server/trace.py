@@ -0,0 +1,119 @@
+# coding=utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import threading
+
+from collections import deque
+from itertools import count
+from random import random
+from time import perf_counter
+
+
+class Span:
+    """ A timed section of work, with child spans for the pieces of it """
+
+    __slots__ = ['name', 'start', 'end', 'children']
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = perf_counter() if start is None else start
+        self.end = None
+        self.children = []
+
+    def child(self, name, start=None):
+        span = Span(name, start)
+        # list.append is atomic, so storage threads can do this too
+        self.children.append(span)
+        return span
+
+    def finish(self, end=None):
+        self.end = perf_counter() if end is None else end
+
+    def rows(self, trace_id, base, parent=0, ids=None):
+        """ Flatten into (trace, id, parent, name, offset, duration) rows,
+        times in microseconds from base. Unfinished spans have no duration.
+        """
+        if ids is None:
+            ids = count(1)
+
+        span_id = next(ids)
+        duration = None
+        if self.end is not None:
+            duration = round((self.end - self.start) * 1e6)
+
+        yield (trace_id, span_id, parent, self.name,
+               round((self.start - base) * 1e6), duration)
+
+        for child in list(self.children):
+            yield from child.rows(trace_id, base, span_id, ids)
+
+
+class Tracer:
+    """ Samples inbound frames and follows them through the server.
+
+    On the event loop thread, current is the span of whatever traced
+    coroutine is running right now (see run). Storage threads find theirs in
+    thread_span(). Finished traces go into a ring buffer.
+    """
+
+    def __init__(self, sample_rate=0.01, size=256):
+        self.sample_rate = sample_rate
+        self.traces = deque(maxlen=size)
+        self.ids = count(1)
+
+        self.current = None
+        self.local = threading.local()
+
+    def configure(self, sample_rate, size):
+        self.sample_rate = sample_rate
+        self.traces = deque(self.traces, maxlen=size)
+
+    def sample(self, name):
+        """ Get a root span for a new trace, or None if not sampled """
+        if not self.sample_rate or random() >= self.sample_rate:
+            return None
+
+        return Span(name)
+
+    def record(self, span):
+        self.traces.append((next(self.ids), span))
+
+    def thread_span(self):
+        return getattr(self.local, 'span', None)
+
+    def set_thread_span(self, span):
+        self.local.span = span
+
+    def run(self, coro, span):
+        """ Drive coro, making span current whenever it's running """
+        value = exc = None
+        while True:
+            prev = self.current
+            self.current = span
+            try:
+                if exc is None:
+                    yielded = coro.send(value)
+                else:
+                    yielded = coro.throw(exc)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.current = prev
+
+            try:
+                value = yield yielded
+                exc = None
+            except BaseException as e:
+                value = None
+                exc = e
+
+    def rows(self):
+        """ Flatten every buffered trace (see Span.rows) """
+        for trace_id, span in list(self.traces):
+            yield from span.rows(trace_id, span.start)
+
+
+tracer = Tracer()
@@ -4,36 +4,38 @@
 # under the terms of the Do What The Fuck You Want To Public License, Version
 # 2, as published by Sam Hocevar. See the LICENSE file for more details.
 
-import asyncio
-
+from sys import intern
 from time import time
 
+from server.names import canonical
 from server.property import UserPropertySet
 from server.acl import UserACLSet
-from server.roster import RosterSet
+from server.roster import LazyRoster
 
 
 class User:
+    """ A registered user.
+
+    Users are slotted and their ACL, property and roster sets are only made
+    when first used, since most of the online population never has any and
+    there may be a great many users online.
+    """
+
+    __slots__ = ['server', 'name', 'key', '_gecos', '_password', '_acl',
+                 '_property', '_roster', 'options', 'sessions', 'groups',
+                 'signon', '__weakref__']
+
     def __init__(self, server, name, gecos, password, acl=None, property=None,
-                 roster=None, options=[]):
+                 roster=None, options=()):
         self.server = server
-        self.name = name
+        self.name = intern(name)
+        self.key = canonical(name)
         self._gecos = gecos
         self._password = password
 
-        if acl is None:
-            self.acl = UserACLSet(server, name)
-
-        self.acl = acl
-
-        if property is None:
-            property = UserPropertySet(server, name)
-
-        if roster is None:
-            roster = RosterSet(server, name)
-
-        self.property = property
-        self.roster = roster
+        self._acl = acl
+        self._property = property
+        self._roster = roster
         self.options = options  # TODO
 
         self.sessions = set()
@@ -41,6 +43,22 @@ class User:
 
         self.signon = round(time())
 
+    @property
+    def acl(self):
+        if self._acl is None:
+            self._acl = UserACLSet(self.server, self.key)
+
+        return self._acl
+
+    @property
+    def roster(self):
+        """ A LazyRoster; use (yield from user.roster.load()) to get at the
+        entries """
+        if self._roster is None:
+            self._roster = LazyRoster(self.server, self.key)
+
+        return self._roster
+
     @property
     def gecos(self):
         return self._gecos
@@ -48,8 +66,8 @@ class User:
     @gecos.setter
     def gecos(self, value):
         self._gecos = value
-        asyncio.async(self.server.proto_store.set_user(self.name.lower(),
-                      gecos=value))
+        self.server.proto_store.write('set_user', self.key, gecos=value,
+                                      coalesce=(self.key, 'gecos'))
 
     @property
     def password(self):
@@ -59,8 +77,8 @@ class User:
     def password(self, value):
         self._password = value
 
-        asyncio.async(self.server.proto_store.set_user(self.name.lower(),
-                      password=value))
+        self.server.proto_store.write('set_user', self.key, password=value,
+                                      coalesce=(self.key, 'password'))
 
     def send(self, source, target, command, kval=None):
         if kval is None:
@@ -73,5 +91,20 @@ class User:
         for proto in self.sessions:
             proto.send_multipart(source, target, command, keys, kval)
 
+    def error(self, command, reason, fatal=True, extargs=None, source=None):
+        """ Send an error to all of the user's sessions. Errors in reply to
+        a command go to the session that sent it instead. """
+        for proto in list(self.sessions):
+            proto.error(command, reason, fatal, extargs, source)
+
     def message(self, source, message):
         self.send(source, self, 'message', {'body': message})
+
+    def _get_property(self):
+        if self._property is None:
+            self._property = UserPropertySet(self.server, self.key)
+
+        return self._property
+
+    # Last, so it doesn't hide the property builtin from the rest of the class
+    property = property(_get_property)
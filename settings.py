@@ -67,6 +67,17 @@ class MinnowSettings(object):
         self.cert_file_path = self._config['server'].get('cert_file',
                                                          'cert.pem')
 
+        # How long a dropped session can be resumed for (0 to disable), and
+        # how many writes to it are kept meanwhile
+        self.resume_grace = self._config['server'].getint('resume_grace', 120)
+        self.resume_buffer = self._config['server'].getint('resume_buffer',
+                                                           256)
+
+        # Messages kept for each offline user, and for how many seconds
+        self.offline_cap = self._config['server'].getint('offline_cap', 100)
+        self.offline_expiry = self._config['server'].getint('offline_expiry',
+                                                            604800)
+
         # storage settings
         provider_name = self._config['storage'].get('backend', 'sqlite')
         module = __import__('server.storage', globals(), locals(),
@@ -74,10 +85,42 @@ class MinnowSettings(object):
         self.store_backend = getattr(module, provider_name).backend.ProtocolStorage
         self.store_backend_args = ('data/store.db',)  # XXX TODO bad
 
+        if provider_name == 'sqlite':
+            # 'wal' (a connection per storage thread, and reads never wait
+            # for writes) or 'locked' (one connection behind a lock)
+            mode = self._config['storage'].get('sqlite_mode', 'wal')
+            pragmas = {
+                'synchronous': self._config['storage'].get(
+                    'sqlite_synchronous', 'NORMAL'),
+                'mmap_size': self._config['storage'].getint(
+                    'sqlite_mmap_size', 268435456),
+                'cache_size': self._config['storage'].getint(
+                    'sqlite_cache_size', -16384),
+            }
+            self.store_backend_args += (mode, pragmas)
+        elif provider_name == 'memory':
+            # Everything is kept in memory. Changes go to data/store.journal,
+            # fsynced every memory_sync_interval seconds, and every
+            # memory_snapshot_ops changes it's compacted into
+            # data/store.snapshot
+            self.store_backend_args = (
+                'data/store',
+                self._config['storage'].getfloat('memory_sync_interval',
+                                                 0.05),
+                self._config['storage'].getint('memory_snapshot_ops',
+                                               100000),
+            )
+
         # debug settings
         level = self._config['logging'].get('level', 'DEBUG').upper()
         self.log_level = getattr(logging, level)
 
+        # Fraction of inbound frames to trace, and how many traces to keep
+        self.trace_sample_rate = self._config['logging'].getfloat(
+            'trace_sample_rate', 0.01)
+        self.trace_buffer = self._config['logging'].getint('trace_buffer',
+                                                           256)
+
         # performance settings
         cache = self._config['performance'].get('max_cache', '1024')
         if cache.lower()[:2] == 'no':
@@ -85,5 +128,54 @@ class MinnowSettings(object):
         else:
             self.max_cache = int(cache)
 
+        # Event loop lag (in seconds) at which we start shedding load, in
+        # order: defer new connections, reject expensive commands, stretch
+        # ping deadlines
+        lag = self._config['performance'].get('lag_thresholds',
+                                              '0.1, 0.25, 0.5')
+        self.lag_thresholds = tuple(float(t) for t in lag.split(','))
+        if len(self.lag_thresholds) > 3:
+            raise ValueError('lag_thresholds takes at most 3 values, one '
+                             'per shedding level')
+        self.lag_interval = self._config['performance'].getfloat(
+            'lag_interval', 0.25)
+        self.shed_retry_after = self._config['performance'].getint(
+            'shed_retry_after', 30)
+
+        # Writes are committed together every write_flush_interval seconds,
+        # or as soon as write_flush_ops are waiting
+        self.write_flush_interval = self._config['performance'].getfloat(
+            'write_flush_interval', 0.05)
+        self.write_flush_ops = self._config['performance'].getint(
+            'write_flush_ops', 256)
+
+        # Threads serving storage reads (writes get one thread of their
+        # own), and how many storage connections they may have open between
+        # them (0 for one per thread)
+        self.storage_readers = self._config['performance'].getint(
+            'storage_readers', 8)
+        self.storage_connections = self._config['performance'].getint(
+            'storage_connections', 0) or None
+
+        # Seconds a group can sit empty before it's dropped from memory
+        self.group_idle_timeout = self._config['performance'].getint(
+            'group_idle_timeout', 300)
+
+        # Messages kept in memory per group, how many are replayed on
+        # group-enter, and how big each group's spill file may grow (in
+        # bytes, 0 to keep scrollback in memory only)
+        self.scrollback_size = self._config['performance'].getint(
+            'scrollback_size', 100)
+        self.scrollback_join = self._config['performance'].getint(
+            'scrollback_join', 25)
+        self.scrollback_spill = self._config['performance'].getint(
+            'scrollback_spill', 1048576)
+        self.scrollback_dir = 'data/scrollback'
+
+        # Seconds to collect group membership changes for clients that
+        # negotiated group-delta; other clients get each change right away
+        self.group_delta_window = self._config['performance'].getfloat(
+            'group_delta_window', 0.25)
+
 cfg_path = os.path.join(_determine_prefix(), '/etc/minnow/minnow.conf')
 sys.modules[__name__] = MinnowSettings(['minnow.conf', cfg_path])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+""" Measure how much memory each online user costs """
+
+import sys
+import argparse
+import gc
+import tracemalloc
+
+from pathlib import Path
+basedir = Path(__file__).resolve().parent.parent
+sys.path.append(str(basedir))
+
+from server.user import User
+from server.group import Group
+from server.names import NameRegistry
+
+
+class FakeServer:
+    """ Just enough server for User and Group """
+
+    proto_store = None
+
+    def __init__(self):
+        self.group_manager = self
+
+    def scrollback(self, key):
+        return None
+
+
+def measure(count, groups, members):
+    server = FakeServer()
+    online = NameRegistry()
+    group_list = []
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for i in range(count):
+        name = 'User{}'.format(i)
+        online[name] = User(server, name, name, '*')
+
+    after_users = tracemalloc.get_traced_memory()[0]
+
+    for i in range(groups):
+        group = Group(server, '#group{}'.format(i))
+        group_list.append(group)
+
+    users = list(online.values())
+    for i, user in enumerate(users):
+        for j in range(members):
+            group = group_list[(i + j) % groups]
+            group.users.add(user)
+            user.groups.add(group)
+
+    after_groups = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return ((after_users - before) / count,
+            (after_groups - after_users) / count)
+
+
+parser = argparse.ArgumentParser(description='Measure memory per online user')
+parser.add_argument('--users', type=int, default=200000,
+                    help='Online users to create')
+parser.add_argument('--groups', type=int, default=1000,
+                    help='Groups to spread them across')
+parser.add_argument('--memberships', type=int, default=3,
+                    help='Groups each user is in')
+
+args = parser.parse_args()
+
+per_user, per_membership = measure(args.users, args.groups, args.memberships)
+print('{} users: {:.0f} bytes/user, {:.0f} bytes/user for {} group '
+      'memberships'.format(args.users, per_user, per_membership,
+                           args.memberships))
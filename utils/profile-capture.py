@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import socket
+import sys
+import argparse
+
+from pathlib import Path
+basedir = Path(__file__).resolve().parent.parent
+sys.path.append(str(basedir))
+
+import settings
+
+from server.parser import JSONFrame, MAXFRAME
+
+
+def process_multipart(sock, command):
+    """ Read frames until the end of a reply for command """
+    frames = []
+    data = b''
+    while True:
+        data += sock.recv(MAXFRAME * 4)
+        *lines, data = data.split(JSONFrame.terminator)
+        for line in lines:
+            if not line:
+                continue
+
+            frame = JSONFrame.parse(line + JSONFrame.terminator)
+            frames.append(frame)
+
+            if frame.command == 'error':
+                return frames
+
+            if frame.command == command:
+                multipart = frame.kval.get('multipart')
+                if multipart is None or multipart == ['*']:
+                    return frames
+
+
+parser = argparse.ArgumentParser(description='Profile the running server')
+parser.add_argument('--seconds', type=float, default=10,
+                    help="How long to profile for")
+parser.add_argument('--interval', type=float, default=5,
+                    help="Sampling interval in milliseconds")
+parser.add_argument('--pstats', action='store_true',
+                    help="Use cProfile on the event loop thread instead of "
+                    "sampling")
+
+args = parser.parse_args()
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+path = str(basedir.joinpath(settings.unix_path))
+sock.connect(path)
+
+kwds = {
+    'seconds': [str(args.seconds)],
+    'interval': [str(args.interval)],
+    'format': ['pstats' if args.pstats else 'collapsed'],
+}
+
+print('Profiling for', args.seconds, 'seconds')
+sock.sendall(bytes(JSONFrame('*', '*', 'profile', kwds)))
+resp = process_multipart(sock, 'profile')
+
+for frame in resp:
+    if frame.command == 'error':
+        print('Error:', frame.kval.get('reason'), file=sys.stderr)
+        quit(1)
+
+    if 'path' in frame.kval:
+        print('Written to', frame.kval['path'][0])
+
+    for context, samples in zip(frame.kval.get('context', []),
+                                frame.kval.get('samples', [])):
+        print('{:>8} {}'.format(samples, context))
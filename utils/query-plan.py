@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+""" Check every statement in the SQLite backend's queries uses an index.
+
+A database is built with the current schema and filled with synthetic data,
+then each query is run through EXPLAIN QUERY PLAN. Any step that scans a
+whole table (or a whole index, which is no better) is reported, and the
+exit status is 1 if there were any.
+"""
+
+import os
+import sys
+import argparse
+import random
+import re
+import tempfile
+
+from pathlib import Path
+basedir = Path(__file__).resolve().parent.parent
+sys.path.append(str(basedir))
+os.chdir(str(basedir))
+
+from server.storage.sqlite import backend, queries
+
+# A pass over a whole table, or a whole index
+scan = re.compile(r'^SCAN ')
+
+# Queries that are meant to read everything
+FULL_SCANS = {'s_get_user_names', 's_get_group_names'}
+
+USER_ACLS = ['user:auspex', 'user:grant', 'user:ban', 'group:override']
+GROUP_ACLS = ['user:op', 'user:voice', 'group:topic', 'grant:*']
+
+
+def populate(store, users, groups):
+    """ Fill the database up, all in one transaction """
+    rnd = random.Random(0)
+    user_names = ['user{}'.format(i) for i in range(users)]
+    group_names = ['#group{}'.format(i) for i in range(groups)]
+
+    def rows(n, make):
+        return [make() for _ in range(n)]
+
+    def user():
+        return rnd.choice(user_names)
+
+    def group():
+        return rnd.choice(group_names)
+
+    statements = [
+        (queries.s_create_user, [(n, 'Synthetic', '*') for n in user_names]),
+        (queries.s_create_group, [(n.lower(), 'Topic', n)
+                                  for n in group_names]),
+        ('INSERT OR IGNORE ' + queries.s_create_user_acl[7:],
+         rows(users // 2, lambda: (rnd.choice(USER_ACLS), user(), user(),
+                                   None))),
+        ('INSERT OR IGNORE ' + queries.s_create_group_acl[7:],
+         rows(users * 2, lambda: (rnd.choice(GROUP_ACLS), group(), user(),
+                                  user(), None))),
+        ('INSERT OR IGNORE ' + queries.s_create_property_user[7:],
+         rows(users, lambda: ('prop{}'.format(rnd.randrange(5)), 'v',
+                              user(), user()))),
+        ('INSERT OR IGNORE ' + queries.s_create_property_group[7:],
+         rows(groups * 3, lambda: ('prop{}'.format(rnd.randrange(5)), 'v',
+                                   group(), user()))),
+        ('INSERT OR IGNORE ' + queries.s_create_group_filter[7:],
+         rows(groups, lambda: ('literal', 'spam{}'.format(rnd.randrange(9)),
+                               group(), user()))),
+        ('INSERT OR IGNORE ' + queries.s_create_roster_user[7:],
+         rows(users * 5, lambda: (user(), user(), None, None, 1))),
+        ('INSERT OR IGNORE ' + queries.s_create_roster_group[7:],
+         rows(users, lambda: (user(), group(), None, None, 1))),
+        (queries.s_create_roster_deleted,
+         rows(users, lambda: (user(), user(), 1))),
+        (queries.s_create_offline,
+         rows(users * 2, lambda: (user(), user(), '["hi"]', 0))),
+    ]
+
+    store.database.batch(statements)
+    store.database.modify('ANALYZE')
+
+
+def check(store, verbose=False):
+    """ Get (name, plan step) for every step that scans a table """
+    failures = []
+    for name in sorted(dir(queries)):
+        if not name.startswith('s_'):
+            continue
+
+        query = getattr(queries, name)
+        params = ['x'] * query.count('?')
+
+        try:
+            plan = store.database.read('EXPLAIN QUERY PLAN ' + query,
+                                       params).fetchall()
+        except Exception as e:
+            failures.append((name, 'does not compile: {}'.format(e)))
+            continue
+
+        if verbose:
+            print(name)
+
+        for row in plan:
+            detail = row[-1]
+            if verbose:
+                print('    ' + detail)
+
+            if scan.match(detail) and name not in FULL_SCANS:
+                failures.append((name, detail))
+
+    return failures
+
+
+parser = argparse.ArgumentParser(description='Check queries use indexes')
+parser.add_argument('--users', type=int, default=20000,
+                    help='Synthetic users to create')
+parser.add_argument('--groups', type=int, default=2000,
+                    help='Synthetic groups to create')
+parser.add_argument('-v', '--verbose', action='store_true',
+                    help='Print every query plan')
+
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmp:
+    store = backend.ProtocolStorage(os.path.join(tmp, 'plan.db'))
+    populate(store, args.users, args.groups)
+    failures = check(store, args.verbose)
+
+for name, detail in failures:
+    print('{}: {}'.format(name, detail))
+
+if failures:
+    print('{} table scans found'.format(len(failures)))
+    sys.exit(1)
+
+print('All queries use indexes')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+""" Compare concurrent read throughput of the SQLite storage modes, with a
+writer running alongside the readers """
+
+import os
+import sys
+import argparse
+import tempfile
+import threading
+
+from time import perf_counter, sleep
+from pathlib import Path
+basedir = Path(__file__).resolve().parent.parent
+sys.path.append(str(basedir))
+os.chdir(str(basedir))
+
+from server.storage.sqlite import backend
+
+
+def populate(dbname, users):
+    store = backend.ProtocolStorage(dbname, 'locked')
+    for i in range(users):
+        store.create_user('user{}'.format(i), 'Bench user', '*')
+
+    store.database.close()
+
+
+def run(dbname, mode, users, readers, seconds, write_delay):
+    # Every thread gets its own storage object, as in the executor pool
+    stop = threading.Event()
+    counts = [0] * readers
+    writes = [0]
+
+    def reader(n):
+        store = backend.ProtocolStorage(dbname, mode)
+        i = n
+        while not stop.is_set():
+            store.get_user('user{}'.format(i % users))
+            counts[n] += 1
+            i += readers
+
+    def writer():
+        store = backend.ProtocolStorage(dbname, mode)
+        i = 0
+        while not stop.is_set():
+            store.set_user('user{}'.format(i % users),
+                           gecos='Changed {}'.format(i))
+            writes[0] += 1
+            i += 1
+            if write_delay:
+                sleep(write_delay)
+
+    threads = [threading.Thread(target=reader, args=(n,))
+               for n in range(readers)]
+    threads.append(threading.Thread(target=writer))
+
+    start = perf_counter()
+    for t in threads:
+        t.start()
+
+    sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    elapsed = perf_counter() - start
+    return (sum(counts) / elapsed, writes[0] / elapsed)
+
+
+parser = argparse.ArgumentParser(description='Compare SQLite storage modes')
+parser.add_argument('--users', type=int, default=10000,
+                    help='Users in the database')
+parser.add_argument('--readers', type=int, default=8,
+                    help='Reader threads')
+parser.add_argument('--seconds', type=float, default=5,
+                    help='How long to run each mode for')
+parser.add_argument('--write-delay', type=float, default=0.001,
+                    help='Seconds the writer sleeps between writes')
+
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmp:
+    for mode in ('locked', 'wal'):
+        # A fresh file each time, since WAL mode sticks to the file
+        dbname = os.path.join(tmp, mode + '.db')
+
+        # Schema is set up once per process; the new file needs it too
+        backend.ProtocolStorage._initdb = False
+        populate(dbname, args.users)
+
+        reads, writes = run(dbname, mode, args.users, args.readers,
+                            args.seconds, args.write_delay)
+        print('{:>6}: {:>10.0f} reads/s, {:>8.0f} writes/s ({} readers)'
+              .format(mode, reads, writes, args.readers))
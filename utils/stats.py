@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import socket
+import sys
+import argparse
+import json
+
+from pathlib import Path
+basedir = Path(__file__).resolve().parent.parent
+sys.path.append(str(basedir))
+
+import settings
+
+from server.parser import JSONFrame, MAXFRAME
+
+
+def process_multipart(sock, command):
+    """ Read frames until the end of a multipart stream for command """
+    frames = []
+    data = b''
+    while True:
+        data += sock.recv(MAXFRAME * 4)
+        *lines, data = data.split(JSONFrame.terminator)
+        for line in lines:
+            if not line:
+                continue
+
+            frame = JSONFrame.parse(line + JSONFrame.terminator)
+            frames.append(frame)
+
+            if frame.command == 'error':
+                return frames
+
+            if (frame.command == command and
+                    frame.kval.get('multipart') == ['*']):
+                return frames
+
+
+parser = argparse.ArgumentParser(description='Dump runtime metrics from the '
+                                 'server')
+parser.add_argument('--raw', action='store_true', help="Print the raw frames")
+parser.add_argument('metric', nargs='*', help="Metrics to show (default: all)")
+
+args = parser.parse_args()
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+path = str(basedir.joinpath(settings.unix_path))
+sock.connect(path)
+
+sock.sendall(bytes(JSONFrame('*', '*', 'stats', {})))
+resp = process_multipart(sock, 'stats')
+
+if args.raw:
+    print('Response:', repr(resp))
+    quit()
+
+stats = {}
+for frame in resp:
+    if frame.command == 'error':
+        print('Error:', frame.kval.get('reason'), file=sys.stderr)
+        quit(1)
+
+    for name, value in zip(frame.kval.get('metric', []),
+                           frame.kval.get('value', [])):
+        stats[name] = json.loads(value)
+
+if args.metric:
+    stats = {k: v for k, v in stats.items() if k in args.metric}
+
+print(json.dumps(stats, indent=2, sort_keys=True))
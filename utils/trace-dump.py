@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# Copyright © 2014 Elizabeth Myers, Andrew Wilcox. All rights reserved.
+# This software is free and open source. You can redistribute and/or modify it
+# under the terms of the Do What The Fuck You Want To Public License, Version
+# 2, as published by Sam Hocevar. See the LICENSE file for more details.
+
+import socket
+import sys
+import argparse
+import json
+
+from collections import defaultdict
+from pathlib import Path
+basedir = Path(__file__).resolve().parent.parent
+sys.path.append(str(basedir))
+
+import settings
+
+from server.parser import JSONFrame, MAXFRAME
+
+
+def process_multipart(sock, command):
+    """ Read frames until the end of a reply for command """
+    frames = []
+    data = b''
+    while True:
+        data += sock.recv(MAXFRAME * 4)
+        *lines, data = data.split(JSONFrame.terminator)
+        for line in lines:
+            if not line:
+                continue
+
+            frame = JSONFrame.parse(line + JSONFrame.terminator)
+            frames.append(frame)
+
+            if frame.command == 'error':
+                return frames
+
+            if frame.command == command:
+                multipart = frame.kval.get('multipart')
+                if multipart is None or multipart == ['*']:
+                    return frames
+
+
+def print_span(spans, children, trace_id, span_id, depth=0):
+    name, offset, duration = spans[(trace_id, span_id)]
+    duration = '...' if duration is None else '{}us'.format(duration)
+    print('{}{} +{}us {}'.format('  ' * depth, name, offset, duration))
+
+    for child in children[(trace_id, span_id)]:
+        print_span(spans, children, trace_id, child, depth + 1)
+
+
+parser = argparse.ArgumentParser(description='Dump sampled command traces '
+                                 'from the server')
+parser.add_argument('--clear', action='store_true',
+                    help="Clear the trace buffer afterwards")
+parser.add_argument('--json', action='store_true',
+                    help="Print raw span rows as JSON")
+
+args = parser.parse_args()
+
+sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+path = str(basedir.joinpath(settings.unix_path))
+sock.connect(path)
+
+kwds = {'clear': ['*']} if args.clear else {}
+sock.sendall(bytes(JSONFrame('*', '*', 'trace', kwds)))
+resp = process_multipart(sock, 'trace')
+
+rows = []
+for frame in resp:
+    if frame.command == 'error':
+        print('Error:', frame.kval.get('reason'), file=sys.stderr)
+        quit(1)
+
+    rows.extend(json.loads(s) for s in frame.kval.get('span', []))
+
+if args.json:
+    print(json.dumps(rows))
+    quit()
+
+spans = {}
+children = defaultdict(list)
+roots = []
+for trace_id, span_id, parent, name, offset, duration in rows:
+    spans[(trace_id, span_id)] = (name, offset, duration)
+    if parent:
+        children[(trace_id, parent)].append(span_id)
+    else:
+        roots.append((trace_id, span_id))
+
+for trace_id, span_id in roots:
+    print('Trace', trace_id)
+    print_span(spans, children, trace_id, span_id, 1)